@@ -0,0 +1,368 @@
+import asyncio
+import json
+import logging
+import uuid
+from book_api.open_ai_service import (
+    build_batch_request,
+    create_batch_async,
+    get_batch_async,
+    get_batch_results_async,
+)
+from book_api.chroma_db_service import get_books_by_theme_groups
+from book_api.persistence import (
+    claim_bulk_job,
+    create_bulk_job,
+    get_bulk_job,
+    get_bulk_job_ids,
+    get_bulk_job_prompts,
+    transition_bulk_job,
+)
+from book_api.rag_config import (
+    RESPONSE_MODE,
+    BULK_JOB_CLAIM_TIMEOUT_SECONDS,
+    BULK_JOB_MAX_PROMPTS,
+    BULK_RETRIEVAL_CHUNK_SIZE,
+)
+from book_api.rag_service import (
+    tools,
+    instructions_identify_themes,
+    instructions_format_recommendations,
+    parse_tool_calls,
+    build_recommendation,
+)
+from book_api.context_builder import (
+    build_tool_call_context,
+    function_call_items,
+)
+from book_api.metrics import get_usage_metrics
+
+logger = logging.getLogger(__name__)
+
+# Job statuses: theme extraction batch -> (local retrieval) ->
+# formatting batch ("llm" mode only) -> completed
+EXTRACTING_THEMES = "extracting_themes"
+FORMATTING = "formatting"
+COMPLETED = "completed"
+FAILED = "failed"
+# While a worker acts on a finished batch, the job is claimed (in SQLite,
+# so across worker processes), so no other worker acts on it too
+RETRIEVING = "retrieving"
+COLLECTING = "collecting"
+CLAIMED_STATUSES = {EXTRACTING_THEMES: RETRIEVING, FORMATTING: COLLECTING}
+WAITING_STATUSES = {
+    claimed: waiting for waiting, claimed in CLAIMED_STATUSES.items()
+}
+ACTIVE_STATUSES = (*CLAIMED_STATUSES, *WAITING_STATUSES)
+# Batch statuses after which a batch has no (more) results coming
+FAILED_BATCH_STATUSES = ("failed", "expired", "cancelled")
+
+
+def _custom_id(job_id, prompt_index):
+    return f"{job_id}-{prompt_index}"
+
+
+def _prompt_index(custom_id):
+    return int(custom_id.rsplit("-", 1)[1])
+
+
+async def submit_bulk_job(prompts, response_mode=None):
+    """
+    Submit a bulk recommendation job, for many prompts at once.
+
+    Both LLM steps go through the Batch API (at half the price, but
+    taking up to 24 hours each): the theme extraction batch is submitted
+    right away, and the job is then moved along by
+    :func:`advance_bulk_job`.
+
+    :param prompts: The prompts to recommend books for.
+    :type prompts: list[str]
+    :param response_mode: "llm", "markdown" or "json", as for
+        :func:`book_api.rag_service.get_book_recommendation`.
+        (Defaults to the RESPONSE_MODE setting.)
+    :type response_mode: str, optional
+    :returns: The job's status, as from :func:`get_bulk_job_status`.
+    :rtype: dict
+    :raises ValueError: If there are no prompts, or too many.
+    """
+    if not prompts or len(prompts) > BULK_JOB_MAX_PROMPTS:
+        raise ValueError(
+            f"Bulk jobs take 1 to {BULK_JOB_MAX_PROMPTS} prompts,"
+            f" got {len(prompts)}"
+        )
+    response_mode = response_mode or RESPONSE_MODE
+    job_id = uuid.uuid4().hex
+    batch = await create_batch_async([
+        build_batch_request(
+            _custom_id(job_id, index),
+            [prompt],
+            instructions=instructions_identify_themes,
+            tools=tools,
+            max_output_tokens=100,
+        )
+        for index, prompt in enumerate(prompts)
+    ])
+    await asyncio.to_thread(
+        create_bulk_job,
+        job_id, EXTRACTING_THEMES, response_mode, prompts, batch.id
+    )
+    logger.info(
+        "Submitted bulk job %s (%d prompts), batch %s.",
+        job_id, len(prompts), batch.id,
+    )
+    return await asyncio.to_thread(get_bulk_job_status, job_id)
+
+
+async def advance_bulk_job(job_id):
+    """
+    Move a bulk job along, if the batch it's waiting on is done.
+
+    When the theme extraction batch is done, retrieval is run locally for
+    all prompts, and the formatting batch is submitted (or, in the local
+    formatting modes, the job is completed right away). When the
+    formatting batch is done, the job is completed.
+
+    Either way, the job is claimed first, so that only one worker (of
+    any process) acts on the finished batch.
+
+    :param job_id: The ID of the job.
+    :type job_id: str
+    :returns: The job's status, as from :func:`get_bulk_job_status`.
+    :rtype: dict
+    """
+    job = await asyncio.to_thread(get_bulk_job, job_id)
+    if job is None or job["status"] not in ACTIVE_STATUSES:
+        return await asyncio.to_thread(get_bulk_job_status, job_id)
+    # Claimed jobs are checked on too, in case their claim went stale
+    waiting_status = WAITING_STATUSES.get(job["status"], job["status"])
+    batch_id = (
+        job["theme_batch_id"] if waiting_status == EXTRACTING_THEMES
+        else job["format_batch_id"]
+    )
+    batch = await get_batch_async(batch_id)
+    if batch.status in FAILED_BATCH_STATUSES:
+        await asyncio.to_thread(
+            transition_bulk_job, job_id, waiting_status,
+            status=FAILED, error=f"Batch {batch.id} {batch.status}",
+        )
+    elif batch.status == "completed":
+        claimed_status = CLAIMED_STATUSES[waiting_status]
+        claimed_at = await asyncio.to_thread(
+            claim_bulk_job, job_id, waiting_status, claimed_status,
+            BULK_JOB_CLAIM_TIMEOUT_SECONDS,
+        )
+        if claimed_at is None:
+            # Another worker is on it
+            return await asyncio.to_thread(get_bulk_job_status, job_id)
+        job = {**job, "status": claimed_status, "claimed_at": claimed_at}
+        try:
+            if waiting_status == EXTRACTING_THEMES:
+                await _retrieve_and_format(job, batch)
+            else:
+                await _complete_formatting(job, batch)
+        except BaseException:
+            # Give the job back, to be retried on the next poll
+            await asyncio.to_thread(
+                transition_bulk_job, job_id, claimed_status,
+                claimed_at=claimed_at, status=waiting_status,
+            )
+            raise
+    return await asyncio.to_thread(get_bulk_job_status, job_id)
+
+
+async def advance_bulk_jobs():
+    """Move along all running bulk jobs (see :func:`advance_bulk_job`)."""
+    job_ids = await asyncio.to_thread(get_bulk_job_ids, ACTIVE_STATUSES)
+    for job_id in job_ids:
+        try:
+            await advance_bulk_job(job_id)
+        except Exception as e:
+            # Leave it be; it's retried on the next poll
+            logger.exception("Could not advance bulk job %s: %s", job_id, e)
+
+
+async def _retrieve_and_format(job, batch):
+    job_id = job["id"]
+    prompts = {
+        prompt_index: prompt
+        for prompt_index, prompt, _, _, _ in await asyncio.to_thread(
+            get_bulk_job_prompts, job_id
+        )
+    }
+    responses, records = await get_batch_results_async(batch, {
+        _custom_id(job_id, prompt_index): (
+            instructions_identify_themes, prompt
+        )
+        for prompt_index, prompt in prompts.items()
+    })
+
+    tool_calls = {}  # Prompt index -> tool calls
+    function_calls = {}  # Prompt index -> function call items
+    errors = {}  # Prompt index -> error
+    for custom_id, response in responses.items():
+        prompt_index = _prompt_index(custom_id)
+        if response is None:
+            errors[prompt_index] = "Theme extraction failed"
+            continue
+        try:
+            tool_calls[prompt_index] = parse_tool_calls(response)
+        except ValueError as e:
+            errors[prompt_index] = str(e)
+            continue
+        function_calls[prompt_index] = function_call_items(response)
+    returned = {_prompt_index(custom_id) for custom_id in responses}
+    for prompt_index in prompts.keys() - returned:
+        errors[prompt_index] = "Missing from the batch results"
+
+    # Step 3, in bulk: one embedding request and one query per chunk
+    all_tool_calls = [
+        (prompt_index, tool_call)
+        for prompt_index, calls in tool_calls.items()
+        for tool_call in calls
+    ]
+    books_per_call = []
+    for start in range(0, len(all_tool_calls), BULK_RETRIEVAL_CHUNK_SIZE):
+        chunk = all_tool_calls[start:start + BULK_RETRIEVAL_CHUNK_SIZE]
+        books_per_call.extend(await get_books_by_theme_groups(
+            [themes for _, (_, themes, _) in chunk],
+            [n_results for _, (_, _, n_results) in chunk],
+            request_keys=[prompt_index for prompt_index, _ in chunk],
+        ))
+    books_per_prompt = {prompt_index: [] for prompt_index in tool_calls}
+    for (prompt_index, _), books in zip(all_tool_calls, books_per_call):
+        books_per_prompt[prompt_index].append(books)
+
+    results = []  # (prompt index, books JSON, response, error)
+    format_requests = []
+    for prompt_index, calls in tool_calls.items():
+        books = [
+            book
+            for call_books in books_per_prompt[prompt_index]
+            for book in call_books
+        ]
+        results.append((prompt_index, json.dumps(books), None, None))
+        if job["response_mode"] == "llm":
+            input_list, _ = build_tool_call_context(
+                prompts[prompt_index],
+                function_calls[prompt_index],
+                calls,
+                books_per_prompt[prompt_index],
+            )
+            format_requests.append(build_batch_request(
+                _custom_id(job_id, prompt_index),
+                input_list,
+                instructions=instructions_format_recommendations,
+                max_output_tokens=1000,
+            ))
+    results.extend(
+        (prompt_index, None, None, error)
+        for prompt_index, error in errors.items()
+    )
+
+    if not format_requests:
+        if await _transition(job, results, records, status=COMPLETED):
+            logger.info("Bulk job %s completed.", job_id)
+        return
+    # Step 4, in bulk
+    format_batch = await create_batch_async(format_requests)
+    if not await _transition(
+        job, results, records,
+        status=FORMATTING, format_batch_id=format_batch.id,
+    ):
+        return
+    logger.info(
+        "Bulk job %s retrieved books, formatting in batch %s.",
+        job_id, format_batch.id,
+    )
+
+
+async def _complete_formatting(job, batch):
+    job_id = job["id"]
+    rows = await asyncio.to_thread(get_bulk_job_prompts, job_id)
+    responses, records = await get_batch_results_async(batch, {
+        _custom_id(job_id, prompt_index): (
+            instructions_format_recommendations, prompt
+        )
+        for prompt_index, prompt, _, _, error in rows
+        if error is None
+    })
+    results = []
+    for prompt_index, _, books, _, error in rows:
+        if error is not None:
+            continue
+        response = responses.get(_custom_id(job_id, prompt_index))
+        if response is None:
+            results.append((prompt_index, books, None, "Formatting failed"))
+        else:
+            results.append((prompt_index, books, response.output_text, None))
+    if await _transition(job, results, records, status=COMPLETED):
+        logger.info("Bulk job %s completed.", job_id)
+
+
+async def _transition(job, results, records, **fields):
+    """
+    Move a claimed job on, recording its results along with the batch
+    usage (see :func:`book_api.persistence.transition_bulk_job`).
+
+    :returns: Whether the job was moved on (if not, its claim went stale
+        and it was taken over, and nothing was recorded).
+    :rtype: bool
+    """
+    if not await asyncio.to_thread(
+        transition_bulk_job, job["id"], job["status"], results, records,
+        claimed_at=job["claimed_at"], **fields
+    ):
+        logger.warning(
+            "Lost the claim on bulk job %s, dropping its results.",
+            job["id"],
+        )
+        return False
+    # Only counted once persisted, so they're never counted twice
+    usage_metrics = get_usage_metrics()
+    for record in records:
+        usage_metrics.record(record)
+    return True
+
+
+def get_bulk_job_status(job_id):
+    """
+    Get a bulk job's status.
+
+    :param job_id: The ID of the job.
+    :type job_id: str
+    :returns: The job's fields, with the number of prompts that failed
+        so far ("failed_count"), or None if there is no such job.
+    :rtype: dict or None
+    """
+    job = get_bulk_job(job_id)
+    if job is None:
+        return None
+    job["failed_count"] = sum(
+        1 for *_, error in get_bulk_job_prompts(job_id) if error is not None
+    )
+    return job
+
+
+def get_bulk_job_results(job_id):
+    """
+    Get a bulk job's results (so far).
+
+    :param job_id: The ID of the job.
+    :type job_id: str
+    :returns: For each prompt, a dict with the "prompt" and either the
+        recommendation (as from
+        :func:`book_api.rag_service.get_book_recommendation`)
+        or an "error". Prompts without a result yet have neither.
+    :rtype: list[dict]
+    """
+    job = get_bulk_job(job_id)
+    results = []
+    for _, prompt, books, response, error in get_bulk_job_prompts(job_id):
+        result = {"prompt": prompt}
+        if error is not None:
+            result["error"] = error
+        elif job["status"] == COMPLETED:
+            result.update(build_recommendation(
+                job["response_mode"], response, json.loads(books)
+            ))
+        results.append(result)
+    return results
@@ -3,3 +3,13 @@ from os import getenv
 CHROMA_HOST = getenv("CHROMA_HOST")  # No default, must be set
 CHROMA_PORT = int(getenv("CHROMA_PORT", "8000"))
 CHROMA_COLLECTION_NAME = getenv("CHROMA_COLLECTION_NAME", "book_summaries")
+SUMMARIES_PATH = getenv("SUMMARIES_PATH", "book_api/summaries.txt")
+
+# Ingestion pipeline (summaries.txt -> embeddings -> ChromaDB)
+# OpenAI allows up to 2048 inputs and 300k tokens per embedding request
+INGEST_BATCH_MAX_ITEMS = int(getenv("INGEST_BATCH_MAX_ITEMS", "512"))
+INGEST_BATCH_MAX_TOKENS = int(getenv("INGEST_BATCH_MAX_TOKENS", "100000"))
+INGEST_CONCURRENCY = int(getenv("INGEST_CONCURRENCY", "4"))
+INGEST_PROGRESS_EVERY_SECONDS = float(
+    getenv("INGEST_PROGRESS_EVERY_SECONDS", "5")
+)
@@ -1,9 +1,26 @@
-from book_api.chroma_db_setup import get_chroma_collection
+from collections import Counter
+from book_api.embedding_cache import get_embedding_vector_async
+from book_api.lexical_index import get_lexical_index, reciprocal_rank_fusion
+from book_api.neighbour_table import (
+    get_neighbour_table,
+    record_materialized_hit,
+)
+from book_api.rag_config import (
+    LEXICAL_RETRIEVAL_ENABLED,
+    MATERIALIZED_THEMES_ENABLED,
+    MATERIALIZED_THEMES_MIN_SIMILARITY,
+    RRF_K,
+)
+from book_api.retrieval_backends import get_retrieval_backend
+from book_api.tracing import span
 
 
-def get_book_by_themes(themes, n_results=3):
+async def get_book_by_themes(themes, n_results=3):
     """
-    Retrieve book summaries from ChromaDB based on thematic similarity.
+    Retrieve book summaries based on thematic similarity.
+
+    Both the query embedding and the ChromaDB query are awaited,
+    so this never blocks the event loop.
 
     :param themes: A list of strings describing the themes to search for.
     :type themes: list[str]
@@ -12,25 +29,208 @@ def get_book_by_themes(themes, n_results=3):
     :returns: A list of dictionaries containing title, author, and summary.
     :rtype: list of dict
     """
-    collection = get_chroma_collection()
-    results = collection.query(
-        query_texts=[" ".join(themes)],
-        n_results=n_results,
-        include=["metadatas", "documents", "distances"],
+    books_per_group = await get_books_by_theme_groups([themes], [n_results])
+    return books_per_group[0]
+
+
+async def get_books_by_theme_groups(
+    theme_groups,
+    n_results_per_group=None,
+    request_keys=None
+):
+    """
+    Retrieve book summaries for several groups of themes at once.
+
+    Costs one embedding request and one query, whatever the number of
+    groups. A book is only returned for the first group it matches (among
+    groups of the same request), so groups don't repeat each other;
+    groups are topped up with their next-closest books instead.
+
+    If lexical retrieval is enabled, groups naming a title or author get
+    those books first, topped up from the lexical index alone (without
+    embedding the group). Other groups get the vector and lexical
+    rankings fused. If materialized themes are enabled, groups close
+    enough to a theme cluster get its representative books instead of
+    querying the retrieval backend.
+
+    :param theme_groups: The groups of themes (e.g. one per tool call).
+    :type theme_groups: list[list[str]]
+    :param n_results_per_group: The number of book summaries to retrieve
+        for each group (None for the default of 3).
+    :type n_results_per_group: list[int | None], optional
+    :param request_keys: The request each group belongs to, when
+        retrieving for several requests at once (e.g. bulk jobs).
+        (Defaults to all groups belonging to the same request.)
+    :type request_keys: list, optional
+    :returns: For each group, a list of dictionaries containing title,
+        author, and summary.
+    :rtype: list[list[dict]]
+    """
+    if not theme_groups:
+        return []
+    if n_results_per_group is None:
+        n_results_per_group = [None] * len(theme_groups)
+    if request_keys is None:
+        request_keys = [None] * len(theme_groups)
+    n_results_per_group = [
+        3 if n_results is None else n_results
+        for n_results in n_results_per_group
+    ]
+
+    queries = [" ".join(themes) for themes in theme_groups]
+    # Fetch enough to top groups up after de-duplication
+    max_groups_per_request = max(Counter(request_keys).values())
+    n_fetched = max(n_results_per_group) * max_groups_per_request
+
+    if LEXICAL_RETRIEVAL_ENABLED:
+        with span("lexical_query"):
+            ranked_books_per_group = _lexical_rankings(queries, n_fetched)
+    else:
+        ranked_books_per_group = [([], False)] * len(queries)
+    # Groups without an exact match go through the vector search too
+    vector_groups = [
+        index for index, (_, exact) in enumerate(ranked_books_per_group)
+        if not exact
+    ]
+    if vector_groups:
+        query_embeddings = await get_embedding_vector_async(
+            [queries[index] for index in vector_groups]
+        )
+        if MATERIALIZED_THEMES_ENABLED:
+            with span("materialized_theme_lookup"):
+                vector_groups, query_embeddings = _materialized_rankings(
+                    vector_groups, query_embeddings, ranked_books_per_group,
+                    n_results_per_group, n_fetched,
+                )
+    if vector_groups:
+        with span("retrieval_query"):
+            results = await get_retrieval_backend().query(
+                query_embeddings, n_fetched
+            )
+        for index, (books, _) in zip(vector_groups, results):
+            lexical_books, _ = ranked_books_per_group[index]
+            ranked_books_per_group[index] = (
+                _fuse(books, lexical_books), False
+            )
+
+    seen = set()  # (request key, title, author)
+    books_per_group = []
+    for (books, _), n_results, request_key in zip(
+        ranked_books_per_group, n_results_per_group, request_keys
+    ):
+        group_books = []
+        for book in books:
+            if len(group_books) >= n_results:
+                break
+            key = (request_key, book["title"], book["author"])
+            if key not in seen:
+                seen.add(key)
+                group_books.append(book)
+        books_per_group.append(group_books)
+    return books_per_group
+
+
+def _lexical_rankings(queries, n_results):
+    """
+    Rank books for each query from the lexical index.
+
+    :returns: For each query, a tuple of (the books, whether they start
+        with exact title or author matches).
+    """
+    lexical_index = get_lexical_index()
+    rankings = []
+    for query in queries:
+        exact_rows = lexical_index.exact_matches(query)
+        rows = list(dict.fromkeys(
+            exact_rows + lexical_index.search(query, n_results)
+        ))
+        rankings.append((
+            [lexical_index.books[row] for row in rows[:n_results]],
+            bool(exact_rows),
+        ))
+    return rankings
+
+
+def _materialized_rankings(
+    groups, query_embeddings, rankings, n_results_per_group, n_fetched
+):
+    """
+    Rank books from the theme clusters, for the groups close enough to
+    one (see ``MATERIALIZED_THEMES_MIN_SIMILARITY``), fused with their
+    lexical rankings. Groups asking for more books than a cluster keeps
+    representatives still query the retrieval backend.
+
+    :returns: A tuple of (the other groups, their query embeddings),
+        still to query the retrieval backend for.
+    """
+    neighbour_table = get_neighbour_table()
+    if neighbour_table is None:
+        return groups, query_embeddings
+    remaining_groups = []
+    remaining_embeddings = []
+    for index, query_embedding in zip(groups, query_embeddings):
+        cluster, similarity = neighbour_table.match_cluster(query_embedding)
+        if (
+            cluster is None
+            or similarity < MATERIALIZED_THEMES_MIN_SIMILARITY
+            or n_results_per_group[index] > len(
+                neighbour_table.clusters[cluster]["representatives"]
+            )
+        ):
+            remaining_groups.append(index)
+            remaining_embeddings.append(query_embedding)
+            continue
+        record_materialized_hit()
+        lexical_books, _ = rankings[index]
+        books = [
+            {
+                "title": book["title"],
+                "author": book["author"],
+                "summary": book["summary"],
+            }
+            for book in neighbour_table.get_cluster_books(cluster, n_fetched)
+        ]
+        rankings[index] = (_fuse(books, lexical_books), False)
+    return remaining_groups, remaining_embeddings
+
+
+def _book_key(book):
+    return book["title"], book["author"]
+
+
+def _fuse(vector_books, lexical_books):
+    """
+    Fuse vector and lexical rankings of books (see ``RRF_K``).
+    With no lexical ranking, the vector ranking is kept as is.
+    """
+    books = {
+        _book_key(book): book for book in lexical_books + vector_books
+    }
+    fused_keys = reciprocal_rank_fusion(
+        [
+            [_book_key(book) for book in vector_books],
+            [_book_key(book) for book in lexical_books],
+        ],
+        RRF_K,
     )
-    ids = results["ids"][0]
-    documents = results["documents"][0]  # type: ignore
-    metadatas = results["metadatas"][0]  # type: ignore
-    # distances = results["distances"][0]  # type: ignore
-    # Pylance doesn't understand that we explicitly asked for these
-
-    books = []
-    for idx in range(len(ids)):
-        books.append({
-            "title": metadatas[idx].get("title", "Unknown Title"),
-            "author": metadatas[idx].get("author", "Unknown Author"),
-            "summary": documents[idx],
-            # "distance": distances[idx],
-        })
-
-    return books
+    return [books[key] for key in fused_keys]
+
+
+async def get_books_by_embedding(query_embedding, n_results=3):
+    """
+    Retrieve book summaries closest to a query embedding,
+    from the configured retrieval backend.
+
+    :param query_embedding: The embedding to search with.
+    :type query_embedding: list[float]
+    :param n_results: The number of similar book summaries to retrieve.
+    :type n_results: int
+    :returns: A tuple of (a list of dictionaries containing title, author,
+        and summary; the matching list of cosine distances).
+    :rtype: tuple[list[dict], list[float]]
+    """
+    with span("retrieval_query"):
+        results = await get_retrieval_backend().query(
+            [query_embedding], n_results
+        )
+    return results[0]
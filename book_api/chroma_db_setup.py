@@ -1,15 +1,45 @@
-from chromadb import HttpClient
-from chromadb.api.types import EmbeddingFunction, Embeddable, Metadata
-from book_api.open_ai_service import get_embedding_vector
+import logging
+from hashlib import sha256
+from book_api.embedding_cache import get_embedding_vector
+from book_api.persistence import (
+    get_library_manifest,
+    update_library_manifest,
+)
 from book_api.chroma_db_config import (
     CHROMA_HOST,
     CHROMA_PORT,
     CHROMA_COLLECTION_NAME,
+    SUMMARIES_PATH,
 )
+from book_api.ingestion import ingest_entries
+from book_api.transport import chroma_settings
 
+logger = logging.getLogger(__name__)
 
 _client = None  # Must setup first
 _collection = None
+_async_client = None  # For the async request path
+_async_collection = None
+_library_change_listeners = []  # Called when the library contents change
+
+
+def add_library_change_listener(listener):
+    """
+    Register a callable to be invoked whenever the library changes.
+
+    Used to invalidate anything derived from the library (e.g. caches).
+    A listener added more than once is still only called once.
+
+    :param listener: A callable taking no arguments.
+    :type listener: callable
+    """
+    if listener not in _library_change_listeners:
+        _library_change_listeners.append(listener)
+
+
+def _notify_library_changed():
+    for listener in _library_change_listeners:
+        listener()
 
 
 def get_chroma_collection():
@@ -22,6 +52,16 @@ def get_chroma_collection():
     return _collection
 
 
+def get_async_chroma_collection():
+    """Get the async ChromaDB collection (after async setup)."""
+    if _async_collection is None:
+        raise ValueError(
+            "Async ChromaDB collection not set up."
+            " Call setup_async_chroma_db() first."
+        )
+    return _async_collection
+
+
 def get_id_for_title_author(title, author):
     """Get the ChromaDB ID for a given title and author."""
     return (
@@ -30,78 +70,192 @@ def get_id_for_title_author(title, author):
     )
 
 
+def iter_summaries_txt(summaries_path=SUMMARIES_PATH):
+    """
+    Parse summaries.txt lazily, yielding (title, author, summary) tuples.
+
+    The file is read line by line, so only one entry is held in memory
+    at a time, however large the file.
+    """
+    def parse_entry(lines):
+        if len(lines) >= 3:
+            title = lines[0].replace("## Title: ", "").strip()
+            author = lines[1].replace("# Author: ", "").strip()
+            summary = "\n".join(lines[2:]).strip()
+            return title, author, summary
+        return None
+
+    with open(summaries_path, "r", encoding="utf-8") as summaries_file:
+        lines = []
+        for line in summaries_file:
+            line = line.strip()
+            if line:
+                lines.append(line)
+                continue
+            # A blank line ends the current entry
+            entry = parse_entry(lines)
+            if entry is not None:
+                yield entry
+            lines = []
+        entry = parse_entry(lines)
+        if entry is not None:
+            yield entry
+
+
+def get_summaries_fingerprint(summaries_path=SUMMARIES_PATH):
+    """
+    Get a fingerprint of summaries.txt, so anything built straight from
+    it can tell whether it's stale.
+    """
+    fingerprint = sha256()
+    with open(summaries_path, "rb") as summaries_file:
+        for chunk in iter(lambda: summaries_file.read(1 << 20), b""):
+            fingerprint.update(chunk)
+    return fingerprint.hexdigest()
+
+
 def parse_summaries_txt():
     """
     Parse summaries.txt into a list of (title, author, summary) tuples.
     """
-    summaries_path = "book_api/summaries.txt"  # Note: currently hardcoded
+    return list(iter_summaries_txt())
 
-    summaries = []
-    with open(summaries_path, "r", encoding="utf-8") as summaries_file:
-        content = summaries_file.read()
 
-        entries = content.strip().split("\n\n")
-        for entry in entries:
-            lines = entry.strip().split("\n")
-            if len(lines) >= 3:
-                title = lines[0].replace("## Title: ", "").strip()
-                author = lines[1].replace("# Author: ", "").strip()
-                summary = "\n".join(lines[2:]).strip()
-                summaries.append((title, author, summary))
+def get_content_hash(title, author, summary):
+    """Get a hash of a library entry's content, to detect changes."""
+    content = "\n".join((title, author, summary))
+    return sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_library_fingerprint():
+    """
+    Get a fingerprint of the library contents loaded in ChromaDB.
+
+    Changes whenever an entry is added, changed or removed, so anything
+    derived from the library can tell whether it's stale.
+    """
+    fingerprint = sha256()
+    for entry_id, content_hash in sorted(get_library_manifest().items()):
+        fingerprint.update(f"{entry_id}:{content_hash}\n".encode("utf-8"))
+    return fingerprint.hexdigest()
+
 
-    return summaries
+def _read_manifest_from_collection(collection):
+    """Rebuild the manifest (ID -> content hash) from ChromaDB metadata."""
+    results = collection.get(include=["metadatas"])  # type: ignore
+    metadatas = results["metadatas"] or []
+    return {
+        entry_id: str(metadata.get("content_hash", ""))
+        # Entries loaded before hashes were stored, or with mocked
+        # embeddings (see ingest_entries), have none, so they'll count
+        # as changed (and get re-embedded)
+        for entry_id, metadata in zip(results["ids"], metadatas)
+    }
 
 
 def ensure_summaries_up_to_date():
-    """Ensure that the summaries are loaded into the ChromaDB collection."""
+    """
+    Sync summaries.txt into the ChromaDB collection, incrementally.
+
+    Only added or changed entries are upserted (and so embedded), and
+    removed entries are deleted. What's loaded is tracked in the library
+    manifest, so an unchanged library costs no embedding calls.
+    The file is streamed through the ingestion pipeline, so memory use
+    stays flat however large the library is.
+
+    :returns: The number of added, updated, removed and unchanged entries.
+    :rtype: dict
+    """
     # Step 0: Ensure setup has been done
     collection = get_chroma_collection()
 
-    # Note: currently we're only checking that there ARE summaries in there
-    # A more complete solution would also check whether these are up-to-date
-    # (e.g. that they haven't been updated in summaries.txt), and if not
-    # update only the changed ones.
-    # Step 1: Check if there are already summaries in the collection
-    existing_count = collection.count()
-    if existing_count > 0:
-        print(
-            "ChromaDB collection already has"
-            f" {existing_count} summaries. Skipping load."
+    # Step 1: Load the manifest of what's already in the collection
+    manifest = get_library_manifest()
+    if collection.count() != len(manifest):
+        # Out of step (e.g. first run with a manifest, or the ChromaDB
+        # volume was reset), so rebuild it from the collection itself
+        logger.info(
+            "Library manifest out of date, rebuilding it from ChromaDB..."
         )
-        return
+        manifest = _read_manifest_from_collection(collection)
+        update_library_manifest(manifest, [], replace=True)
 
-    # Step 2: If not, load summaries from summaries.txt
-    print(
-        "ChromaDB collection is empty."
-        " Loading summaries from summaries.txt..."
-    )
-    summaries = parse_summaries_txt()
-    ids = [
-        get_id_for_title_author(title, author)
-        for title, author, _ in summaries
-    ]
-    metadatas: list[Metadata] = [
-        {"title": title, "author": author}
-        for title, author, _ in summaries
+    # Step 2: Stream summaries.txt, keeping only added or changed entries
+    seen_ids = set()
+    sync_counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+
+    def changed_entries():
+        for title, author, summary in iter_summaries_txt():
+            entry_id = get_id_for_title_author(title, author)
+            if entry_id in seen_ids:
+                logger.warning(
+                    "Duplicate library entry %s, skipping.", entry_id
+                )
+                continue
+            seen_ids.add(entry_id)
+
+            content_hash = get_content_hash(title, author, summary)
+            if manifest.get(entry_id) == content_hash:
+                sync_counts["unchanged"] += 1
+                continue
+            if entry_id in manifest:
+                sync_counts["updated"] += 1
+            else:
+                sync_counts["added"] += 1
+            yield {
+                "id": entry_id,
+                "title": title,
+                "author": author,
+                "summary": summary,
+                "content_hash": content_hash,
+            }
+
+    # Step 3: Embed and upsert them in batches, recording each written
+    # batch in the manifest (so a crashed sync resumes where it left off)
+    def record_batch(batch):
+        update_library_manifest(
+            {entry["id"]: entry["content_hash"] for entry in batch}, []
+        )
+
+    ingest_entries(collection, changed_entries(), record_batch)
+
+    # Step 4: Delete entries that are no longer in summaries.txt
+    removed_ids = [
+        entry_id for entry_id in manifest if entry_id not in seen_ids
     ]
-    documents = [summary for _, _, summary in summaries]
+    if removed_ids:
+        collection.delete(ids=removed_ids)
+        update_library_manifest({}, removed_ids)
+    sync_counts["removed"] = len(removed_ids)
 
-    collection.add(
-        ids=ids,
-        metadatas=metadatas,
-        documents=documents
-    )
+    if not (
+        sync_counts["added"] or sync_counts["updated"] or removed_ids
+    ):
+        logger.info(
+            "ChromaDB collection up to date (%d summaries). Nothing to sync.",
+            sync_counts["unchanged"],
+        )
+        return sync_counts
+
+    logger.info("Synced summaries.txt into ChromaDB: %s", sync_counts)
+    _notify_library_changed()
+    return sync_counts
 
 
 def setup_chroma_db():
     """Set up the ChromaDB persistent client."""
+    # Imported here, as chromadb is slow to import (see transport)
+    from chromadb import HttpClient
+    from chromadb.api.types import EmbeddingFunction, Embeddable
     global _client, _collection
 
     # Set up the ChromaDB persistent client
     if _client is None:
         if CHROMA_HOST is None:
             raise ValueError("CHROMA_HOST environment variable not set")
-        _client = HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+        _client = HttpClient(
+            host=CHROMA_HOST, port=CHROMA_PORT, settings=chroma_settings()
+        )
 
     # Set up embedding callable
     # (Consider getting a cleverer name)
@@ -116,3 +270,28 @@ def setup_chroma_db():
         # FIXME: What's this metadata above even say?
         embedding_function=MyEmbedder()
     )
+
+
+async def setup_async_chroma_db():
+    """
+    Set up the async ChromaDB client, used by the request path.
+
+    Queries through this client are expected to pass precomputed
+    ``query_embeddings`` (see ``chroma_db_service``), so no embedding
+    function is attached here; the sync collection owns ingestion.
+    """
+    from chromadb import AsyncHttpClient
+    global _async_client, _async_collection
+
+    if _async_client is None:
+        if CHROMA_HOST is None:
+            raise ValueError("CHROMA_HOST environment variable not set")
+        _async_client = await AsyncHttpClient(
+            host=CHROMA_HOST, port=CHROMA_PORT, settings=chroma_settings()
+        )
+
+    _async_collection = await _async_client.get_or_create_collection(
+        name=CHROMA_COLLECTION_NAME,
+        metadata={"hnsw:space": "cosine"},
+        embedding_function=None,
+    )
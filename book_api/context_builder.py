@@ -0,0 +1,234 @@
+import json
+import threading
+from book_api.rag_config import FORMATTING_CONTEXT_MAX_TOKENS, MAX_N_RESULTS
+from book_api.tokens import count_tokens, truncate_to_tokens
+from book_api.tracing import set_trace_attributes
+
+TRIMMED_SUFFIX = "…"
+# A trimmed summary ends after its last full sentence that fits, unless
+# that would keep less than this share of what fits
+MIN_SENTENCE_CUT_RATIO = 0.5
+SENTENCE_ENDS = (". ", "! ", "? ", ".\n", "!\n", "?\n")
+
+_stats_lock = threading.Lock()
+_stats = {
+    "contexts": 0,
+    "trimmed_contexts": 0,
+    "trimmed_books": 0,
+    "summary_tokens": 0,
+    "kept_summary_tokens": 0,
+    "input_tokens": 0,
+}
+
+
+def clamp_n_results(n_results):
+    """
+    Clamp the number of books a tool call asks for to 1 to
+    ``MAX_N_RESULTS`` (the model may ask for any number).
+
+    :returns: The clamped number, or None for the default.
+    :rtype: int or None
+    """
+    try:
+        n_results = int(n_results)
+    except (TypeError, ValueError):
+        return None
+    return max(1, min(n_results, MAX_N_RESULTS))
+
+
+def function_call_items(response):
+    """
+    Get just the function call items from a response, to send back with
+    their outputs (the rest of the output isn't needed to answer them).
+
+    :param response: The theme identification response.
+    :type response: OpenAIResponse
+    :rtype: list[dict]
+    """
+    return [
+        {
+            "type": "function_call",
+            "call_id": item.call_id,
+            "name": item.name,
+            "arguments": item.arguments,
+        }
+        for item in response.output
+        if item.type == "function_call"
+    ]
+
+
+def function_call_outputs(tool_calls, books_per_call):
+    """
+    Build the function call output items answering the tool calls.
+
+    :param tool_calls: The tool calls, as from ``parse_tool_calls``.
+    :type tool_calls: list[tuple]
+    :param books_per_call: The books retrieved for each tool call.
+    :type books_per_call: list[list[dict]]
+    :returns: The input items to send back to OpenAI.
+    :rtype: list[dict]
+    """
+    return [
+        {
+            "type": "function_call_output",
+            "call_id": call_id,
+            "output": json.dumps({
+                "recommended_books": recommended_books
+            })
+        }
+        for (call_id, _, _), recommended_books in zip(
+            tool_calls, books_per_call
+        )
+    ]
+
+
+def build_tool_call_context(
+    user_input, function_calls, tool_calls, books_per_call
+):
+    """
+    Build the input for the formatting call, answering tool calls: the
+    prompt, the function calls, and their outputs, with the summaries
+    fitted to the token budget (see :func:`fit_summaries`).
+
+    :param user_input: The user's prompt.
+    :type user_input: str
+    :param function_calls: The function call items, as from
+        :func:`function_call_items`.
+    :type function_calls: list[dict]
+    :param tool_calls: The tool calls, as from ``parse_tool_calls``.
+    :type tool_calls: list[tuple]
+    :param books_per_call: The books retrieved for each tool call.
+    :type books_per_call: list[list[dict]]
+    :returns: A tuple of (the input list, the context report).
+    :rtype: tuple[list, dict]
+    """
+    books_per_call, report = fit_summaries(
+        books_per_call, FORMATTING_CONTEXT_MAX_TOKENS
+    )
+    input_list = [
+        user_input,
+        *function_calls,
+        *function_call_outputs(tool_calls, books_per_call),
+    ]
+    report["input_tokens"] = count_input_tokens(input_list)
+    return input_list, report
+
+
+def build_books_context(user_input, books):
+    """
+    Build the input for the formatting call, for books retrieved without
+    a tool call, so passed on as a developer message (summaries fitted to
+    the token budget, like in :func:`build_tool_call_context`).
+
+    :returns: A tuple of (the input list, the context report).
+    :rtype: tuple[list, dict]
+    """
+    (books,), report = fit_summaries([books], FORMATTING_CONTEXT_MAX_TOKENS)
+    input_list = [user_input, {
+        "role": "developer",
+        "content": json.dumps({"recommended_books": books}),
+    }]
+    report["input_tokens"] = count_input_tokens(input_list)
+    return input_list, report
+
+
+def fit_summaries(books_per_group, max_tokens):
+    """
+    Trim book summaries so they fit a token budget together.
+
+    Every book gets an equal share of the budget, and what shorter
+    summaries don't use goes to the longer ones, so only the longest are
+    trimmed (to their last full sentence that fits, where possible).
+
+    :param books_per_group: The books, in groups (e.g. per tool call).
+    :type books_per_group: list[list[dict]]
+    :param max_tokens: The token budget for all summaries.
+    :type max_tokens: int
+    :returns: A tuple of (the books, with summaries trimmed as needed,
+        in the same groups; the context report).
+    :rtype: tuple[list[list[dict]], dict]
+    """
+    counts = [
+        [count_tokens(book["summary"]) for book in books]
+        for books in books_per_group
+    ]
+    all_counts = [count for group in counts for count in group]
+    limit = _summary_limit(all_counts, max_tokens)
+    fitted_books_per_group = []
+    trimmed_books = 0
+    kept_tokens = 0
+    for books, group_counts in zip(books_per_group, counts):
+        fitted_books = []
+        for book, count in zip(books, group_counts):
+            if count > limit:
+                summary = _trim_summary(book["summary"], limit)
+                book = {**book, "summary": summary}
+                count = count_tokens(summary)
+                trimmed_books += 1
+            fitted_books.append(book)
+            kept_tokens += count
+        fitted_books_per_group.append(fitted_books)
+    return fitted_books_per_group, {
+        "budget_tokens": max_tokens,
+        "summary_tokens": sum(all_counts),
+        "kept_summary_tokens": kept_tokens,
+        "trimmed_books": trimmed_books,
+    }
+
+
+def _summary_limit(counts, max_tokens):
+    """The most tokens any one summary may keep to fit the budget."""
+    remaining = max_tokens
+    sorted_counts = sorted(counts)
+    for index, count in enumerate(sorted_counts):
+        share = remaining // (len(sorted_counts) - index)
+        if count > share:
+            return share
+        remaining -= count
+    return sorted_counts[-1] if sorted_counts else 0
+
+
+def _trim_summary(summary, max_tokens):
+    # Leave room for the suffix marking the summary as trimmed
+    kept = truncate_to_tokens(summary, max_tokens - 1)
+    sentence_end = max(kept.rfind(end) for end in SENTENCE_ENDS)
+    if sentence_end >= len(kept) * MIN_SENTENCE_CUT_RATIO:
+        return kept[:sentence_end + 1]
+    return kept.rstrip() + TRIMMED_SUFFIX
+
+
+def count_input_tokens(input_list):
+    """
+    Count the tokens in an input list locally (roughly: items are
+    counted as JSON, not as the model sees them).
+    """
+    return sum(
+        count_tokens(item if isinstance(item, str) else json.dumps(item))
+        for item in input_list
+    )
+
+
+def record_context_report(report):
+    """
+    Record the context sent to a formatting call, on the current trace
+    and in the running totals (see :func:`get_context_stats`).
+    """
+    set_trace_attributes({
+        f"formatting_context.{key}": value for key, value in report.items()
+    })
+    with _stats_lock:
+        _stats["contexts"] += 1
+        _stats["trimmed_contexts"] += bool(report["trimmed_books"])
+        for key in (
+            "trimmed_books",
+            "summary_tokens",
+            "kept_summary_tokens",
+            "input_tokens",
+        ):
+            _stats[key] += report[key]
+
+
+def get_context_stats():
+    """Get running totals of the contexts sent to formatting calls."""
+    with _stats_lock:
+        return {"budget_tokens": FORMATTING_CONTEXT_MAX_TOKENS, **_stats}
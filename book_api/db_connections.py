@@ -0,0 +1,96 @@
+import os
+import threading
+import weakref
+from sqlite3 import connect, Connection
+from book_api.persistence_config import (
+    DB_PATH,
+    SQLITE_BUSY_TIMEOUT_MS,
+    SQLITE_SYNCHRONOUS,
+    SQLITE_CACHE_SIZE_KB,
+    SQLITE_STATEMENT_CACHE_SIZE,
+)
+
+
+class _PooledConnection(Connection):
+    """A plain sqlite3 connection, but one that can be weakly referenced."""
+
+
+class ConnectionManager:
+    """
+    Hands out one long-lived SQLite connection per thread (and process).
+
+    Connections use WAL journaling (readers don't block the writer and
+    vice versa) and a busy timeout (writers from other threads or worker
+    processes wait for the lock instead of failing with "database is
+    locked"). Since connections live on, sqlite3's per-connection prepared
+    statement cache is reused across calls.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # All open connections, to close on shutdown. Weak references, so
+        # connections of threads that have exited get garbage collected
+        self._connections = weakref.WeakSet()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        conn = connect(
+            self.db_path,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=SQLITE_STATEMENT_CACHE_SIZE,
+            factory=_PooledConnection,
+            # Only ever used by the thread that opened it, but closed
+            # from whichever thread shuts down
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        return conn
+
+    def get_connection(self):
+        """Get this thread's connection, opening it if needed."""
+        if os.getpid() != self._pid:
+            # Forked (e.g. into a worker process): the parent's connections
+            # mustn't be used here, so start afresh
+            self._local = threading.local()
+            self._connections = weakref.WeakSet()
+            self._pid = os.getpid()
+
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.connection = conn
+            with self._lock:
+                self._connections.add(conn)
+        return conn
+
+    def release_connection(self):
+        """Close this thread's connection (e.g. before the thread exits)."""
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            return
+        self._local.connection = None
+        with self._lock:
+            self._connections.discard(conn)
+        conn.close()
+
+    def close_all(self):
+        """Close all connections (on shutdown)."""
+        with self._lock:
+            connections = list(self._connections)
+            self._connections = weakref.WeakSet()
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+_connection_manager = ConnectionManager(DB_PATH)
+
+
+def get_connection_manager():
+    """Get the shared SQLite connection manager."""
+    return _connection_manager
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from typing import List
+import numpy as np
+from book_api.open_ai_service import (
+    EMBEDDING_MODEL,
+    get_embedding_vector as get_uncached_embedding_vector,
+    get_embedding_vector_async as get_uncached_embedding_vector_async,
+)
+from book_api.persistence import get_cached_embeddings, persist_embeddings
+from book_api.rag_config import (
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    COALESCING_ENABLED,
+)
+from book_api.single_flight import get_single_flight
+from book_api.tracing import span
+
+# (model, sha256(text)) -> float32 vector, least recently used first
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()  # Lookups also run in worker threads
+
+
+def _text_hash(text):
+    return sha256(text.encode("utf-8")).hexdigest()
+
+
+def _from_memory(key):
+    with _memory_cache_lock:
+        vector = _memory_cache.get(key)
+        if vector is not None:
+            _memory_cache.move_to_end(key)
+        return vector
+
+
+def _to_memory(key, vector):
+    with _memory_cache_lock:
+        _memory_cache[key] = vector
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > EMBEDDING_CACHE_MAX_ENTRIES:
+            _memory_cache.popitem(last=False)
+
+
+def _lookup(texts):
+    """
+    Look up texts in the in-process tier, then in the SQLite tier.
+
+    :returns: A tuple of (vectors found so far, by text hash;
+        texts still missing, de-duplicated, by text hash).
+    """
+    found = {}
+    missing = {}
+    for text in texts:
+        text_hash = _text_hash(text)
+        vector = _from_memory((EMBEDDING_MODEL, text_hash))
+        if vector is not None:
+            found[text_hash] = vector
+        else:
+            missing[text_hash] = text
+
+    if missing:
+        stored = get_cached_embeddings(EMBEDDING_MODEL, list(missing))
+        for text_hash, blob in stored.items():
+            vector = np.frombuffer(blob, dtype=np.float32)
+            _to_memory((EMBEDDING_MODEL, text_hash), vector)
+            found[text_hash] = vector
+            del missing[text_hash]
+
+    return found, missing
+
+
+def _store(missing, vectors):
+    """
+    Store freshly computed vectors in both tiers.
+
+    :returns: The computed vectors, by text hash.
+    """
+    if len(vectors) != len(missing):
+        raise ValueError(
+            f"Expected {len(missing)} embeddings, got {len(vectors)}"
+        )
+    computed = {}
+    to_persist = {}
+    for text_hash, vector in zip(missing, vectors):
+        vector = np.asarray(vector, dtype=np.float32)
+        computed[text_hash] = vector
+        if vector.any():  # Don't cache mocked (all-zero) embeddings
+            _to_memory((EMBEDDING_MODEL, text_hash), vector)
+            to_persist[text_hash] = vector.tobytes()
+    if to_persist:
+        persist_embeddings(EMBEDDING_MODEL, to_persist)
+    return computed
+
+
+def _assemble(texts, found):
+    return [found[_text_hash(text)].tolist() for text in texts]
+
+
+def _coalesced(texts_by_hash, call):
+    """
+    Make an embedding call, coalesced with identical ones in flight
+    (the same texts, in the same order) if request coalescing is enabled.
+    """
+    if not COALESCING_ENABLED:
+        return call()
+    return get_single_flight("embedding").run(
+        (EMBEDDING_MODEL, tuple(texts_by_hash)), call
+    )
+
+
+async def _coalesced_async(texts_by_hash, call):
+    """Async variant of :func:`_coalesced`."""
+    if not COALESCING_ENABLED:
+        return await call()
+    return await get_single_flight("embedding").run_async(
+        (EMBEDDING_MODEL, tuple(texts_by_hash)), call
+    )
+
+
+def _embed_missing(missing):
+    with span("embedding"):
+        vectors = get_uncached_embedding_vector(list(missing.values()))
+    return _store(missing, vectors)
+
+
+async def _embed_missing_async(missing):
+    with span("embedding"):
+        vectors = await get_uncached_embedding_vector_async(
+            list(missing.values())
+        )
+    return await asyncio.to_thread(_store, missing, vectors)
+
+
+def get_embedding_vector(texts: List[str]) -> List[List[float]]:
+    """
+    Get embedding vectors for the texts, going through the embedding cache.
+
+    Only cache misses are sent to OpenAI, in a single batched request.
+    Identical requests already in flight (e.g. for a prompt many users
+    just sent) are waited for instead of being sent again.
+
+    :param texts: The texts to embed.
+    :type texts: List[str]
+    :returns: The embedding vectors as lists, in the order of ``texts``.
+    :rtype: list
+    """
+    if not EMBEDDING_CACHE_ENABLED:
+        def embed():
+            with span("embedding"):
+                return get_uncached_embedding_vector(texts)
+        return _coalesced(map(_text_hash, texts), embed)
+
+    with span("embedding_cache_lookup"):
+        found, missing = _lookup(texts)
+    if missing:
+        found.update(_coalesced(missing, lambda: _embed_missing(missing)))
+    return _assemble(texts, found)
+
+
+async def get_embedding_vector_async(texts: List[str]) -> List[List[float]]:
+    """
+    Async variant of :func:`get_embedding_vector`.
+
+    :param texts: The texts to embed.
+    :type texts: List[str]
+    :returns: The embedding vectors as lists, in the order of ``texts``.
+    :rtype: list
+    """
+    if not EMBEDDING_CACHE_ENABLED:
+        async def embed():
+            with span("embedding"):
+                return await get_uncached_embedding_vector_async(texts)
+        return await _coalesced_async(map(_text_hash, texts), embed)
+
+    with span("embedding_cache_lookup"):
+        found, missing = await asyncio.to_thread(_lookup, texts)
+    if missing:
+        found.update(await _coalesced_async(
+            missing, lambda: _embed_missing_async(missing)
+        ))
+    return _assemble(texts, found)
@@ -0,0 +1,24 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from book_api.rag_config import LOCK_DIR
+
+
+@contextmanager
+def file_lock(name):
+    """
+    Hold an exclusive lock shared by every process on this machine (e.g.
+    every gunicorn worker), so only one of them does something at a time.
+
+    The lock is released if the holder dies, so it can't be left behind.
+
+    :param name: What the lock is for (e.g. "startup").
+    :type name: str
+    """
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, f"{name}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
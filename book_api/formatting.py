@@ -0,0 +1,46 @@
+# Local (deterministic) rendering of recommended books,
+# as an alternative to having the LLM format them.
+RESPONSE_MODES = ("llm", "markdown", "json")
+
+BOOK_MARKDOWN_TEMPLATE = "### {title}\n*by {author}*\n\n{summary}"
+RECOMMENDATIONS_MARKDOWN_HEADER = "Here are some books you might enjoy:"
+NO_RECOMMENDATIONS_MARKDOWN = (
+    "Sorry, I couldn't find any matching books in the library."
+)
+
+
+def unique_books(books):
+    """De-duplicate books (by title and author), keeping the first seen."""
+    seen = set()
+    unique = []
+    for book in books:
+        key = (book["title"], book["author"])
+        if key not in seen:
+            seen.add(key)
+            unique.append(book)
+    return unique
+
+
+def format_books_markdown(books):
+    """
+    Render recommended books as markdown, without calling the LLM.
+
+    :param books: The recommended books, as dicts with title, author
+        and summary.
+    :type books: list[dict]
+    :returns: The rendered markdown.
+    :rtype: str
+    """
+    books = unique_books(books)
+    if not books:
+        return NO_RECOMMENDATIONS_MARKDOWN
+    return "\n\n".join(
+        [RECOMMENDATIONS_MARKDOWN_HEADER] + [
+            BOOK_MARKDOWN_TEMPLATE.format(
+                title=book["title"],
+                author=book["author"],
+                summary=book["summary"],
+            )
+            for book in books
+        ]
+    )
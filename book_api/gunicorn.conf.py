@@ -0,0 +1,21 @@
+# Gunicorn settings, for serving the API from several worker processes:
+# gunicorn -c book_api/gunicorn.conf.py book_api.main:app
+#
+# The app is imported once, before the workers are forked (preload), so
+# they share its code. At startup, one worker at a time syncs the library
+# (see sync_library in main), so it's only synced and indexed once; the
+# indexes are memory-mapped files, which all workers map zero-copy.
+# Nothing may connect to anything at import time, since the connections
+# would be shared by every worker after the fork.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# One per core by default (each worker is a single-threaded event loop)
+workers = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = True
+# Workers silent for this long are restarted (the library sync runs in
+# the background, so it doesn't hold them up)
+timeout = int(os.getenv("GUNICORN_TIMEOUT_SECONDS", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT_SECONDS", "30"))
+keepalive = 5
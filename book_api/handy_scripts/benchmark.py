@@ -0,0 +1,488 @@
+# Offline benchmarks for book_api, so we can measure throughput and latency
+# without spending money: OpenAI is replaced by a local fake (see
+# fake_openai.py), and ChromaDB by a local server.
+# (Run via `python -m book_api.handy_scripts.benchmark requests` or
+# `python -m book_api.handy_scripts.benchmark ingest`, see --help)
+#
+# Each scenario runs in a fresh process with its own SQLite database,
+# ChromaDB collection and vector index, so runs don't skew each other.
+# By default, a throwaway ChromaDB server is started for the benchmark;
+# pass --chroma-host/--chroma-port to use a running one instead.
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from book_api.handy_scripts.fake_openai import FakeOpenAI, FakeOpenAIServer
+
+THEMES = (
+    "adventure", "betrayal", "coming-of-age", "dystopia", "family",
+    "friendship", "grief", "heist", "identity", "justice", "love", "magic",
+    "memory", "mystery", "mythology", "obsession", "power", "redemption",
+    "revenge", "science", "space", "survival", "time", "war", "wilderness",
+    "witchcraft",
+)
+WORDS = (
+    "ancient", "city", "secret", "journey", "kingdom", "river", "storm",
+    "letter", "island", "machine", "garden", "empire", "winter", "detective",
+    "orphan", "ship", "village", "war", "library", "forest", "night",
+    "crown", "mirror", "desert", "voyage", "crime", "sister", "brother",
+    "lighthouse", "plague", "rebellion", "theatre", "artist", "scholar",
+)
+PROMPT_TEMPLATES = (
+    "I'd like a book about {} and {}",
+    "Recommend something with {}, {} and {}",
+    "Looking for a novel on {}",
+    "Any books that explore {} and {}?",
+)
+CHROMA_STARTUP_TIMEOUT_SECONDS = 60
+
+
+# Synthetic data
+
+def write_synthetic_library(path, n_books, seed=0):
+    """
+    Write a summaries.txt style library of made-up books.
+
+    :param path: Where to write the library.
+    :type path: str
+    :param n_books: The number of books to write.
+    :type n_books: int
+    :param seed: Seed for the random contents.
+    :type seed: int, optional
+    """
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as library_file:
+        for index in range(n_books):
+            title = " ".join(rng.sample(WORDS, 2)).title()
+            themes = rng.sample(THEMES, 3)
+            lines = [
+                " ".join(rng.choices(WORDS + THEMES, k=18)).capitalize() + "."
+                for _ in range(2)
+            ]
+            library_file.write(
+                f"## Title: The {title} ({index})\n"
+                f"# Author: Author {index % 997}\n"
+                f"A story of {', '.join(themes)}.\n"
+                + "\n".join(lines)
+                + "\n\n"
+            )
+
+
+def make_prompts(n_prompts, seed=0):
+    """Make varied user prompts, from the synthetic themes."""
+    rng = random.Random(seed)
+    prompts = []
+    for _ in range(n_prompts):
+        template = rng.choice(PROMPT_TEMPLATES)
+        prompts.append(
+            template.format(*rng.sample(THEMES, template.count("{}")))
+        )
+    return prompts
+
+
+# Measurements
+
+def memory_usage_mb():
+    """Get the current and peak resident memory of this process, in MB."""
+    current = None
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        current = pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        pass  # Not on Linux
+    # (ru_maxrss is in KB on Linux, but in bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+    return {"rss_mb": current, "peak_rss_mb": max(peak, current or 0)}
+
+
+def percentiles_ms(durations):
+    durations = sorted(durations)
+    if not durations:
+        return {}
+    return {
+        f"p{percentile}": round(1000 * durations[
+            min(len(durations) - 1, len(durations) * percentile // 100)
+        ], 2)
+        for percentile in (50, 95, 99)
+    }
+
+
+# Scenarios (each run in a fresh process, see run_scenario)
+
+def requests_scenario(env, options):
+    """Drive /book-recommendation, reporting throughput and latencies."""
+    os.environ.update(env)
+    return asyncio.run(_drive_requests(options))
+
+
+async def _drive_requests(options):
+    import httpx
+    from book_api.main import app
+    from book_api.response_queue import get_response_writer
+    from book_api.semantic_cache import get_semantic_cache
+    from book_api.tracing import get_latency_stats, reset_latency_stats
+
+    path = "/book-recommendation"
+    if options["stream"]:
+        path += "/stream"
+    prompts = make_prompts(
+        options["warmup"] + options["requests"], options["seed"]
+    )
+    concurrency = asyncio.Semaphore(options["concurrency"])
+    latencies = []
+    errors = 0
+
+    async def send(client, prompt, measure):
+        nonlocal errors
+        body = {"prompt": prompt}
+        if options["response_mode"]:
+            body["response_mode"] = options["response_mode"]
+        # (The ASGI transport buffers whole responses, so streamed ones
+        # are timed until their last event)
+        async with concurrency:
+            started_at = perf_counter()
+            response = await client.post(path, json=body)
+            finished_at = perf_counter()
+        if not measure:
+            return
+        if response.status_code != 200:
+            errors += 1
+            return
+        latencies.append(finished_at - started_at)
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark", timeout=None
+        ) as client:
+            # The library is synced in the background after startup
+            while (await client.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.1)
+            await asyncio.gather(*(
+                send(client, prompt, measure=False)
+                for prompt in prompts[:options["warmup"]]
+            ))
+            reset_latency_stats()
+            written_before = get_response_writer().stats()["written"]
+            cache_before = get_semantic_cache().stats()
+            started_at = perf_counter()
+            await asyncio.gather(*(
+                send(client, prompt, measure=True)
+                for prompt in prompts[options["warmup"]:]
+            ))
+            elapsed = perf_counter() - started_at
+            written_during = (
+                get_response_writer().stats()["written"] - written_before
+            )
+            cache_after = get_semantic_cache().stats()
+            memory = memory_usage_mb()
+    # Shutting down flushes the response writer's queue
+    written_total = get_response_writer().stats()["written"] - written_before
+
+    result = {
+        "scenario": "requests",
+        "path": path,
+        "concurrency": options["concurrency"],
+        "requests": options["requests"],
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(options["requests"] / elapsed, 2),
+        "latency_ms": percentiles_ms(latencies),
+        "stages_ms": get_latency_stats(),
+        "semantic_cache_hits": cache_after["hits"] - cache_before["hits"],
+        "memory": memory,
+        "sqlite": {
+            "records_written": written_total,
+            "records_per_second": round(written_during / elapsed, 2),
+        },
+    }
+    return result
+
+
+def ingest_scenario(env, options):
+    """Time a full sync of a synthetic library, then a no-op resync."""
+    os.environ.update(env)
+    write_synthetic_library(
+        env["SUMMARIES_PATH"], options["books"], options["seed"]
+    )
+    from book_api.persistence import setup_database
+    from book_api.chroma_db_setup import setup_chroma_db
+    from book_api.chroma_db_setup import ensure_summaries_up_to_date
+    from book_api.tracing import get_latency_stats
+
+    setup_database()
+    setup_chroma_db()
+    started_at = perf_counter()
+    sync_counts = ensure_summaries_up_to_date()
+    sync_seconds = perf_counter() - started_at
+    started_at = perf_counter()
+    ensure_summaries_up_to_date()
+    resync_seconds = perf_counter() - started_at
+    return {
+        "scenario": "ingest",
+        "books": options["books"],
+        "added": sync_counts["added"],
+        "sync_seconds": round(sync_seconds, 3),
+        "books_per_second": round(options["books"] / sync_seconds, 2),
+        "resync_seconds": round(resync_seconds, 3),
+        "stages_ms": get_latency_stats(),
+        "memory": memory_usage_mb(),
+    }
+
+
+def run_scenario(scenario, env, options):
+    """Run a scenario in a fresh process, so module state starts clean."""
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return executor.submit(scenario, env, options).result()
+
+
+# Environment
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_chroma(data_dir):
+    """
+    Start a throwaway ChromaDB server.
+
+    :returns: A tuple of (the server process, its port).
+    """
+    import httpx
+
+    port = _free_port()
+    process = subprocess.Popen(
+        [shutil.which("chroma") or "chroma", "run",
+         "--path", data_dir, "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + CHROMA_STARTUP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://localhost:{port}/api/v2/heartbeat")
+            return process, port
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("ChromaDB server did not start in time.")
+
+
+def delete_collections(chroma_host, chroma_port, envs):
+    """Delete the collections the scenarios created."""
+    from chromadb import HttpClient
+
+    client = HttpClient(host=chroma_host, port=chroma_port)
+    for env in envs:
+        try:
+            client.delete_collection(env["CHROMA_COLLECTION_NAME"])
+        except Exception:
+            pass  # The scenario failed before creating it
+
+
+def scenario_env(work_dir, openai_base_url, chroma_host, chroma_port, args):
+    """The environment a scenario runs the service with."""
+    env = {
+        "OPENAI_BASE_URL": openai_base_url,
+        "OPENAI_API_KEY": "benchmark",
+        "CHROMA_HOST": chroma_host,
+        "CHROMA_PORT": str(chroma_port),
+        "CHROMA_COLLECTION_NAME": f"benchmark_{uuid.uuid4().hex[:12]}",
+        # Everything the service writes goes in the work dir, so the
+        # real database and indexes are left alone
+        "DB_PATH": os.path.join(work_dir, "persistence.db"),
+        "SUMMARIES_PATH": os.path.join(work_dir, "summaries.txt"),
+        "VECTOR_INDEX_DIR": os.path.join(work_dir, "vector_index"),
+        "LEXICAL_INDEX_DIR": os.path.join(work_dir, "lexical_index"),
+        "NEIGHBOUR_TABLE_DIR": os.path.join(work_dir, "neighbour_table"),
+        "LOCK_DIR": os.path.join(work_dir, "locks"),
+        "TRACE_EXPORT_PATH": "",
+        "LOG_LEVEL": "WARNING",
+    }
+    if getattr(args, "no_semantic_cache", False):
+        env["SEMANTIC_CACHE_ENABLED"] = "false"
+    if getattr(args, "retrieval_backend", None):
+        env["RETRIEVAL_BACKEND"] = args.retrieval_backend
+    return env
+
+
+# Reporting
+
+def print_result(result):
+    memory = result["memory"]
+    if result["scenario"] == "requests":
+        print(
+            f"\n{result['path']} at concurrency {result['concurrency']}:"
+            f" {result['requests']} requests in {result['elapsed_seconds']}s"
+            f" -> {result['requests_per_second']} requests/s"
+            f" ({result['errors']} errors,"
+            f" {result['semantic_cache_hits']} semantic cache hits)"
+        )
+        print(f"  Latency (ms): {result['latency_ms']}")
+        print(
+            f"  SQLite: {result['sqlite']['records_written']} records"
+            f" ({result['sqlite']['records_per_second']} records/s)"
+        )
+    else:
+        print(
+            f"\nIngesting {result['books']} books:"
+            f" {result['sync_seconds']}s"
+            f" ({result['books_per_second']} books/s),"
+            f" no-op resync {result['resync_seconds']}s"
+        )
+    print(
+        f"  Memory: {memory['rss_mb'] or 0:.1f} MB"
+        f" (peak {memory['peak_rss_mb']:.1f} MB)"
+    )
+    print("  Stages (ms):")
+    for stage, stats in result["stages_ms"].items():
+        print(
+            f"    {stage:<24} n={stats['count']:<7}"
+            f" p50={stats.get('p50')} p95={stats.get('p95')}"
+            f" p99={stats.get('p99')}"
+        )
+
+
+def _int_list(text):
+    return [int(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark book_api offline (fake OpenAI, local Chroma)."
+    )
+    parser.add_argument(
+        "--response-latency", default="lognormal:400,0.5",
+        help="Simulated latency of OpenAI responses (e.g. fixed:200,"
+        " uniform:100,500, lognormal:400,0.5; in milliseconds)",
+    )
+    parser.add_argument(
+        "--embedding-latency", default="lognormal:80,0.3",
+        help="Simulated latency of OpenAI embeddings (same format)",
+    )
+    parser.add_argument(
+        "--chroma-host",
+        help="Use this ChromaDB server (defaults to a throwaway one)",
+    )
+    parser.add_argument("--chroma-port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the results as JSON")
+    subparsers = parser.add_subparsers(dest="scenario", required=True)
+
+    requests_parser = subparsers.add_parser(
+        "requests", help="Drive /book-recommendation"
+    )
+    requests_parser.add_argument("--requests", type=int, default=200)
+    requests_parser.add_argument(
+        "--concurrency", type=_int_list, default=[1, 8, 32],
+        help="Comma-separated concurrency levels to run at",
+    )
+    requests_parser.add_argument("--warmup", type=int, default=10)
+    requests_parser.add_argument(
+        "--books", type=int,
+        help="Use a synthetic library of this size"
+        " (defaults to book_api/summaries.txt)",
+    )
+    requests_parser.add_argument(
+        "--response-mode", choices=["llm", "markdown", "json"]
+    )
+    requests_parser.add_argument(
+        "--stream", action="store_true",
+        help="Use /book-recommendation/stream",
+    )
+    requests_parser.add_argument("--no-semantic-cache", action="store_true")
+    requests_parser.add_argument(
+        "--retrieval-backend", choices=["chroma", "numpy"]
+    )
+
+    ingest_parser = subparsers.add_parser(
+        "ingest", help="Benchmark syncing summaries.txt into ChromaDB"
+    )
+    ingest_parser.add_argument(
+        "--books", type=_int_list, default=[1000, 10000, 100000],
+        help="Comma-separated library sizes to ingest",
+    )
+    args = parser.parse_args()
+
+    fake_openai = FakeOpenAIServer(FakeOpenAI(
+        args.response_latency, args.embedding_latency, args.seed
+    )).start()
+    chroma_process = None
+    envs = []  # One per library (and so collection)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="book_api_benchmark_") as tmp:
+        try:
+            chroma_host, chroma_port = args.chroma_host, args.chroma_port
+            if chroma_host is None:
+                chroma_process, chroma_port = start_chroma(
+                    os.path.join(tmp, "chroma")
+                )
+                chroma_host = "localhost"
+
+            if args.scenario == "requests":
+                # One library (and database) for all concurrency levels
+                env = scenario_env(
+                    tmp, fake_openai.base_url, chroma_host, chroma_port, args
+                )
+                envs.append(env)
+                if args.books:
+                    write_synthetic_library(
+                        env["SUMMARIES_PATH"], args.books, args.seed
+                    )
+                else:
+                    shutil.copy(
+                        "book_api/summaries.txt", env["SUMMARIES_PATH"]
+                    )
+                for index, concurrency in enumerate(args.concurrency):
+                    results.append(run_scenario(requests_scenario, env, {
+                        "requests": args.requests,
+                        "concurrency": concurrency,
+                        "warmup": args.warmup,
+                        "response_mode": args.response_mode,
+                        "stream": args.stream,
+                        # Fresh prompts, so earlier runs don't warm caches
+                        "seed": args.seed + index,
+                    }))
+                    print_result(results[-1])
+            else:
+                for books in args.books:
+                    work_dir = tempfile.mkdtemp(dir=tmp)
+                    env = scenario_env(
+                        work_dir, fake_openai.base_url,
+                        chroma_host, chroma_port, args
+                    )
+                    envs.append(env)
+                    results.append(run_scenario(ingest_scenario, env, {
+                        "books": books,
+                        "seed": args.seed,
+                    }))
+                    print_result(results[-1])
+        finally:
+            if chroma_process is not None:
+                chroma_process.terminate()
+                chroma_process.wait()
+            elif envs:
+                delete_collections(chroma_host, chroma_port, envs)
+            fake_openai.stop()
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
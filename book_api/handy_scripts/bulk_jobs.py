@@ -0,0 +1,95 @@
+# Submit and check on bulk recommendation jobs (see book_api/bulk_jobs.py)
+# from the command line, without the API running.
+# (Run via `python -m book_api.handy_scripts.bulk_jobs submit prompts.txt`,
+# with one prompt per line; see --help for the other commands)
+#
+# To try it out for free, point OPENAI_BASE_URL at the fake OpenAI API
+# (`python -m book_api.handy_scripts.fake_openai`), which has a Batch API.
+import argparse
+import asyncio
+import json
+from book_api.persistence import setup_database, close_db_connections
+from book_api.response_queue import get_response_writer
+from book_api.chroma_db_setup import setup_chroma_db, setup_async_chroma_db
+from book_api.retrieval_backends import refresh_retrieval_backend
+from book_api.lexical_index import refresh_lexical_index
+from book_api.bulk_jobs import (
+    ACTIVE_STATUSES,
+    submit_bulk_job,
+    advance_bulk_job,
+    get_bulk_job_results,
+)
+
+
+async def run(args):
+    # Retrieval runs locally, so it needs the same setup as the API
+    # (The library itself is kept up to date by the API)
+    setup_chroma_db()
+    refresh_retrieval_backend()
+    refresh_lexical_index()
+    await setup_async_chroma_db()
+
+    if args.command == "submit":
+        with open(args.prompts_file, encoding="utf-8") as prompts_file:
+            prompts = [line.strip() for line in prompts_file if line.strip()]
+        status = await submit_bulk_job(prompts, args.response_mode)
+    else:
+        status = await advance_bulk_job(args.job_id)
+        if status is None:
+            raise SystemExit(f"No bulk job {args.job_id}")
+    while args.wait and status["status"] in ACTIVE_STATUSES:
+        await asyncio.sleep(args.poll_seconds)
+        status = await advance_bulk_job(status["id"])
+    print(json.dumps(status, indent=2))
+
+    if args.command == "results" or (args.wait and args.output):
+        results = get_bulk_job_results(status["id"])
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as output_file:
+                for result in results:
+                    output_file.write(json.dumps(result) + "\n")
+            print(f"Wrote {len(results)} results to {args.output}")
+        else:
+            for result in results:
+                print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Submit and check on bulk recommendation jobs."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    submit_parser = subparsers.add_parser("submit", help="Submit a job")
+    submit_parser.add_argument(
+        "prompts_file", help="A text file with one prompt per line"
+    )
+    submit_parser.add_argument(
+        "--response-mode", choices=["llm", "markdown", "json"]
+    )
+    status_parser = subparsers.add_parser(
+        "status", help="Check on (and move along) a job"
+    )
+    status_parser.add_argument("job_id")
+    results_parser = subparsers.add_parser(
+        "results", help="Get a job's results (as JSON lines)"
+    )
+    results_parser.add_argument("job_id")
+    for subparser in (submit_parser, status_parser, results_parser):
+        subparser.add_argument(
+            "--wait", action="store_true",
+            help="Keep polling until the job is finished",
+        )
+        subparser.add_argument("--poll-seconds", type=float, default=30)
+        subparser.add_argument(
+            "--output", help="Write the results to this file, once finished"
+        )
+    args = parser.parse_args()
+
+    setup_database()
+    # Record usage in the background, like the API does
+    get_response_writer().start()
+    try:
+        asyncio.run(run(args))
+    finally:
+        get_response_writer().stop()
+        close_db_connections()
@@ -2,37 +2,34 @@
 # (You have to run this manually - it's just a temp file of sorts)
 # (Run via `python -m book_api.handy_scripts.api_test`)
 # (Since VS Code / IDEs might launch you too deep in, and imports will fail)
-import re
-from book_api.persistence import get_db_connection
-
-COSTS_PER_1M_TOKENS = {
-    "gpt-4.1-nano": {
-        "regular": {
-            "uncached_input": 0.10,
-            "cached_input": 0.025,
-            "output": 0.40,
-        },
-        "batch": {
-            "uncached_input": 0.05,
-            "output": 0.20,
-        }
-    },
-    "text-embedding-3-small": {
-        "regular": {
-            "uncached_input": 0.02,
-        },
-        "batch": {
-            "uncached_input": 0.01,
-        }
-    }
-}
-CURRENCY = "USD"
-
-
-def compute_costs():
+from argparse import ArgumentParser
+from book_api.persistence import (
+    PERIOD_FORMATS,
+    get_usage_rollups,
+    get_usage_rollups_by_period,
+)
+from book_api.pricing import (
+    COSTS_PER_1M_TOKENS,
+    CURRENCY,
+    cost_for_tokens,
+    get_token_costs,
+    normalize_model_name,
+)
+
+
+def compute_costs(start=None, end=None):
     """
     Computes the total costs for all responses stored in the database.
 
+    Reads the hourly usage rollups rather than every response, so this
+    stays fast however long the history is.
+
+    :param start: Only include usage from this UTC time on
+        (e.g. "2025-01-31"), rounded down to the hour.
+    :type start: str, optional
+    :param end: Only include usage before this UTC time,
+        rounded up to the hour.
+    :type end: str, optional
     :return: A dictionary containing the breakdown of costs for each model.
     :rtype: dict
     """
@@ -69,97 +66,83 @@ def compute_costs():
     # }
     errors = []
 
-    with get_db_connection() as conn:
-        # Group by model and batch type
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT model, batch,
-               SUM(uncached_input_tokens),
-               SUM(cached_input_tokens),
-               SUM(reasoning_output_tokens),
-               SUM(nonreasoning_output_tokens)
-        FROM responses
-        GROUP BY model, batch
-        ''')
-        rows = cursor.fetchall()
-        # If lots of rows, might prefer fetching them in chunks
-        # But for this small app, fetching all at once is fine
-        for row in rows:
-            (model, batch, uncached_input_tokens, cached_input_tokens,
-                reasoning_output_tokens, nonreasoning_output_tokens) = row
-            tier = "batch" if batch else "regular"
-
-            # Model names get persisted with full datestamp
-            # (e.g. "gpt-4.1-nano-2025-04-14")
-            # So we need to strip the datestamp at least
-            datestamp_pattern = r"-\d{4}-\d{2}-\d{2}$"
-            model = re.sub(datestamp_pattern, "", model)
-            # If no datestamp, model will be unchanged
-
-            # Log errors if we don't have costs for this model + batch type
-            if model not in COSTS_PER_1M_TOKENS:
-                # Will print twice if we have batch and regular for same model
-                # Not ideal, but not a big deal
-                errors.append(f"{model}: no costs defined")
-                continue
-            if tier not in COSTS_PER_1M_TOKENS[model]:
-                errors.append(f"{model}: no {tier} costs defined")
-                continue
-
-            # Otherwise, query already summed up most of the data we need
-            # First compute, then store
-            def cost_for_tokens(tokens, cost_per_million):
-                return (tokens / 1_000_000) * cost_per_million
-            pricing = COSTS_PER_1M_TOKENS[model][tier]
-
-            uncached_input_cost = cost_for_tokens(
-                uncached_input_tokens, pricing.get("uncached_input", 0)
-            )
-            cached_input_cost = cost_for_tokens(
-                cached_input_tokens, pricing.get("cached_input", 0)
-            )
-            nonreasoning_output_cost = cost_for_tokens(
-                nonreasoning_output_tokens, pricing.get("output", 0)
-            )
-            reasoning_output_cost = cost_for_tokens(
-                reasoning_output_tokens, pricing.get("output", 0)
-            )
-            total_cost = (
-                uncached_input_cost + cached_input_cost +
-                nonreasoning_output_cost + reasoning_output_cost
-            )
+    # Grouped by model and batch type
+    token_sums = {}  # (model, tier) -> summed token counts
+    for row in get_usage_rollups(start, end):
+        model, batch, _, *token_counts = row
+        tier = "batch" if batch else "regular"
 
-            # Store the costs in the dictionary
-            if model not in costs:
-                costs[model] = {}
-
-            tier_costs = {}
-            if uncached_input_cost:
-                tier_costs["uncached_input"] = uncached_input_cost
-            if cached_input_cost:
-                tier_costs["cached_input"] = cached_input_cost
-            if nonreasoning_output_cost:
-                tier_costs["nonreasoning_output"] = nonreasoning_output_cost
-            if reasoning_output_cost:
-                tier_costs["reasoning_output"] = reasoning_output_cost
-            tier_costs["total"] = total_cost
-            # No need to check for total - if the query returned data,
-            # it means we have at least one cost.
-
-            costs[model][tier] = tier_costs
-
-        # Once dictionary is populated, compute per-model and overall total
-        big_total = 0
-        for model, batch_types in costs.items():
-            model_total = sum(
-                batch_type.get("total", 0)
-                for batch_type in batch_types.values()
-            )
-            # If we have no costs for this model, it will be 0
-            # But we still want to add it to the overall total
-            big_total += model_total
-            batch_types["total"] = model_total
-        costs["total"] = big_total
+        # Strip the datestamp model names get persisted with
+        # (Dated and undated rows for the same model get added up)
+        model = normalize_model_name(model)
+        summed = token_sums.get((model, tier), (0, 0, 0, 0))
+        token_sums[(model, tier)] = tuple(
+            summed_tokens + tokens
+            for summed_tokens, tokens in zip(summed, token_counts)
+        )
+
+    for (model, tier), token_counts in token_sums.items():
+        (uncached_input_tokens, cached_input_tokens,
+            reasoning_output_tokens, nonreasoning_output_tokens) = token_counts
+
+        # Log errors if we don't have costs for this model + batch type
+        if model not in COSTS_PER_1M_TOKENS:
+            # Will print twice if we have batch and regular for same model
+            # Not ideal, but not a big deal
+            errors.append(f"{model}: no costs defined")
+            continue
+        if tier not in COSTS_PER_1M_TOKENS[model]:
+            errors.append(f"{model}: no {tier} costs defined")
+            continue
+
+        # Otherwise, query already summed up most of the data we need
+        # First compute, then store
+        token_costs = get_token_costs(model, tier, {
+            "uncached_input": uncached_input_tokens,
+            "cached_input": cached_input_tokens,
+            "nonreasoning_output": nonreasoning_output_tokens,
+            "reasoning_output": reasoning_output_tokens,
+        })
+        uncached_input_cost = token_costs["uncached_input"]
+        cached_input_cost = token_costs["cached_input"]
+        nonreasoning_output_cost = token_costs["nonreasoning_output"]
+        reasoning_output_cost = token_costs["reasoning_output"]
+        total_cost = (
+            uncached_input_cost + cached_input_cost +
+            nonreasoning_output_cost + reasoning_output_cost
+        )
+
+        # Store the costs in the dictionary
+        if model not in costs:
+            costs[model] = {}
+
+        tier_costs = {}
+        if uncached_input_cost:
+            tier_costs["uncached_input"] = uncached_input_cost
+        if cached_input_cost:
+            tier_costs["cached_input"] = cached_input_cost
+        if nonreasoning_output_cost:
+            tier_costs["nonreasoning_output"] = nonreasoning_output_cost
+        if reasoning_output_cost:
+            tier_costs["reasoning_output"] = reasoning_output_cost
+        tier_costs["total"] = total_cost
+        # No need to check for total - if the query returned data,
+        # it means we have at least one cost.
+
+        costs[model][tier] = tier_costs
+
+    # Once dictionary is populated, compute per-model and overall total
+    big_total = 0
+    for model, batch_types in costs.items():
+        model_total = sum(
+            batch_type.get("total", 0)
+            for batch_type in batch_types.values()
+        )
+        # If we have no costs for this model, it will be 0
+        # But we still want to add it to the overall total
+        big_total += model_total
+        batch_types["total"] = model_total
+    costs["total"] = big_total
 
     # Print errors if any
     if errors:
@@ -170,9 +153,103 @@ def compute_costs():
     return costs
 
 
+def compute_cache_hit_ratios(period="day", start=None, end=None):
+    """
+    Computes the prompt cache hit ratio (the share of input tokens that
+    were cached) per period and model, and what caching saved.
+
+    Only the regular tier is included, since batch requests get no
+    cached input pricing. Models with no input tokens are left out
+    (e.g. a period with no requests to them).
+
+    :param period: "hour", "day", "week" or "month".
+    :type period: str, optional
+    :param start: As for :func:`compute_costs`.
+    :type start: str, optional
+    :param end: As for :func:`compute_costs`.
+    :type end: str, optional
+    :return: Dicts with the "period", "model", "input_tokens",
+        "cached_input_tokens", "hit_ratio" and "saved" (in CURRENCY,
+        or None if the model has no cached input price), oldest first.
+    :rtype: list[dict]
+    """
+    # (period, model) -> [uncached input tokens, cached input tokens]
+    # (Dated and undated rows for the same model get added up)
+    token_sums = {}
+    for row in get_usage_rollups_by_period(period, start, end):
+        period_start, model, batch, _, uncached, cached, *_ = row
+        if batch:
+            continue
+        summed = token_sums.setdefault(
+            (period_start, normalize_model_name(model)), [0, 0]
+        )
+        summed[0] += uncached
+        summed[1] += cached
+
+    ratios = []
+    for (period_start, model), (uncached, cached) in token_sums.items():
+        input_tokens = uncached + cached
+        if not input_tokens:
+            continue
+        prices = COSTS_PER_1M_TOKENS.get(model, {}).get("regular", {})
+        saved = None
+        if "cached_input" in prices:
+            saved = cost_for_tokens(
+                cached, prices["uncached_input"] - prices["cached_input"]
+            )
+        ratios.append({
+            "period": period_start,
+            "model": model,
+            "input_tokens": input_tokens,
+            "cached_input_tokens": cached,
+            "hit_ratio": cached / input_tokens,
+            "saved": saved,
+        })
+    return ratios
+
+
+def print_cache_hit_ratios(ratios, period):
+    print(f"Prompt cache hit ratio (per {period}):")
+    if not ratios:
+        print("  No regular tier usage.")
+        return
+    for ratio in ratios:
+        saved = (
+            f", saved {ratio['saved']:.6f} {CURRENCY}"
+            if ratio["saved"] is not None else ""
+        )
+        print(
+            f"  {ratio['period']}  {ratio['model']}:"
+            f" {ratio['hit_ratio']:.1%} of {ratio['input_tokens']:,}"
+            f" input tokens cached{saved}"
+        )
+    total_saved = sum(ratio["saved"] or 0 for ratio in ratios)
+    print(f"Total saved by caching: {total_saved:.6f} {CURRENCY}")
+
+
 if __name__ == "__main__":
     # If run as a script, compute and print costs
-    costs = compute_costs()
+    parser = ArgumentParser(description="Compute OpenAI API costs.")
+    parser.add_argument(
+        "--since", help="UTC start time, e.g. 2025-01-31 or '2025-01-31 14:00'"
+    )
+    parser.add_argument("--until", help="UTC end time (exclusive)")
+    parser.add_argument(
+        "--cache-report", action="store_true",
+        help="Report the prompt cache hit ratio over time instead",
+    )
+    parser.add_argument(
+        "--period", choices=list(PERIOD_FORMATS), default="day",
+        help="The period of the cache report (default: day)",
+    )
+    args = parser.parse_args()
+    if args.cache_report:
+        print_cache_hit_ratios(
+            compute_cache_hit_ratios(args.period, args.since, args.until),
+            args.period,
+        )
+        raise SystemExit
+    costs = compute_costs(args.since, args.until)
 
     def non_total_items(dict):
         return (
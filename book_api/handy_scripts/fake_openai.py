@@ -0,0 +1,557 @@
+# A local stand-in for the OpenAI API, for benchmarking without spending
+# money (see benchmark.py). It can also be run on its own, e.g.
+# `python -m book_api.handy_scripts.fake_openai --port 8081`, and used by
+# pointing OPENAI_BASE_URL at it (e.g. http://127.0.0.1:8081/v1).
+#
+# Supports the endpoints book_api uses:
+# - POST /v1/responses (plain, with tools, and streamed)
+# - POST /v1/embeddings (float and base64 encodings)
+# - The Batch API: POST /v1/files, GET /v1/files/{id}/content,
+#   POST /v1/batches and GET /v1/batches/{id} (batches complete after a
+#   configurable delay, once polled)
+# Responses are deterministic (same request, same response) and come with
+# realistic usage objects, after a configurable simulated latency.
+import argparse
+import base64
+import email.parser
+import email.policy
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from book_api.tokens import count_tokens, EMBEDDING_ENCODING
+
+DEFAULT_EMBEDDING_DIMENSIONS = 1536
+# OpenAI caches prompt prefixes of at least 1024 tokens, in 128 token steps
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_INCREMENT = 128
+STREAM_CHUNK_WORDS = 4  # Words per streamed text delta
+STOPWORDS = frozenset(
+    "a an and are about any as at be book books by for from give i i'd in"
+    " is it like looking me my of on or please recommend some something"
+    " that the to want with".split()
+)
+
+
+class LatencyDistribution:
+    """
+    A distribution of simulated latencies.
+
+    Specified as "fixed:MS", "uniform:MIN_MS,MAX_MS" or
+    "lognormal:MEDIAN_MS,SIGMA" (a bare number means "fixed").
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        if not params:
+            kind, params = "fixed", kind
+        try:
+            values = [float(value) for value in params.split(",")]
+        except ValueError:
+            raise ValueError(f"Invalid latency distribution: {spec}")
+        if kind == "fixed" and len(values) == 1:
+            self._sample = lambda rng: values[0] / 1000
+        elif kind == "uniform" and len(values) == 2:
+            self._sample = lambda rng: rng.uniform(*values) / 1000
+        elif kind == "lognormal" and len(values) == 2:
+            median, sigma = values
+            self._sample = (
+                lambda rng: median * rng.lognormvariate(0, sigma) / 1000
+            )
+        else:
+            raise ValueError(f"Invalid latency distribution: {spec}")
+
+    def sample(self, rng):
+        """Sample a latency, in seconds."""
+        return max(0.0, self._sample(rng))
+
+
+class FakeOpenAI:
+    """The fake API's behaviour, independent of the HTTP server."""
+
+    def __init__(
+        self,
+        response_latency="0",
+        embedding_latency="0",
+        seed=0,
+        batch_seconds=0.0
+    ):
+        self.response_latency = LatencyDistribution(response_latency)
+        self.embedding_latency = LatencyDistribution(embedding_latency)
+        self.batch_seconds = batch_seconds  # How long batches take
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._word_vectors = {}  # (word, dimensions) -> unit vector
+        self._seen_prefixes = set()  # For simulating prompt caching
+        self._lock = threading.Lock()
+        self.request_counts = {"responses": 0, "embeddings": 0}
+        self._files = {}  # File ID -> file object and content
+        self._batches = {}  # Batch ID -> batch object
+
+    def sleep(self, distribution):
+        with self._rng_lock:
+            latency = distribution.sample(self._rng)
+        time.sleep(latency)
+
+    # Embeddings
+
+    def _word_vector(self, word, dimensions):
+        key = (word, dimensions)
+        vector = self._word_vectors.get(key)
+        if vector is None:
+            seed = int.from_bytes(sha256(word.encode()).digest()[:8], "big")
+            vector = np.random.default_rng(seed).standard_normal(dimensions)
+            vector = vector.astype(np.float32)
+            self._word_vectors[key] = vector
+        return vector
+
+    def embed(self, text, dimensions):
+        """
+        Embed a text as the normalized sum of per-word random vectors.
+
+        Texts sharing words end up closer together, so retrieval over
+        fake embeddings still behaves (somewhat) like the real thing.
+        """
+        vector = np.zeros(dimensions, dtype=np.float32)
+        for word in _words(text):
+            vector += self._word_vector(word, dimensions)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embeddings(self, body):
+        texts = body["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        dimensions = body.get("dimensions", DEFAULT_EMBEDDING_DIMENSIONS)
+        data = []
+        for index, text in enumerate(texts):
+            vector = self.embed(text, dimensions)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append(
+                {"object": "embedding", "index": index, "embedding": embedding}
+            )
+        prompt_tokens = sum(
+            count_tokens(text, EMBEDDING_ENCODING) for text in texts
+        )
+        return {
+            "object": "list",
+            "data": data,
+            "model": body["model"],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "total_tokens": prompt_tokens,
+            },
+        }
+
+    # Responses
+
+    def _cached_tokens(self, body):
+        """Simulate prompt caching of the instructions and tools prefix."""
+        prefix = json.dumps(
+            [body.get("instructions"), body.get("tools")], sort_keys=True
+        )
+        prefix_tokens = count_tokens(prefix)
+        with self._lock:
+            seen = prefix in self._seen_prefixes
+            self._seen_prefixes.add(prefix)
+        if not seen or prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+            return 0
+        return prefix_tokens // PROMPT_CACHE_INCREMENT * PROMPT_CACHE_INCREMENT
+
+    def _output(self, body):
+        input_items = body["input"]
+        if isinstance(input_items, str):
+            input_items = [input_items]
+        prompt = next(
+            (item for item in input_items if isinstance(item, str)), ""
+        )
+        item_id = "_" + sha256(
+            json.dumps(body, sort_keys=True).encode()
+        ).hexdigest()[:24]
+
+        if body.get("tools"):
+            themes = [
+                word for word in _words(prompt) if word not in STOPWORDS
+            ][:3] or ["fiction"]
+            return [{
+                "type": "function_call",
+                "id": "fc" + item_id,
+                "call_id": "call" + item_id,
+                "name": body["tools"][0]["name"],
+                "arguments": json.dumps({"themes": themes}),
+                "status": "completed",
+            }]
+
+        # Format any books passed back to us, like the real model would
+        books = []
+        for item in input_items:
+            if isinstance(item, dict):
+                output = item.get("output") or item.get("content")
+                try:
+                    books.extend(json.loads(output)["recommended_books"])
+                except (TypeError, ValueError, KeyError):
+                    pass
+        lines = ["Here are some books you might enjoy:", ""]
+        for book in books:
+            lines.append(f"**{book['title']}** by {book['author']}")
+            lines.append(book.get("summary", ""))
+            lines.append("")
+        text = "\n".join(lines).strip()
+        max_output_tokens = body.get("max_output_tokens")
+        if max_output_tokens:
+            # Roughly 4 characters a token
+            text = text[:max_output_tokens * 4]
+        return [{
+            "type": "message",
+            "id": "msg" + item_id,
+            "role": "assistant",
+            "status": "completed",
+            "content": [
+                {"type": "output_text", "text": text, "annotations": []}
+            ],
+        }]
+
+    def response(self, body):
+        output = self._output(body)
+        input_tokens = count_tokens(json.dumps(
+            [body.get("instructions"), body.get("tools"), body["input"]]
+        ))
+        output_tokens = sum(
+            count_tokens(item["arguments"]) if item["type"] == "function_call"
+            else count_tokens(item["content"][0]["text"])
+            for item in output
+        )
+        return {
+            "id": "resp_" + uuid.uuid4().hex,
+            "object": "response",
+            "created_at": int(time.time()),
+            "status": "completed",
+            "model": _dated_model_name(body["model"]),
+            "instructions": body.get("instructions"),
+            "max_output_tokens": body.get("max_output_tokens"),
+            "output": output,
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": body.get("tools", []),
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {
+                    "cached_tokens": self._cached_tokens(body)
+                },
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+    def response_events(self, body):
+        """The server-sent events of a streamed response."""
+        response = self.response(body)
+        yield "response.created", {
+            "response": {**response, "status": "in_progress", "output": []}
+        }
+        for item in response["output"]:
+            if item["type"] != "message":
+                continue
+            words = re.split(r"(?<=\s)", item["content"][0]["text"])
+            for start in range(0, len(words), STREAM_CHUNK_WORDS):
+                yield "response.output_text.delta", {
+                    "item_id": item["id"],
+                    "output_index": 0,
+                    "content_index": 0,
+                    "delta": "".join(
+                        words[start:start + STREAM_CHUNK_WORDS]
+                    ),
+                }
+        yield "response.completed", {"response": response}
+
+    # Batch API
+
+    def upload_file(self, filename, content, purpose):
+        file_object = {
+            "id": "file-" + uuid.uuid4().hex,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self._lock:
+            self._files[file_object["id"]] = (file_object, content)
+        return file_object
+
+    def file_content(self, file_id):
+        with self._lock:
+            _, content = self._files.get(file_id, (None, None))
+        return content
+
+    def create_batch(self, body):
+        batch = {
+            "id": "batch_" + uuid.uuid4().hex,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "validating",
+            "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self._lock:
+            self._batches[batch["id"]] = batch
+        return batch
+
+    def get_batch(self, batch_id):
+        """Get a batch, running it if it's due (simulating the wait)."""
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is None or batch["status"] == "completed":
+            return batch
+        if time.time() - batch["created_at"] < self.batch_seconds:
+            batch["status"] = "in_progress"
+            return batch
+
+        lines = []
+        counts = {"total": 0, "completed": 0, "failed": 0}
+        content = self.file_content(batch["input_file_id"]) or b""
+        for line in content.decode().splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            counts["total"] += 1
+            if request["url"] == "/v1/responses":
+                body = self.response(request["body"])
+            elif request["url"] == "/v1/embeddings":
+                body = self.embeddings(request["body"])
+            else:
+                counts["failed"] += 1
+                lines.append({
+                    "id": "batch_req_" + uuid.uuid4().hex,
+                    "custom_id": request["custom_id"],
+                    "response": None,
+                    "error": {
+                        "code": "invalid_url",
+                        "message": f"Unsupported URL: {request['url']}",
+                    },
+                })
+                continue
+            counts["completed"] += 1
+            lines.append({
+                "id": "batch_req_" + uuid.uuid4().hex,
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": body,
+                },
+                "error": None,
+            })
+        output_file = self.upload_file(
+            "batch_output.jsonl",
+            "".join(json.dumps(line) + "\n" for line in lines).encode(),
+            "batch_output",
+        )
+        batch.update({
+            "status": "completed",
+            "output_file_id": output_file["id"],
+            "completed_at": int(time.time()),
+            "request_counts": counts,
+        })
+        return batch
+
+
+def _words(text):
+    return re.findall(r"[a-z']+", text.lower())
+
+
+def _dated_model_name(model):
+    # Like the real API, which reports e.g. "gpt-4.1-nano-2025-04-14"
+    if re.search(r"-\d{4}-\d{2}-\d{2}$", model):
+        return model
+    return f"{model}-2025-04-14"
+
+
+def make_handler(fake):
+    """Make an HTTP request handler class serving a :class:`FakeOpenAI`."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+        # Otherwise small writes wait on delayed ACKs (~40ms each)
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass  # Far too chatty for benchmarking
+
+        def _send_json(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_events(self, events):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for sequence_number, (event, data) in enumerate(events):
+                data = {
+                    "type": event, "sequence_number": sequence_number, **data
+                }
+                chunk = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                chunk = chunk.encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _send_not_found(self):
+            self._send_json(404, {"error": {
+                "message": f"Unknown endpoint or ID: {self.path}",
+                "type": "invalid_request_error",
+            }})
+
+        def _read_multipart(self, data):
+            """Parse a multipart/form-data upload into a dict of parts."""
+            message = email.parser.BytesParser(
+                policy=email.policy.HTTP
+            ).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n"
+                .encode() + data
+            )
+            return {
+                part.get_param("name", header="content-disposition"): part
+                for part in message.iter_parts()
+            }
+
+        def do_GET(self):
+            parts = self.path.rstrip("/").split("/")
+            if parts[-2:-1] == ["batches"]:
+                batch = fake.get_batch(parts[-1])
+                if batch is not None:
+                    return self._send_json(200, batch)
+            elif parts[-3:-2] == ["files"] and parts[-1] == "content":
+                content = fake.file_content(parts[-2])
+                if content is not None:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/jsonl")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                    return
+            self._send_not_found()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length)
+            path = self.path.rstrip("/")
+            if path.endswith("/files"):
+                form = self._read_multipart(data)
+                file_part = form["file"]
+                return self._send_json(200, fake.upload_file(
+                    file_part.get_filename() or "upload.jsonl",
+                    file_part.get_payload(decode=True),
+                    form["purpose"].get_content().strip(),
+                ))
+            body = json.loads(data or b"{}")
+            if path.endswith("/batches"):
+                self._send_json(200, fake.create_batch(body))
+            elif path.endswith("/embeddings"):
+                fake.request_counts["embeddings"] += 1
+                fake.sleep(fake.embedding_latency)
+                self._send_json(200, fake.embeddings(body))
+            elif path.endswith("/responses"):
+                fake.request_counts["responses"] += 1
+                fake.sleep(fake.response_latency)
+                if body.get("stream"):
+                    self._send_events(fake.response_events(body))
+                else:
+                    self._send_json(200, fake.response(body))
+            else:
+                self._send_not_found()
+
+    return Handler
+
+
+class FakeOpenAIServer:
+    """
+    Serve a :class:`FakeOpenAI` over HTTP, from a background thread.
+
+    :param fake: The fake API to serve.
+    :type fake: FakeOpenAI
+    :param host: The host to bind to.
+    :type host: str, optional
+    :param port: The port to bind to. (Defaults to any free port.)
+    :type port: int, optional
+    """
+
+    def __init__(self, fake, host="127.0.0.1", port=0):
+        self.fake = fake
+        self._server = ThreadingHTTPServer((host, port), make_handler(fake))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """The URL to set as OPENAI_BASE_URL."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            name="fake-openai",
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve a fake OpenAI API locally."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--response-latency", default="lognormal:400,0.5",
+        help="Latency of /v1/responses calls (e.g. fixed:200,"
+        " uniform:100,500, lognormal:400,0.5; in milliseconds)",
+    )
+    parser.add_argument(
+        "--embedding-latency", default="lognormal:80,0.3",
+        help="Latency of /v1/embeddings calls (same format)",
+    )
+    parser.add_argument(
+        "--batch-seconds", type=float, default=5.0,
+        help="How long batches take to complete",
+    )
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        FakeOpenAI(
+            args.response_latency,
+            args.embedding_latency,
+            batch_seconds=args.batch_seconds,
+        ),
+        host=args.host,
+        port=args.port,
+    )
+    print(f"Fake OpenAI API at {server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -2,12 +2,30 @@
 # (You have to run this manually - it's just a temp file of sorts)
 # (Run via `python -m book_api.handy_scripts.update`)
 # (Since VS Code / IDEs might launch you too deep in, and imports will fail)
-from book_api.persistence import get_db_connection
+from book_api.persistence import get_db_connection, setup_database
+# (Shares the API's connection settings: WAL mode, busy timeout, etc.,
+# so it's safe to run against a live database)
 
-# Update `responses` table to add a boolean `batch` column, default False
+# Move the bulky text columns of `responses` into `response_texts`,
+# so that usage scans stay narrow
+# (setup_database creates response_texts, and backfills usage_rollups)
+setup_database()
 with get_db_connection() as conn:
     cursor = conn.cursor()
 
-    pass  # Replace with your SQL as needed
+    cursor.execute("PRAGMA table_info(responses)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if "instructions" in columns:
+        cursor.execute('''
+        INSERT OR IGNORE INTO response_texts (
+            response_id, instructions, input, output
+        )
+        SELECT id, instructions, input, output FROM responses
+        ''')
+        for column in ("instructions", "input", "output"):
+            cursor.execute(f"ALTER TABLE responses DROP COLUMN {column}")
 
     conn.commit()
+
+# Reclaim the space the text columns took up
+get_db_connection().execute("VACUUM")
@@ -0,0 +1,154 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from time import monotonic
+from book_api.chroma_db_config import (
+    INGEST_BATCH_MAX_ITEMS,
+    INGEST_BATCH_MAX_TOKENS,
+    INGEST_CONCURRENCY,
+    INGEST_PROGRESS_EVERY_SECONDS,
+)
+from book_api.embedding_cache import get_embedding_vector
+from book_api.tokens import count_tokens, EMBEDDING_ENCODING
+
+logger = logging.getLogger(__name__)
+
+
+def batch_by_tokens(
+    entries,
+    *,
+    max_items=INGEST_BATCH_MAX_ITEMS,
+    max_tokens=INGEST_BATCH_MAX_TOKENS
+):
+    """
+    Group library entries into batches sized for one embedding request.
+
+    :param entries: The entries to batch, as dicts with (at least)
+        a "summary" key, which is what gets embedded.
+    :type entries: Iterable[dict]
+    :param max_items: The maximum number of entries per batch.
+    :type max_items: int, optional
+    :param max_tokens: The maximum number of summary tokens per batch.
+    :type max_tokens: int, optional
+    :returns: A generator of lists of entries.
+    :rtype: Iterator[list[dict]]
+    """
+    batch = []
+    batch_tokens = 0
+    for entry in entries:
+        tokens = count_tokens(entry["summary"], EMBEDDING_ENCODING)
+        if batch and (
+            len(batch) >= max_items or batch_tokens + tokens > max_tokens
+        ):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(entry)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def _embed_batch(batch):
+    return batch, get_embedding_vector([entry["summary"] for entry in batch])
+
+
+def ingest_entries(
+    collection,
+    entries,
+    on_batch_written,
+    *,
+    concurrency=INGEST_CONCURRENCY
+):
+    """
+    Embed library entries and upsert them into ChromaDB, streaming.
+
+    Entries are batched by token count, up to ``concurrency`` embedding
+    requests run at once, and each batch is written to ChromaDB as soon as
+    its embeddings arrive. At most ``2 * concurrency`` batches are held in
+    memory at any time (further entries aren't read until a slot frees up),
+    so memory use doesn't grow with the size of the library.
+
+    :param collection: The ChromaDB collection to write to.
+    :type collection: chromadb.Collection
+    :param entries: The entries to ingest, as dicts with "id", "title",
+        "author", "summary" and "content_hash" keys.
+    :type entries: Iterable[dict]
+    :param on_batch_written: Called with each batch once it's written
+        (leaving out entries with mocked embeddings), e.g. to record
+        progress so that a crashed ingest can resume.
+    :type on_batch_written: callable
+    :param concurrency: The number of concurrent embedding requests.
+    :type concurrency: int, optional
+    :returns: The number of entries ingested.
+    :rtype: int
+    """
+    started_at = monotonic()
+    last_report_at = started_at
+    ingested_count = 0
+
+    def write(batch, embeddings):
+        # Mocked (all-zero) embeddings are upserted, so the books are
+        # still there, but without a content hash and left out of what's
+        # reported as written, so they're embedded again on the next sync
+        embedded = [any(embedding) for embedding in embeddings]
+        collection.upsert(
+            ids=[entry["id"] for entry in batch],
+            embeddings=embeddings,
+            metadatas=[
+                {
+                    "title": entry["title"],
+                    "author": entry["author"],
+                    "content_hash": (
+                        entry["content_hash"] if is_embedded else ""
+                    ),
+                }
+                for entry, is_embedded in zip(batch, embedded)
+            ],
+            documents=[entry["summary"] for entry in batch],
+        )
+        if not all(embedded):
+            logger.warning(
+                "%d entries got mocked embeddings, they'll be embedded"
+                " again on the next sync.",
+                embedded.count(False),
+            )
+        on_batch_written([
+            entry for entry, is_embedded in zip(batch, embedded)
+            if is_embedded
+        ])
+
+    def report(final=False):
+        elapsed = monotonic() - started_at
+        rate = ingested_count / elapsed if elapsed > 0 else 0.0
+        logger.info(
+            "%s %d entries in %.1fs (%.1f entries/s)",
+            "Ingested" if final else "Ingesting...",
+            ingested_count, elapsed, rate,
+        )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = set()
+        batches = batch_by_tokens(entries)
+        while True:
+            # Backpressure: only read more entries when there's room
+            while len(in_flight) < 2 * concurrency:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                in_flight.add(executor.submit(_embed_batch, batch))
+            if not in_flight:
+                break
+
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch, embeddings = future.result()
+                write(batch, embeddings)
+                ingested_count += len(batch)
+
+            if monotonic() - last_report_at >= INGEST_PROGRESS_EVERY_SECONDS:
+                last_report_at = monotonic()
+                report()
+
+    if ingested_count:
+        report(final=True)
+    return ingested_count
@@ -0,0 +1,338 @@
+import json
+import os
+import re
+import unicodedata
+from array import array
+import numpy as np
+from book_api.chroma_db_setup import (
+    get_summaries_fingerprint,
+    iter_summaries_txt,
+)
+from book_api.file_lock import file_lock
+from book_api.rag_config import LEXICAL_INDEX_DIR
+from book_api.theme_extraction import STOPWORDS
+from book_api.vector_index import (
+    BookRecords,
+    new_version_dir,
+    read_index_manifest,
+    swap_in_version,
+    write_book_records,
+)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+APOSTROPHE_PATTERN = re.compile(r"['\u2019]")  # Straight or curly
+# BM25 parameters (the usual defaults)
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Title and author words count this many times over summary words
+FIELD_WEIGHTS = {"title": 3.0, "author": 3.0, "summary": 1.0}
+# Longest title or author name (in tokens) looked for in a prompt
+MAX_PHRASE_TOKENS = 16
+POSTING_ARRAYS = ("posting_offsets", "posting_rows", "posting_weights")
+PHRASES_FILE_NAME = "phrases.json"  # Term IDs, and phrases -> book rows
+# One-word titles and names ("Dracula", "Homer") are ordinary words too,
+# so they only match a whole prompt, or right after one of these words
+SINGLE_TOKEN_CUES = frozenset({"like", "by"})
+
+
+def tokenize(text):
+    """
+    Split text into lowercase ASCII word tokens, dropping accents
+    (so "Brontë" matches "Bronte") and apostrophes.
+    """
+    text = APOSTROPHE_PATTERN.sub("", text)
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = text.encode("ascii", "ignore").decode("ascii")
+    return TOKEN_PATTERN.findall(text)
+
+
+def _term(token):
+    """
+    Fold plurals for BM25 ("whales" matches "whale"). Crude, but applied
+    the same way to books and queries.
+    """
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def _is_distinctive(tokens):
+    """Whether a phrase is worth an exact match (not just stopwords)."""
+    return any(token not in STOPWORDS for token in tokens)
+
+
+class LexicalIndex:
+    """
+    An in-memory BM25 inverted index of the library's titles, authors
+    and summaries.
+
+    Postings are stored as compact arrays (CSR style: per term, a slice
+    of book rows and their precomputed BM25 weights), so a query is a
+    few vectorized additions, and the index stays small at 100k+ books.
+    Titles and author names are also indexed as whole phrases, for exact
+    matches. Saved indexes are memory-mapped (see :meth:`load`), so
+    worker processes share one copy of the postings and book records.
+    """
+
+    def __init__(self, entries=()):
+        """
+        :param entries: The library's (title, author, summary) entries.
+        :type entries: Iterable[tuple[str, str, str]]
+        """
+        self.books = []
+        self._term_ids = {}
+        self._titles = {}  # Title phrase -> book rows
+        self._authors = {}  # Author name phrase -> book rows
+        self._surnames = {}  # Author surname -> book rows
+        posting_terms = array("i")
+        posting_rows = array("i")
+        posting_tfs = array("f")
+        lengths = array("f")
+
+        for row, (title, author, summary) in enumerate(entries):
+            self.books.append(
+                {"title": title, "author": author, "summary": summary}
+            )
+            term_frequencies = {}
+            length = 0.0
+            for field, text in (
+                ("title", title), ("author", author), ("summary", summary)
+            ):
+                for token in tokenize(text):
+                    term = _term(token)
+                    term_frequencies[term] = (
+                        term_frequencies.get(term, 0.0)
+                        + FIELD_WEIGHTS[field]
+                    )
+                    length += FIELD_WEIGHTS[field]
+            for term, term_frequency in term_frequencies.items():
+                term_id = self._term_ids.setdefault(
+                    term, len(self._term_ids)
+                )
+                posting_terms.append(term_id)
+                posting_rows.append(row)
+                posting_tfs.append(term_frequency)
+            lengths.append(length)
+            self._index_phrases(row, title, author)
+
+        self._build_postings(
+            np.frombuffer(posting_terms, dtype=np.int32),
+            np.frombuffer(posting_rows, dtype=np.int32),
+            np.frombuffer(posting_tfs, dtype=np.float32),
+            np.frombuffer(lengths, dtype=np.float32),
+        )
+
+    def __len__(self):
+        return len(self.books)
+
+    def _index_phrases(self, row, title, author):
+        title_tokens = tokenize(title)
+        author_tokens = tokenize(author)
+        # Also without initials ("Ursula Le Guin" for "Ursula K. Le Guin"),
+        # unless that leaves just the surname ("Wells" for "H. G. Wells"),
+        # which "by <surname>" covers
+        without_initials = [token for token in author_tokens if len(token) > 1]
+        phrases = [
+            (self._titles, title_tokens),
+            (self._authors, author_tokens),
+            (self._surnames, author_tokens[-1:]),
+        ]
+        if len(without_initials) > 1:
+            phrases.append((self._authors, without_initials))
+        for phrase_rows, tokens in phrases:
+            if tokens and _is_distinctive(tokens):
+                rows = phrase_rows.setdefault(" ".join(tokens), [])
+                if row not in rows:
+                    rows.append(row)
+
+    def _build_postings(self, terms, rows, term_frequencies, lengths):
+        n_books = max(len(lengths), 1)
+        average_length = float(lengths.mean()) if len(lengths) else 1.0
+        # Group the postings by term (stable, so rows stay sorted)
+        order = np.argsort(terms, kind="stable")
+        terms = terms[order]
+        self.posting_rows = rows[order]
+        term_frequencies = term_frequencies[order]
+        document_frequencies = np.bincount(
+            terms, minlength=len(self._term_ids)
+        )
+        self.posting_offsets = np.zeros(
+            len(self._term_ids) + 1, dtype=np.int64
+        )
+        np.cumsum(document_frequencies, out=self.posting_offsets[1:])
+
+        # Everything but the query is known, so store final BM25 weights
+        idf = np.log(
+            1 + (n_books - document_frequencies + 0.5)
+            / (document_frequencies + 0.5)
+        ).astype(np.float32)
+        length_norms = (
+            1 - BM25_B + BM25_B * lengths[self.posting_rows] / average_length
+        )
+        self.posting_weights = (
+            idf[terms] * term_frequencies * (BM25_K1 + 1)
+            / (term_frequencies + BM25_K1 * length_norms)
+        ).astype(np.float32)
+
+    def save(self, path):
+        """Write the index to a directory, to :meth:`load` from."""
+        for name in POSTING_ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        write_book_records(path, self.books)
+        with open(os.path.join(path, PHRASES_FILE_NAME), "w") as file:
+            json.dump({
+                "term_ids": self._term_ids,
+                "titles": self._titles,
+                "authors": self._authors,
+                "surnames": self._surnames,
+            }, file)
+
+    @classmethod
+    def load(cls, path):
+        """Load (memory-map) an index written by :meth:`save`."""
+        index = cls()
+        for name in POSTING_ARRAYS:
+            setattr(index, name, np.load(
+                os.path.join(path, f"{name}.npy"), mmap_mode="r"
+            ))
+        index.books = BookRecords(path)
+        with open(os.path.join(path, PHRASES_FILE_NAME)) as file:
+            phrases = json.load(file)
+        index._term_ids = phrases["term_ids"]
+        index._titles = phrases["titles"]
+        index._authors = phrases["authors"]
+        index._surnames = phrases["surnames"]
+        return index
+
+    def search(self, text, n_results):
+        """
+        Rank books against a query with BM25.
+
+        :param text: The query (e.g. themes, or a prompt).
+        :type text: str
+        :param n_results: The number of rows to return.
+        :type n_results: int
+        :returns: The matching book rows, best first (only books
+            matching at least one query word).
+        :rtype: list[int]
+        """
+        terms = {
+            _term(token) for token in tokenize(text)
+            if token not in STOPWORDS
+        }
+        term_ids = [
+            self._term_ids[term] for term in terms if term in self._term_ids
+        ]
+        if not term_ids or n_results <= 0:
+            return []
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term_id in term_ids:
+            start = self.posting_offsets[term_id]
+            end = self.posting_offsets[term_id + 1]
+            # Rows are unique within a term's postings
+            scores[self.posting_rows[start:end]] += (
+                self.posting_weights[start:end]
+            )
+        matches = np.flatnonzero(scores)
+        if len(matches) > n_results:
+            matches = matches[
+                np.argpartition(-scores[matches], n_results - 1)[:n_results]
+            ]
+        return matches[np.argsort(-scores[matches], kind="stable")].tolist()
+
+    def exact_matches(self, text):
+        """
+        Find books whose full title or author name appears in a text,
+        or whose author's surname follows "by" (e.g. "anything by Austen").
+
+        :param text: The text to look in (e.g. a prompt).
+        :type text: str
+        :returns: The matching book rows, title matches first.
+        :rtype: list[int]
+        """
+        title_rows, author_rows = self._phrase_matches(text)
+        # A book matched more than once is only listed once
+        return list(dict.fromkeys(title_rows + author_rows))
+
+    def title_matches(self, text):
+        """
+        Find books whose full title appears in a text.
+
+        :param text: The text to look in (e.g. a prompt).
+        :type text: str
+        :returns: The matching book rows.
+        :rtype: list[int]
+        """
+        title_rows, _ = self._phrase_matches(text)
+        return list(dict.fromkeys(title_rows))
+
+    def _phrase_matches(self, text):
+        """The rows of the titles and of the authors a text names."""
+        tokens = tokenize(text)
+        title_rows = []
+        author_rows = []
+        for start in range(len(tokens)):
+            for end in range(
+                start + 1, min(start + MAX_PHRASE_TOKENS, len(tokens)) + 1
+            ):
+                if end - start == 1 and not (
+                    len(tokens) == 1
+                    or (start and tokens[start - 1] in SINGLE_TOKEN_CUES)
+                ):
+                    continue
+                phrase = " ".join(tokens[start:end])
+                title_rows.extend(self._titles.get(phrase, ()))
+                author_rows.extend(self._authors.get(phrase, ()))
+        for previous, token in zip(tokens, tokens[1:]):
+            if previous == "by":
+                author_rows.extend(self._surnames.get(token, ()))
+        return title_rows, author_rows
+
+
+def reciprocal_rank_fusion(rankings, k):
+    """
+    Fuse rankings with reciprocal rank fusion: items are ordered by the
+    sum of 1 / (k + rank) over the rankings they appear in.
+
+    :param rankings: The rankings to fuse, best first.
+    :type rankings: list[list]
+    :param k: Dampens the weight of the top ranks (60 is the usual).
+    :type k: int
+    :returns: The fused ranking, best first.
+    :rtype: list
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+_lexical_index = LexicalIndex()  # Built from summaries.txt, see below
+
+
+def refresh_lexical_index():
+    """
+    Make sure the saved lexical index matches summaries.txt, (re)building
+    it if needed, and (re)load it.
+    """
+    global _lexical_index
+    fingerprint = get_summaries_fingerprint()
+    with file_lock("lexical_index"):
+        index_manifest = read_index_manifest(LEXICAL_INDEX_DIR)
+        if (
+            index_manifest is None
+            or index_manifest["fingerprint"] != fingerprint
+        ):
+            version_dir, path = new_version_dir(LEXICAL_INDEX_DIR)
+            LexicalIndex(iter_summaries_txt()).save(path)
+            swap_in_version(LEXICAL_INDEX_DIR, version_dir, fingerprint)
+            index_manifest = read_index_manifest(LEXICAL_INDEX_DIR)
+    _lexical_index = LexicalIndex.load(
+        os.path.join(LEXICAL_INDEX_DIR, index_manifest["version_dir"])
+    )
+
+
+def get_lexical_index():
+    """Get the lexical index of the library."""
+    return _lexical_index
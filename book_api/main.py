@@ -2,44 +2,532 @@
 # We do need to figure out what we want to return
 # from these endpoints (how much detail, what format)
 # and get the service to do that.
-from contextlib import asynccontextmanager
-from fastapi import FastAPI
-from pydantic import BaseModel
-from book_api.persistence import setup_database
-from book_api.chroma_db_setup import setup_chroma_db
+import asyncio
+import json
+import logging
+import math
+from contextlib import asynccontextmanager, suppress
+from typing import Literal
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
+from pydantic import BaseModel, Field
+from book_api.startup import startup_phase, mark_serving, mark_ready
+from book_api.startup import is_ready, get_startup_report
+from book_api.metrics import get_usage_metrics, render_prometheus
+from book_api.persistence import setup_database, close_db_connections
+from book_api.response_queue import get_response_writer
+from book_api.chroma_db_setup import setup_chroma_db, setup_async_chroma_db
 from book_api.chroma_db_setup import ensure_summaries_up_to_date
+from book_api.chroma_db_setup import add_library_change_listener
+from book_api.file_lock import file_lock
+from book_api.open_ai_service import warm_up_clients
 from book_api.rag_service import get_book_recommendation
+from book_api.rag_service import stream_book_recommendation
+from book_api.rag_config import (
+    BULK_JOB_MAX_PROMPTS,
+    BULK_JOB_POLL_INTERVAL_SECONDS,
+    NEIGHBOURS_PER_BOOK,
+    THEME_CLUSTER_REPRESENTATIVES,
+)
+from book_api.bulk_jobs import submit_bulk_job, advance_bulk_jobs
+from book_api.bulk_jobs import get_bulk_job_status, get_bulk_job_results
+from book_api.semantic_cache import get_semantic_cache, clear_semantic_cache
+from book_api.single_flight import get_single_flight_stats
+from book_api.context_builder import get_context_stats
+from book_api.retrieval_backends import refresh_retrieval_backend
+from book_api.theme_extraction import refresh_theme_vocabulary
+from book_api.prompt_prefix import refresh_catalogue_digest
+from book_api.lexical_index import refresh_lexical_index
+from book_api.neighbour_table import refresh_neighbour_table
+from book_api.neighbour_table import get_neighbour_table
+from book_api.neighbour_table import get_neighbour_table_stats
+from book_api.theme_extraction import get_retrieval_path_stats
+from book_api.tracing import start_trace, finish_trace, stop_trace_export
+from book_api.tracing import get_latency_stats, latency_metric_families
+from book_api.tracing_config import LOG_LEVEL, SERVER_TIMING_ENABLED
+from book_api.transport import is_openai_error, is_retryable
+from book_api.transport import get_limiter_stats
+from book_api.transport_config import OPENAI_RETRY_MAX_DELAY_SECONDS
+from book_api.startup_config import (
+    STARTUP_RETRY_AFTER_SECONDS,
+    STARTUP_RETRY_DELAY_SECONDS,
+)
+
+logging.basicConfig(
+    level=LOG_LEVEL,
+    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+)
+# httpx logs every request to OpenAI and ChromaDB at INFO
+# (httpx2 being the fork newer openai releases are built on)
+for httpx_logger in ("httpx", "httpx2"):
+    logging.getLogger(httpx_logger).setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 
 class PromptRequest(BaseModel):
     prompt: str
+    # Overrides the RESPONSE_MODE setting for this request
+    response_mode: Literal["llm", "markdown", "json"] | None = None
+
+
+class BulkJobRequest(BaseModel):
+    prompts: list[str] = Field(min_length=1, max_length=BULK_JOB_MAX_PROMPTS)
+    response_mode: Literal["llm", "markdown", "json"] | None = None
+
+
+async def poll_bulk_jobs():
+    """Move bulk jobs along as their batches finish (runs until cancelled)."""
+    while True:
+        try:
+            await advance_bulk_jobs()
+        except Exception as e:
+            logger.exception("Polling bulk jobs failed: %s", e)
+        await asyncio.sleep(BULK_JOB_POLL_INTERVAL_SECONDS)
+
+
+async def build_neighbour_table():
+    """Precompute the neighbour table, off the event loop."""
+    try:
+        await asyncio.to_thread(refresh_neighbour_table)
+    except Exception as e:
+        # "More like" lookups stay unavailable until the next sync
+        logger.exception("Could not build the neighbour table: %s", e)
+
+
+def sync_library():
+    """
+    Sync summaries.txt into ChromaDB, then build (or just load) everything
+    derived from the library, and keep it in sync.
+
+    Blocking (syncing an empty collection embeds the whole library), so
+    it's run in a worker thread, see :func:`warm_up`.
+    """
+    # Cached recommendations go stale whenever the library changes
+    add_library_change_listener(clear_semantic_cache)
+    with startup_phase("chroma_setup"):
+        setup_chroma_db()
+    # With several worker processes, the first one to get here syncs the
+    # library and builds the indexes; the others then find them up to
+    # date and just map them (so they're shared, not copied)
+    with file_lock("startup"):
+        with startup_phase("library_sync"):
+            try:
+                ensure_summaries_up_to_date()
+            except Exception as e:
+                if not is_openai_error(e):
+                    raise
+                # Keep serving the library as last synced; retried on next
+                # startup
+                logger.exception(
+                    "Could not sync summaries into ChromaDB: %s", e
+                )
+        # Build the fast path theme vocabulary, the catalogue digest, the
+        # lexical index and the retrieval backend's index (if any), and
+        # keep them in sync
+        for phase, refresh in (
+            ("theme_vocabulary", refresh_theme_vocabulary),
+            ("catalogue_digest", refresh_catalogue_digest),
+            ("lexical_index", refresh_lexical_index),
+            ("retrieval_backend", refresh_retrieval_backend),
+        ):
+            with startup_phase(phase):
+                refresh()
+            add_library_change_listener(refresh)
+    # Import openai now, rather than on the first request
+    with startup_phase("openai_clients"):
+        warm_up_clients()
+
+
+async def warm_up():
+    """
+    Get the app ready in the background, so the server accepts requests
+    (e.g. health checks) straight away: sync the library (retrying until
+    it works), then keep the neighbour table and bulk jobs going (runs
+    until cancelled).
+    """
+    while True:
+        try:
+            await asyncio.to_thread(sync_library)
+            # Async client for the request path (queries only)
+            with startup_phase("async_chroma_setup"):
+                await setup_async_chroma_db()
+            break
+        except Exception as e:
+            logger.exception(
+                "Startup failed, retrying in %g s: %s",
+                STARTUP_RETRY_DELAY_SECONDS, e,
+            )
+            await asyncio.sleep(STARTUP_RETRY_DELAY_SECONDS)
+    mark_ready()
+    # The neighbour table takes a while on large libraries, so it's built
+    # once the rest is ready (and only used once it's built itself)
+    add_library_change_listener(refresh_neighbour_table)
+    await asyncio.gather(build_neighbour_table(), poll_bulk_jobs())
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    # Setup persistence (SQLite DB)
-    setup_database()
-    # Setup ChromaDB connection and ensure summaries are loaded
-    setup_chroma_db()
-    ensure_summaries_up_to_date()
+    # Setup persistence (SQLite DB), and the background writer for it
+    with startup_phase("database"):
+        setup_database()
+        get_response_writer().start()
+    # Everything else happens in the background (see /ready), as syncing
+    # the library can take a while
+    warm_up_task = asyncio.create_task(warm_up())
+    mark_serving()
 
     yield
 
     # Shutdown
-    # (Nothing to do here currently)
-    # (Could consider closing connections if needed)
+    warm_up_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await warm_up_task
+    # Flush any queued response statistics, then close the DB
+    get_response_writer().stop()
+    close_db_connections()
+    # And any traces still to be exported
+    stop_trace_export()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+@app.middleware("http")
+async def handle_openai_errors(request: Request, call_next):
+    """
+    Answer OpenAI failures (left after retries) with a 503 and a
+    Retry-After if they're transient (rate limited, unreachable or
+    overloaded), and a 502 otherwise.
+
+    (A middleware rather than an exception handler, as registering one
+    would mean importing openai up front, see transport.)
+    """
+    try:
+        return await call_next(request)
+    except Exception as exc:
+        if not is_openai_error(exc):
+            raise
+        logger.warning(
+            "OpenAI call failed for %s: %s", request.url.path, exc
+        )
+        if is_retryable(exc):
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "OpenAI is unavailable, try again later."},
+                headers={"Retry-After": str(
+                    math.ceil(OPENAI_RETRY_MAX_DELAY_SECONDS)
+                )},
+            )
+        return JSONResponse(
+            status_code=502,
+            content={"detail": "OpenAI could not handle the request."},
+        )
+
+
+# Added last, so it's the outermost middleware, and times everything
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Trace each request, timing the stages of the pipeline it goes through.
+
+    The trace ID is returned in the X-Trace-Id header, and the stage
+    timings in the Server-Timing header (if enabled). The trace is
+    finished (and exported) once the response body has been sent, so
+    streamed responses are timed in full.
+    """
+    trace = start_trace(f"{request.method} {request.url.path}")
+    try:
+        response = await call_next(request)
+    except BaseException:
+        # Failed requests are exported too (they're the most telling)
+        finish_trace(trace)
+        raise
+    response.headers["X-Trace-Id"] = trace.trace_id
+    if SERVER_TIMING_ENABLED:
+        # Only what's done by the time the headers are sent
+        # (i.e. not the formatting of a streamed response)
+        response.headers["Server-Timing"] = trace.server_timing()
+
+    body_iterator = response.body_iterator
+
+    async def traced_body():
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            finish_trace(trace)
+
+    response.body_iterator = traced_body()
+    return response
+
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
 
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Whether the library is synced and loaded, so recommendations can be
+    served (/health only says the process is up).
+    """
+    if not is_ready():
+        return JSONResponse(
+            status_code=503,
+            content={"status": "starting"},
+            headers={"Retry-After": str(STARTUP_RETRY_AFTER_SECONDS)},
+        )
+    return {"status": "ready"}
+
+
+def _require_ready():
+    if not is_ready():
+        raise HTTPException(
+            status_code=503,
+            detail="Still starting up, try again shortly.",
+            headers={"Retry-After": str(STARTUP_RETRY_AFTER_SECONDS)},
+        )
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "semantic_cache": get_semantic_cache().stats(),
+        "retrieval_paths": get_retrieval_path_stats(),
+        "response_writer": get_response_writer().stats(),
+        "latency_ms": get_latency_stats(),
+        "openai_limits": get_limiter_stats(),
+        "coalescing": get_single_flight_stats(),
+        "neighbour_table": get_neighbour_table_stats(),
+        "startup": get_startup_report(),
+        "formatting_context": get_context_stats(),
+    }
+
+
+@app.get("/costs")
+async def costs():
+    """Running OpenAI costs and token usage (since this process started)."""
+    return get_usage_metrics().costs_summary()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Metrics in the Prometheus text exposition format."""
+    semantic_cache_stats = get_semantic_cache().stats()
+    response_writer_stats = get_response_writer().stats()
+    limiter_stats = get_limiter_stats()
+    single_flight_stats = get_single_flight_stats()
+    metric_families = get_usage_metrics().prometheus_samples() + [
+        (
+            "book_api_semantic_cache_lookups_total", "counter",
+            "Semantic response cache lookups, by result.",
+            [
+                ({"result": "hit"}, semantic_cache_stats["hits"]),
+                ({"result": "miss"}, semantic_cache_stats["misses"]),
+            ],
+        ),
+        (
+            "book_api_semantic_cache_entries", "gauge",
+            "Entries in the semantic response cache.",
+            [({}, semantic_cache_stats["size"])],
+        ),
+        (
+            "book_api_retrieval_path_total", "counter",
+            "Requests by retrieval path taken.",
+            [
+                ({"path": path}, count)
+                for path, count in get_retrieval_path_stats().items()
+            ],
+        ),
+        (
+            "book_api_response_queue_depth", "gauge",
+            "Response statistics waiting to be persisted.",
+            [({}, response_writer_stats["queue_depth"])],
+        ),
+        (
+            "book_api_response_records_total", "counter",
+            "Response statistics records, by outcome.",
+            [
+                ({"outcome": outcome}, response_writer_stats[outcome])
+                for outcome in ("written", "dropped", "failed")
+            ],
+        ),
+        (
+            "book_api_openai_concurrency_limit", "gauge",
+            "Current adaptive limit on concurrent OpenAI calls.",
+            [
+                ({"endpoint": endpoint}, endpoint_stats["limit"])
+                for endpoint, endpoint_stats in limiter_stats.items()
+            ],
+        ),
+        (
+            "book_api_openai_in_flight", "gauge",
+            "OpenAI calls in flight.",
+            [
+                ({"endpoint": endpoint}, endpoint_stats["in_flight"])
+                for endpoint, endpoint_stats in limiter_stats.items()
+            ],
+        ),
+        (
+            "book_api_coalesced_calls_total", "counter",
+            "Calls by kind, either made (leader) or coalesced with an"
+            " identical call in flight (follower).",
+            [
+                ({"kind": kind, "role": role}, flight_stats[f"{role}s"])
+                for kind, flight_stats in single_flight_stats.items()
+                for role in ("leader", "follower")
+            ],
+        ),
+    ] + latency_metric_families()
+    return PlainTextResponse(
+        render_prometheus(metric_families),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
 @app.post("/book-recommendation")
 async def book_recommendation(request: PromptRequest):
-    response_text = get_book_recommendation(request.prompt)
-    return {"response": response_text}
+    _require_ready()
+    return await get_book_recommendation(
+        request.prompt, request.response_mode
+    )
+
+
+@app.post("/book-recommendation/stream")
+async def book_recommendation_stream(request: PromptRequest):
+    """
+    Stream book recommendations as server-sent events.
+
+    Emits a "books" event (retrieved titles and authors) as soon as
+    retrieval is done, "delta" events with the formatted response text,
+    then a "done" event (or an "error" event if something went wrong).
+    """
+    _require_ready()
+
+    async def events():
+        try:
+            async for event, data in stream_book_recommendation(
+                request.prompt, request.response_mode
+            ):
+                if event == "delta":
+                    data = {"text": data}
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except Exception as e:
+            logger.exception("Streaming recommendation failed: %s", e)
+            error = {"detail": "Recommendation failed"}
+            yield f"event: error\ndata: {json.dumps(error)}\n\n"
+            return
+        yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Don't let proxies (e.g. our Nginx) buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _neighbour_table_or_503():
+    neighbour_table = get_neighbour_table()
+    if neighbour_table is None:
+        raise HTTPException(
+            status_code=503,
+            detail="The neighbour table is still being built.",
+            headers={"Retry-After": "30"},
+        )
+    return neighbour_table
+
+
+def _book_fields(book):
+    return {
+        "title": book["title"],
+        "author": book["author"],
+        "summary": book["summary"],
+    }
+
+
+@app.get("/books/more-like")
+async def more_like(
+    title: str,
+    n_results: int = Query(5, ge=1, le=NEIGHBOURS_PER_BOOK),
+):
+    """
+    Recommend the books most similar to one in the library, looked up
+    in the precomputed neighbour table (no OpenAI or ChromaDB calls).
+    """
+    neighbour_table = _neighbour_table_or_503()
+    rows = neighbour_table.find_title(title)
+    if not rows:
+        raise HTTPException(status_code=404, detail="Book not found")
+    neighbour_rows, distances = neighbour_table.get_neighbours(
+        rows[0], n_results
+    )
+    return {
+        "book": _book_fields(neighbour_table.get_book(rows[0])),
+        "books": [
+            {**_book_fields(neighbour_table.get_book(row)),
+             "distance": distance}
+            for row, distance in zip(neighbour_rows, distances)
+        ],
+    }
+
+
+@app.get("/themes")
+async def themes(
+    n_results: int = Query(
+        THEME_CLUSTER_REPRESENTATIVES, ge=1, le=THEME_CLUSTER_REPRESENTATIVES
+    ),
+):
+    """
+    The library's theme clusters, with (up to ``n_results`` of) their
+    representative books.
+    """
+    neighbour_table = _neighbour_table_or_503()
+    return [
+        {
+            "themes": cluster["themes"],
+            "size": cluster["size"],
+            "books": [
+                _book_fields(book)
+                for book in neighbour_table.get_cluster_books(
+                    index, n_results
+                )
+            ],
+        }
+        for index, cluster in enumerate(neighbour_table.clusters)
+    ]
+
+
+@app.post("/bulk-jobs")
+async def bulk_job_submit(request: BulkJobRequest):
+    """
+    Submit a bulk recommendation job, run through the (cheaper, but
+    slower) Batch API. Check on it with ``GET /bulk-jobs/{job_id}``.
+    """
+    _require_ready()
+    return await submit_bulk_job(request.prompts, request.response_mode)
+
+
+@app.get("/bulk-jobs/{job_id}")
+async def bulk_job_status(job_id: str):
+    status = await asyncio.to_thread(get_bulk_job_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Bulk job not found")
+    return status
+
+
+@app.get("/bulk-jobs/{job_id}/results")
+async def bulk_job_results(job_id: str):
+    status = await asyncio.to_thread(get_bulk_job_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Bulk job not found")
+    return {
+        "status": status["status"],
+        "results": await asyncio.to_thread(get_bulk_job_results, job_id),
+    }
@@ -0,0 +1,171 @@
+import threading
+from time import time
+from book_api.pricing import CURRENCY, get_token_costs, normalize_model_name
+
+TOKEN_TYPES = (
+    "uncached_input",
+    "cached_input",
+    "reasoning_output",
+    "nonreasoning_output",
+)
+
+
+class UsageMetrics:
+    """
+    In-memory OpenAI usage counters (tokens, requests and running cost).
+
+    Updated on every recorded response, without touching the database.
+    Counters are per process, and reset when it restarts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # Updated from worker threads too
+        self.started_at = time()
+        self.tokens = {}  # (model, tier, token type) -> tokens
+        self.requests = {}  # (model, tier) -> requests
+        self.costs = {}  # (model, tier) -> cost in CURRENCY
+        self.unpriced_models = set()
+
+    def record(self, response_stats):
+        """
+        Count a response's usage.
+
+        :param response_stats: The response statistics, as recorded by
+            ``response_monitor.record_response``.
+        :type response_stats: dict
+        """
+        model = normalize_model_name(response_stats.get("model", "unknown"))
+        tier = "batch" if response_stats.get("batch") else "regular"
+        token_counts = {
+            token_type: response_stats.get(f"{token_type}_tokens", 0)
+            for token_type in TOKEN_TYPES
+        }
+        token_costs = get_token_costs(model, tier, token_counts)
+
+        with self._lock:
+            for token_type, tokens in token_counts.items():
+                key = (model, tier, token_type)
+                self.tokens[key] = self.tokens.get(key, 0) + tokens
+            self.requests[(model, tier)] = (
+                self.requests.get((model, tier), 0) + 1
+            )
+            if token_costs is None:
+                self.unpriced_models.add(model)
+            else:
+                self.costs[(model, tier)] = (
+                    self.costs.get((model, tier), 0.0)
+                    + sum(token_costs.values())
+                )
+
+    def costs_summary(self):
+        """
+        Summarize running costs per model and tier (for ``/costs``).
+
+        :rtype: dict
+        """
+        with self._lock:
+            models = {}
+            for (model, tier), requests in self.requests.items():
+                tokens = {
+                    token_type: self.tokens.get((model, tier, token_type), 0)
+                    for token_type in TOKEN_TYPES
+                }
+                input_tokens = (
+                    tokens["uncached_input"] + tokens["cached_input"]
+                )
+                models.setdefault(model, {})[tier] = {
+                    "requests": requests,
+                    "tokens": tokens,
+                    # Share of input tokens served from the prompt cache
+                    "cached_input_ratio": (
+                        tokens["cached_input"] / input_tokens
+                        if input_tokens else 0.0
+                    ),
+                    "cost": self.costs.get((model, tier), 0.0),
+                }
+            return {
+                "currency": CURRENCY,
+                "since": self.started_at,
+                "models": models,
+                "total": sum(self.costs.values()),
+                "unpriced_models": sorted(self.unpriced_models),
+            }
+
+    def prometheus_samples(self):
+        """Get the counters as Prometheus metric families."""
+        with self._lock:
+            return [
+                (
+                    "book_api_openai_tokens_total", "counter",
+                    "OpenAI tokens used, by model, tier and token type.",
+                    [
+                        ({"model": model, "tier": tier, "type": token_type},
+                            tokens)
+                        for (model, tier, token_type), tokens
+                        in self.tokens.items()
+                    ],
+                ),
+                (
+                    "book_api_openai_requests_total", "counter",
+                    "OpenAI requests made, by model and tier.",
+                    [
+                        ({"model": model, "tier": tier}, requests)
+                        for (model, tier), requests in self.requests.items()
+                    ],
+                ),
+                (
+                    f"book_api_openai_cost_{CURRENCY.lower()}_total",
+                    "counter",
+                    f"Running OpenAI cost in {CURRENCY}, by model and tier.",
+                    [
+                        ({"model": model, "tier": tier}, cost)
+                        for (model, tier), cost in self.costs.items()
+                    ],
+                ),
+            ]
+
+
+def _escape_label_value(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+
+
+def render_prometheus(metric_families):
+    """
+    Render metric families in the Prometheus text exposition format.
+
+    :param metric_families: Tuples of (name, type, help text, samples),
+        where samples are (labels dict, value) tuples, or (name suffix,
+        labels dict, value) tuples (e.g. for a histogram's "_bucket",
+        "_sum" and "_count" series).
+    :type metric_families: list[tuple]
+    :returns: The rendered metrics.
+    :rtype: str
+    """
+    lines = []
+    for name, metric_type, help_text, samples in metric_families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for sample in samples:
+            suffix, labels, value = (
+                sample if len(sample) == 3 else ("", *sample)
+            )
+            label_text = ",".join(
+                f'{key}="{_escape_label_value(label_value)}"'
+                for key, label_value in labels.items()
+            )
+            if label_text:
+                lines.append(f"{name}{suffix}{{{label_text}}} {value}")
+            else:
+                lines.append(f"{name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+
+_usage_metrics = UsageMetrics()
+
+
+def get_usage_metrics():
+    """Get the shared usage metrics."""
+    return _usage_metrics
@@ -0,0 +1,393 @@
+import json
+import logging
+import math
+import os
+import shutil
+from collections import Counter
+import numpy as np
+from book_api.chroma_db_setup import (
+    get_chroma_collection,
+    get_library_fingerprint,
+)
+from book_api.file_lock import file_lock
+from book_api.lexical_index import tokenize
+from book_api.rag_config import (
+    NEIGHBOUR_TABLE_DIR,
+    NEIGHBOURS_PER_BOOK,
+    THEME_CLUSTER_COUNT,
+    THEME_CLUSTER_REPRESENTATIVES,
+    VECTOR_INDEX_DIR,
+)
+from book_api.theme_extraction import STOPWORDS
+from book_api.vector_index import (
+    BOOKS_FILE_NAME,
+    OFFSETS_FILE_NAME,
+    BookRecords,
+    ensure_vector_index,
+    load_vector_index,
+    new_version_dir,
+    read_index_manifest,
+    swap_in_version,
+)
+
+logger = logging.getLogger(__name__)
+
+NEIGHBOURS_FILE_NAME = "neighbours.npy"  # (n x k) int32 rows, -1 padded
+NEIGHBOUR_DISTANCES_FILE_NAME = "neighbour_distances.npy"  # Same, float32
+CENTROIDS_FILE_NAME = "centroids.npy"  # Normalized float32, one row a cluster
+CLUSTERS_FILE_NAME = "clusters.json"  # Themes, size and representatives
+TITLES_FILE_NAME = "titles.json"  # Normalized title -> book rows
+# Similarities computed at a time in the all-pairs pass (4 bytes each)
+BLOCK_SIMILARITIES = 2 ** 25
+KMEANS_ITERATIONS = 20
+KMEANS_SEED = 0  # So every build of the same library clusters alike
+CLUSTER_THEMES = 5  # Words describing each cluster
+CLUSTER_THEME_SAMPLE = 200  # Closest members to pick them from
+
+_neighbour_table = None  # Loaded in the background, see below
+_materialized_hits = 0
+
+
+class NeighbourTable:
+    """
+    The precomputed neighbour table: every book's nearest neighbours, and
+    theme clusters with representative books, all memory-mapped.
+
+    Answering "more like <title>" or a theme close to a cluster is a
+    lookup, without any embedding or retrieval query.
+    """
+
+    def __init__(self, table_dir, version_dir, fingerprint):
+        self.fingerprint = fingerprint
+        path = os.path.join(table_dir, version_dir)
+        self.neighbours = np.load(
+            os.path.join(path, NEIGHBOURS_FILE_NAME), mmap_mode="r"
+        )
+        self.neighbour_distances = np.load(
+            os.path.join(path, NEIGHBOUR_DISTANCES_FILE_NAME), mmap_mode="r"
+        )
+        self.centroids = np.load(os.path.join(path, CENTROIDS_FILE_NAME))
+        with open(os.path.join(path, CLUSTERS_FILE_NAME)) as file:
+            self.clusters = json.load(file)
+        with open(os.path.join(path, TITLES_FILE_NAME)) as file:
+            self._titles = json.load(file)
+        self.books = BookRecords(path)
+
+    def __len__(self):
+        return len(self.books)
+
+    def get_book(self, row):
+        """Get the book record (id, title, author, summary) for a row."""
+        return self.books.get_book(row)
+
+    def find_title(self, title):
+        """
+        Find the books with a title (ignoring case, accents and
+        punctuation).
+
+        :rtype: list[int]
+        """
+        return self._titles.get(" ".join(tokenize(title)), [])
+
+    def get_neighbours(self, row, n_results):
+        """
+        Get a book's nearest neighbours.
+
+        :param row: The book's row.
+        :type row: int
+        :param n_results: The number of neighbours to return (at most
+            ``NEIGHBOURS_PER_BOOK`` are precomputed).
+        :type n_results: int
+        :returns: A tuple of (neighbour rows, cosine distances), closest
+            first.
+        :rtype: tuple[list[int], list[float]]
+        """
+        rows = self.neighbours[row, :max(n_results, 0)]
+        found = rows >= 0
+        return (
+            rows[found].tolist(),
+            self.neighbour_distances[row, :len(rows)][found].tolist(),
+        )
+
+    def match_cluster(self, embedding):
+        """
+        Find the cluster closest to an embedding.
+
+        :param embedding: The embedding to match (e.g. of a theme query).
+        :type embedding: list[float]
+        :returns: A tuple of (the cluster's index, its cosine similarity
+            to the embedding), or (None, 0.0) if there are no clusters.
+        :rtype: tuple[int | None, float]
+        """
+        if not len(self.centroids):
+            return None, 0.0
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return None, 0.0
+        similarities = self.centroids @ (query / norm)
+        cluster = int(np.argmax(similarities))
+        return cluster, float(similarities[cluster])
+
+    def get_cluster_books(self, cluster, n_results=None):
+        """
+        Get a cluster's representative book records, closest first.
+
+        :param cluster: The cluster's index.
+        :type cluster: int
+        :param n_results: The number of books to return (at most
+            ``THEME_CLUSTER_REPRESENTATIVES`` are kept; None for all).
+        :type n_results: int, optional
+        :rtype: list[dict]
+        """
+        representatives = self.clusters[cluster]["representatives"]
+        return [
+            self.get_book(row) for row in representatives[:n_results]
+        ]
+
+
+def compute_neighbours(embeddings, n_neighbours):
+    """
+    Find every row's nearest other rows, in one vectorized all-pairs pass.
+
+    Rows are compared against all rows a block at a time (one matrix
+    product per block), so memory use stays bounded however large the
+    library is.
+
+    :param embeddings: Normalized embeddings, one row a book.
+    :type embeddings: numpy.ndarray
+    :param n_neighbours: The number of neighbours to find per row.
+    :type n_neighbours: int
+    :returns: A tuple of (neighbour rows, (n x n_neighbours) int32 padded
+        with -1; their cosine distances, float32 padded with inf),
+        closest first.
+    :rtype: tuple[numpy.ndarray, numpy.ndarray]
+    """
+    n_rows = len(embeddings)
+    neighbours = np.full((n_rows, n_neighbours), -1, dtype=np.int32)
+    distances = np.full((n_rows, n_neighbours), np.inf, dtype=np.float32)
+    n_found = min(n_neighbours, n_rows - 1)
+    if n_found <= 0:
+        return neighbours, distances
+
+    block_rows = max(1, BLOCK_SIMILARITIES // n_rows)
+    for start in range(0, n_rows, block_rows):
+        end = min(start + block_rows, n_rows)
+        similarities = embeddings[start:end] @ embeddings.T
+        # A book isn't its own neighbour
+        similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+        top = np.argpartition(-similarities, n_found - 1, axis=1)
+        top = top[:, :n_found]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        neighbours[start:end, :n_found] = np.take_along_axis(top, order, 1)
+        distances[start:end, :n_found] = (
+            1.0 - np.take_along_axis(top_similarities, order, 1)
+        )
+    return neighbours, distances
+
+
+def cluster_embeddings(embeddings, n_clusters):
+    """
+    Cluster rows by cosine similarity (spherical k-means, seeded so the
+    same library always clusters the same way). Rows are assigned a block
+    at a time, so memory use stays bounded.
+
+    :param embeddings: Normalized embeddings, one row a book.
+    :type embeddings: numpy.ndarray
+    :param n_clusters: The number of clusters (at most one per row).
+    :type n_clusters: int
+    :returns: A tuple of (each row's cluster, int32; the normalized
+        centroids, float32).
+    :rtype: tuple[numpy.ndarray, numpy.ndarray]
+    """
+    n_rows = len(embeddings)
+    n_clusters = min(n_clusters, n_rows)
+    if n_clusters <= 0:
+        return (
+            np.zeros(n_rows, dtype=np.int32),
+            np.zeros((0, embeddings.shape[1]), dtype=np.float32),
+        )
+
+    rng = np.random.default_rng(KMEANS_SEED)
+    seeds = np.sort(rng.choice(n_rows, n_clusters, replace=False))
+    centroids = np.array(embeddings[seeds], dtype=np.float32)
+    block_rows = max(1, BLOCK_SIMILARITIES // n_clusters)
+    labels = None
+    for _ in range(KMEANS_ITERATIONS):
+        new_labels = np.empty(n_rows, dtype=np.int32)
+        sums = np.zeros_like(centroids)
+        for start in range(0, n_rows, block_rows):
+            block = embeddings[start:start + block_rows]
+            block_labels = np.argmax(block @ centroids.T, axis=1)
+            new_labels[start:start + len(block)] = block_labels
+            # Sum each cluster's members with a (clusters x rows) product
+            membership = np.zeros((n_clusters, len(block)), np.float32)
+            membership[block_labels, np.arange(len(block))] = 1.0
+            sums += membership @ block
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty clusters keep their centroid
+        centroids = np.where(norms > 0, sums / np.where(norms == 0, 1, norms),
+                             centroids)
+    return labels, centroids
+
+
+def describe_clusters(embeddings, books, labels, centroids):
+    """
+    Describe each cluster by its representative books (the members
+    closest to its centroid) and theme words (common among its closest
+    members, but not across clusters).
+
+    :rtype: list[dict]
+    """
+    member_words = []
+    clusters = []
+    for cluster, centroid in enumerate(centroids):
+        members = np.flatnonzero(labels == cluster)
+        members = members[np.argsort(-(embeddings[members] @ centroid))]
+        words = Counter()
+        for row in members[:CLUSTER_THEME_SAMPLE]:
+            book = books.get_book(int(row))
+            words.update(set(
+                token for token in tokenize(book["summary"])
+                if token not in STOPWORDS and len(token) > 3
+                and token.isalpha()
+            ))
+        member_words.append(words)
+        representatives = members[:THEME_CLUSTER_REPRESENTATIVES]
+        clusters.append({
+            "size": len(members),
+            "representatives": representatives.tolist(),
+        })
+
+    # Weigh words down the more clusters they're common in
+    cluster_frequencies = Counter()
+    for words in member_words:
+        cluster_frequencies.update(words.keys())
+    for cluster, words in zip(clusters, member_words):
+        scores = {
+            word: count * math.log(1 + len(clusters)
+                                   / cluster_frequencies[word])
+            for word, count in words.items()
+        }
+        cluster["themes"] = sorted(
+            scores, key=lambda word: (-scores[word], word)
+        )[:CLUSTER_THEMES]
+    return clusters
+
+
+def build_neighbour_table(vector_index, table_dir):
+    """
+    Precompute the neighbour table from the vector index.
+
+    No embedding calls are made. The table gets its own copy of the book
+    records, and is written to a fresh directory and swapped in
+    atomically, like the vector index.
+
+    :param vector_index: The (current) vector index to build from.
+    :type vector_index: book_api.vector_index.VectorIndex
+    :param table_dir: The directory holding the table.
+    :type table_dir: str
+    """
+    version_dir, path = new_version_dir(table_dir)
+    for file_name in (BOOKS_FILE_NAME, OFFSETS_FILE_NAME):
+        shutil.copyfile(
+            os.path.join(vector_index.path, file_name),
+            os.path.join(path, file_name),
+        )
+    embeddings = vector_index.embeddings
+    books = vector_index.books
+
+    neighbours, distances = compute_neighbours(
+        embeddings, NEIGHBOURS_PER_BOOK
+    )
+    np.save(os.path.join(path, NEIGHBOURS_FILE_NAME), neighbours)
+    np.save(os.path.join(path, NEIGHBOUR_DISTANCES_FILE_NAME), distances)
+
+    n_clusters = THEME_CLUSTER_COUNT or round(math.sqrt(len(books) / 2))
+    labels, centroids = cluster_embeddings(embeddings, max(n_clusters, 1))
+    clusters = describe_clusters(embeddings, books, labels, centroids)
+    np.save(os.path.join(path, CENTROIDS_FILE_NAME), centroids)
+    with open(os.path.join(path, CLUSTERS_FILE_NAME), "w") as file:
+        json.dump(clusters, file)
+
+    titles = {}
+    for row in range(len(books)):
+        title = " ".join(tokenize(books.get_book(row)["title"]))
+        titles.setdefault(title, []).append(row)
+    with open(os.path.join(path, TITLES_FILE_NAME), "w") as file:
+        json.dump(titles, file)
+
+    swap_in_version(table_dir, version_dir, vector_index.fingerprint)
+    logger.info(
+        "Built neighbour table with %d books and %d theme clusters.",
+        len(books), len(clusters),
+    )
+
+
+def load_neighbour_table(table_dir):
+    """Load (memory-map) the current neighbour table, or return None."""
+    table_manifest = read_index_manifest(table_dir)
+    if table_manifest is None:
+        return None
+    return NeighbourTable(
+        table_dir,
+        table_manifest["version_dir"],
+        table_manifest["fingerprint"],
+    )
+
+
+def refresh_neighbour_table():
+    """
+    Make sure the neighbour table matches the library, (re)building it
+    (and the vector index it's computed from) if needed, and (re)load it.
+
+    Meant to run in the background after the summaries are synced: the
+    table is only used once loaded.
+    """
+    global _neighbour_table
+    with file_lock("neighbour_table"):
+        fingerprint = get_library_fingerprint()
+        table_manifest = read_index_manifest(NEIGHBOUR_TABLE_DIR)
+        if (
+            table_manifest is None
+            or table_manifest["fingerprint"] != fingerprint
+        ):
+            ensure_vector_index(
+                get_chroma_collection, VECTOR_INDEX_DIR, fingerprint
+            )
+            build_neighbour_table(
+                load_vector_index(VECTOR_INDEX_DIR), NEIGHBOUR_TABLE_DIR
+            )
+        if (
+            _neighbour_table is None
+            or _neighbour_table.fingerprint != fingerprint
+        ):
+            _neighbour_table = load_neighbour_table(NEIGHBOUR_TABLE_DIR)
+
+
+def get_neighbour_table():
+    """Get the neighbour table, or None if it isn't loaded yet."""
+    return _neighbour_table
+
+
+def record_materialized_hit():
+    """Count a theme query served from a cluster's representatives."""
+    global _materialized_hits
+    _materialized_hits += 1
+
+
+def get_neighbour_table_stats():
+    """Get whether the table is loaded, its size, and materialized hits."""
+    neighbour_table = _neighbour_table
+    return {
+        "ready": neighbour_table is not None,
+        "books": len(neighbour_table) if neighbour_table else 0,
+        "clusters": (
+            len(neighbour_table.clusters) if neighbour_table else 0
+        ),
+        "materialized_hits": _materialized_hits,
+    }
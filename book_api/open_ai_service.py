@@ -1,8 +1,99 @@
+import json
+import logging
+from contextlib import AsyncExitStack
+from types import SimpleNamespace
 from typing import List, Any
-from openai import OpenAI, NOT_GIVEN
-from book_api.response_monitor import record_response
+from book_api.response_monitor import (
+    get_response_record,
+    record_response,
+    record_response_async,
+)
+from book_api.tokens import count_tokens, EMBEDDING_ENCODING
+from book_api.transport import (
+    make_openai_client,
+    make_async_openai_client,
+    call_with_retries,
+    call_with_retries_async,
+    stream_with_retries_async,
+)
+from book_api.transport_config import (
+    OPENAI_RESPONSE_TIMEOUT_SECONDS,
+    OPENAI_EMBEDDING_TIMEOUT_SECONDS,
+    OPENAI_MOCK_ON_FAILURE,
+)
 
-client = OpenAI()
+logger = logging.getLogger(__name__)
+
+# Pooled clients, so connections are kept alive between calls
+# (made on first use, as importing openai is slow, see transport)
+_client = None
+_async_client = None  # For the async request path
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = make_openai_client()
+    return _client
+
+
+def _get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = make_async_openai_client()
+    return _async_client
+
+
+def warm_up_clients():
+    """Make the clients (importing openai) ahead of the first call."""
+    _get_client()
+    _get_async_client()
+
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+
+
+def _mock_response(text, tool_call=False):
+    """
+    Build a mocked response for development if the OpenAI API fails.
+
+    Mimics just enough of the Responses API object for the RAG pipeline.
+    """
+    output = []
+    if tool_call:
+        output.append(SimpleNamespace(
+            type="function_call",
+            name="get_books_by_themes",
+            call_id="mock_call",
+            arguments=json.dumps({
+                "themes": ["fantasy", "adventure"],
+                "n_results": 4
+            }),
+        ))
+    return SimpleNamespace(output_text=text, output=output)
+
+
+def _mock_embedding(texts):
+    """Build a mocked embedding response (zero vectors) for development."""
+    return SimpleNamespace(data=[
+        SimpleNamespace(embedding=[0.0] * EMBEDDING_DIMENSIONS)
+        for _ in texts
+    ])
+
+
+def _estimate_response_tokens(input, instructions, max_output_tokens):
+    """Roughly how many tokens a response uses, for the token budget."""
+    return (
+        count_tokens(str(input))
+        + count_tokens(instructions or "")
+        + max_output_tokens
+    )
+
+
+def _estimate_embedding_tokens(texts):
+    """How many tokens embedding the texts uses, for the token budget."""
+    return sum(count_tokens(text, EMBEDDING_ENCODING) for text in texts)
 
 
 def get_response(
@@ -17,7 +108,8 @@ def get_response(
     # is upset when calling the API, or it's upset when calling
     # this function.)
     max_output_tokens: int = 500,
-    model: str = "gpt-4.1-nano"
+    model: str = "gpt-4.1-nano",
+    prompt_cache_key: str | None = None,
 ):  # 500 tokens as sanity limit
     """
     Get a response from the OpenAI API for a given input text.
@@ -33,49 +125,53 @@ def get_response(
     :param model: The model to use for the response.
         (Defaults to "gpt-4.1-nano".)
     :type model: str, optional
+    :param prompt_cache_key: Routes requests sharing a prompt prefix to
+        the same cache (see ``prompt_prefix``).
+    :type prompt_cache_key: str, optional
     :returns: The response object from the OpenAI API.
     :rtype: OpenAIResponse
     """
-    # No caching for requests shorter than 1024 tokens, unfortunately
+    from openai import NOT_GIVEN, OpenAIError
+    # OpenAI caches prompt prefixes (tools, then instructions, then input)
+    # of 1024+ tokens, so whatever's the same for every request goes first
     try:
-        response = client.responses.create(
-            model=model,
-            instructions=instructions if instructions is not None else NOT_GIVEN,
-            input=input,
-            tools=tools if tools is not None else NOT_GIVEN,
-            max_output_tokens=max_output_tokens,
-        )
-        record_response(
-            instructions=instructions,
-            input=input,
-            openai_response=response
+        response = call_with_retries(
+            "responses",
+            lambda: _get_client().responses.create(
+                model=model,
+                instructions=(
+                    instructions if instructions is not None else NOT_GIVEN
+                ),
+                input=input,
+                tools=tools if tools is not None else NOT_GIVEN,
+                max_output_tokens=max_output_tokens,
+                prompt_cache_key=(
+                    prompt_cache_key if prompt_cache_key is not None
+                    else NOT_GIVEN
+                ),
+                timeout=OPENAI_RESPONSE_TIMEOUT_SECONDS,
+            ),
+            _estimate_response_tokens(input, instructions, max_output_tokens),
         )
-        return response
-    except Exception as e:
+    except OpenAIError as e:
+        if not OPENAI_MOCK_ON_FAILURE:
+            raise
         # Return a mocked response for development if OpenAI API fails
-        print(f"OpenAI API call failed: {e}, returning mock response.")
-
-        class MockResponse:
-            def __init__(self, text, tool_call=False):
-                # Mock output text
-                self.output_text = text
-                # Mock output structure
-                if tool_call:
-                    self.output = [{
-                        "type": "function_call",
-                        'name': 'get_books_by_themes',
-                        'arguments': {
-                            "themes": ["fantasy", "adventure"],
-                            "n_results": 4
-                        }
-                    }]
-
-        return MockResponse(
+        logger.warning(
+            "OpenAI API call failed: %s, returning mock response.", e
+        )
+        return _mock_response(
             "[MOCKED RESPONSE]"
             f"\nCould not reach OpenAI: {e}."
             f"\nInput was: {input}",
             tool_call=tools is not None  # Mock tool call if tools given
         )
+    record_response(
+        instructions=instructions,
+        input=input,
+        openai_response=response
+    )
+    return response
 
 
 def get_response_text(
@@ -83,7 +179,8 @@ def get_response_text(
     *,
     instructions=None,
     max_output_tokens=500,
-    model="gpt-4.1-nano"
+    model="gpt-4.1-nano",
+    prompt_cache_key=None,
 ):
     """
     Get a response text from the OpenAI API for a given input text.
@@ -97,13 +194,18 @@ def get_response_text(
     :param model: The model to use for the response.
         (Defaults to "gpt-4.1-nano".)
     :type model: str, optional
+    :param prompt_cache_key: Routes requests sharing a prompt prefix to
+        the same cache (see ``prompt_prefix``).
+    :type prompt_cache_key: str, optional
     :returns: The response text from the OpenAI API.
     :rtype: str
     """
     response = get_response(
         input,
+        instructions=instructions,
         max_output_tokens=max_output_tokens,
-        model=model
+        model=model,
+        prompt_cache_key=prompt_cache_key,
     )
     return response.output_text
 
@@ -117,23 +219,31 @@ def get_embedding(texts):
     :returns: The reponse object from the OpenAI API.
     :rtype: OpenAIResponse
     """
+    from openai import OpenAIError
     try:
-        response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=texts
+        response = call_with_retries(
+            "embeddings",
+            lambda: _get_client().embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=texts,
+                timeout=OPENAI_EMBEDDING_TIMEOUT_SECONDS,
+            ),
+            _estimate_embedding_tokens(texts),
         )
-        record_response(
-            instructions=None,
-            input=str(texts),
-            openai_response=response
-        )
-        return response
-    except Exception:
+    except OpenAIError as e:
+        if not OPENAI_MOCK_ON_FAILURE:
+            raise
         # Return a mocked embedding for development if OpenAI API fails
-        class MockEmbedding:
-            def __init__(self, embedding):
-                self.data = [{'embedding': embedding}]
-        return MockEmbedding([0.0] * 1536)  # Example: 1536-dim zero vector
+        logger.warning(
+            "OpenAI API call failed: %s, returning mock embedding.", e
+        )
+        return _mock_embedding(texts)
+    record_response(
+        instructions=None,
+        input=str(texts),
+        openai_response=response
+    )
+    return response
 
 
 def get_embedding_vector(texts: List[str]) -> List[List[float]]:
@@ -149,3 +259,386 @@ def get_embedding_vector(texts: List[str]) -> List[List[float]]:
     response = get_embedding(texts)
     return [entry.embedding for entry in response.data]  # type: ignore
     # TODO: Type is fine, I swear! Figure why VS Code disagrees
+
+
+async def get_response_async(
+    input: str | List[str],
+    *,
+    instructions: str | None = None,
+    tools: List[Any] | None = None,
+    max_output_tokens: int = 500,
+    model: str = "gpt-4.1-nano",
+    prompt_cache_key: str | None = None,
+):
+    """
+    Async variant of :func:`get_response`, using the ``AsyncOpenAI`` client.
+
+    Does not block the event loop while waiting on OpenAI, so a single
+    worker can keep many requests in flight at once.
+
+    :param input: The input text to send to the OpenAI API.
+    :type input: str or list[str]
+    :param instructions: Optional instructions for the response.
+    :type instructions: str, optional
+    :param tools: Optional callable tools to include in the request.
+    :type tools: list, optional
+    :param max_output_tokens: The maximum number of output tokens.
+    :type max_output_tokens: int, optional
+    :param model: The model to use for the response.
+        (Defaults to "gpt-4.1-nano".)
+    :type model: str, optional
+    :param prompt_cache_key: Routes requests sharing a prompt prefix to
+        the same cache (see ``prompt_prefix``).
+    :type prompt_cache_key: str, optional
+    :returns: The response object from the OpenAI API.
+    :rtype: OpenAIResponse
+    """
+    from openai import NOT_GIVEN, OpenAIError
+    try:
+        response = await call_with_retries_async(
+            "responses",
+            lambda: _get_async_client().responses.create(
+                model=model,
+                instructions=(
+                    instructions if instructions is not None else NOT_GIVEN
+                ),
+                input=input,
+                tools=tools if tools is not None else NOT_GIVEN,
+                max_output_tokens=max_output_tokens,
+                prompt_cache_key=(
+                    prompt_cache_key if prompt_cache_key is not None
+                    else NOT_GIVEN
+                ),
+                timeout=OPENAI_RESPONSE_TIMEOUT_SECONDS,
+            ),
+            _estimate_response_tokens(input, instructions, max_output_tokens),
+        )
+    except OpenAIError as e:
+        if not OPENAI_MOCK_ON_FAILURE:
+            raise
+        # Return a mocked response for development if OpenAI API fails
+        logger.warning(
+            "OpenAI API call failed: %s, returning mock response.", e
+        )
+        return _mock_response(
+            "[MOCKED RESPONSE]"
+            f"\nCould not reach OpenAI: {e}."
+            f"\nInput was: {input}",
+            tool_call=tools is not None  # Mock tool call if tools given
+        )
+    await record_response_async(
+        instructions=instructions,
+        input=input,
+        openai_response=response
+    )
+    return response
+
+
+async def get_response_text_async(
+    input,
+    *,
+    instructions=None,
+    max_output_tokens=500,
+    model="gpt-4.1-nano",
+    prompt_cache_key=None,
+):
+    """
+    Async variant of :func:`get_response_text`.
+
+    :param input: The input text to send to the OpenAI API.
+    :type input: str or list[str]
+    :param instructions: Optional instructions for the response.
+    :type instructions: str, optional
+    :param max_output_tokens: The maximum number of output tokens.
+    :type max_output_tokens: int, optional
+    :param model: The model to use for the response.
+        (Defaults to "gpt-4.1-nano".)
+    :type model: str, optional
+    :param prompt_cache_key: Routes requests sharing a prompt prefix to
+        the same cache (see ``prompt_prefix``).
+    :type prompt_cache_key: str, optional
+    :returns: The response text from the OpenAI API.
+    :rtype: str
+    """
+    response = await get_response_async(
+        input,
+        instructions=instructions,
+        max_output_tokens=max_output_tokens,
+        model=model,
+        prompt_cache_key=prompt_cache_key,
+    )
+    return response.output_text
+
+
+async def stream_response_text_async(
+    input,
+    *,
+    instructions=None,
+    max_output_tokens=500,
+    model="gpt-4.1-nano",
+    prompt_cache_key=None,
+):
+    """
+    Stream a response text from the OpenAI API, as it's generated.
+
+    The usage is recorded once the stream completes.
+
+    :param input: The input text to send to the OpenAI API.
+    :type input: str or list[str]
+    :param instructions: Optional instructions for the response.
+    :type instructions: str, optional
+    :param max_output_tokens: The maximum number of output tokens.
+    :type max_output_tokens: int, optional
+    :param model: The model to use for the response.
+        (Defaults to "gpt-4.1-nano".)
+    :type model: str, optional
+    :param prompt_cache_key: Routes requests sharing a prompt prefix to
+        the same cache (see ``prompt_prefix``).
+    :type prompt_cache_key: str, optional
+    :returns: An async generator of response text deltas.
+    :rtype: AsyncIterator[str]
+    """
+    from openai import NOT_GIVEN, OpenAIError
+    async with AsyncExitStack() as stack:
+        try:
+            # Holds the call's slot until the stream is done with
+            stream = await stack.enter_async_context(
+                stream_with_retries_async(
+                    "responses",
+                    lambda: _get_async_client().responses.create(
+                        model=model,
+                        instructions=(
+                            instructions if instructions is not None
+                            else NOT_GIVEN
+                        ),
+                        input=input,
+                        max_output_tokens=max_output_tokens,
+                        prompt_cache_key=(
+                            prompt_cache_key if prompt_cache_key is not None
+                            else NOT_GIVEN
+                        ),
+                        stream=True,
+                        timeout=OPENAI_RESPONSE_TIMEOUT_SECONDS,
+                    ),
+                    _estimate_response_tokens(
+                        input, instructions, max_output_tokens
+                    ),
+                )
+            )
+        except OpenAIError as e:
+            if not OPENAI_MOCK_ON_FAILURE:
+                raise
+            # Return a mocked response for development if OpenAI API fails
+            logger.warning(
+                "OpenAI API call failed: %s, returning mock response.", e
+            )
+            yield _mock_response(
+                "[MOCKED RESPONSE]"
+                f"\nCould not reach OpenAI: {e}."
+                f"\nInput was: {input}"
+            ).output_text
+            return
+
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+            elif event.type == "response.completed":
+                # The final response carries the usage for the whole stream
+                await record_response_async(
+                    instructions=instructions,
+                    input=input,
+                    openai_response=event.response
+                )
+
+
+async def get_embedding_async(texts):
+    """
+    Async variant of :func:`get_embedding`.
+
+    :param texts: The texts to embed.
+    :type texts: List[str]
+    :returns: The reponse object from the OpenAI API.
+    :rtype: OpenAIResponse
+    """
+    from openai import OpenAIError
+    try:
+        response = await call_with_retries_async(
+            "embeddings",
+            lambda: _get_async_client().embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=texts,
+                timeout=OPENAI_EMBEDDING_TIMEOUT_SECONDS,
+            ),
+            _estimate_embedding_tokens(texts),
+        )
+    except OpenAIError as e:
+        if not OPENAI_MOCK_ON_FAILURE:
+            raise
+        # Return a mocked embedding for development if OpenAI API fails
+        logger.warning(
+            "OpenAI API call failed: %s, returning mock embedding.", e
+        )
+        return _mock_embedding(texts)
+    await record_response_async(
+        instructions=None,
+        input=str(texts),
+        openai_response=response
+    )
+    return response
+
+
+async def get_embedding_vector_async(texts: List[str]) -> List[List[float]]:
+    """
+    Async variant of :func:`get_embedding_vector`.
+
+    :param texts: The texts to embed.
+    :type texts: List[str]
+    :returns: The embedding vector as a list.
+    :rtype: list
+    """
+    response = await get_embedding_async(texts)
+    return [entry.embedding for entry in response.data]  # type: ignore
+
+
+def build_batch_request(
+    custom_id,
+    input,
+    *,
+    instructions=None,
+    tools=None,
+    max_output_tokens=500,
+    model="gpt-4.1-nano"
+):
+    """
+    Build one request of a Batch API input file, for the Responses API.
+
+    :param custom_id: An ID to match the request's result with.
+    :type custom_id: str
+    :param input: The input to send to the OpenAI API.
+    :type input: str or list
+    :param instructions: Optional instructions for the response.
+    :type instructions: str, optional
+    :param tools: Optional callable tools to include in the request.
+    :type tools: list, optional
+    :param max_output_tokens: The maximum number of output tokens.
+    :type max_output_tokens: int, optional
+    :param model: The model to use for the response.
+        (Defaults to "gpt-4.1-nano".)
+    :type model: str, optional
+    :returns: The request, as a line of the input file.
+    :rtype: dict
+    """
+    body = {
+        "model": model,
+        "input": input,
+        "max_output_tokens": max_output_tokens,
+    }
+    if instructions is not None:
+        body["instructions"] = instructions
+    if tools is not None:
+        body["tools"] = tools
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/responses",
+        "body": body,
+    }
+
+
+async def create_batch_async(requests):
+    """
+    Submit requests to the Batch API (half the price, results within 24h).
+
+    Unlike the other calls here, failures are raised rather than mocked,
+    since the caller has to know the batch wasn't submitted.
+
+    :param requests: The requests, from :func:`build_batch_request`.
+    :type requests: list[dict]
+    :returns: The batch object from the OpenAI API.
+    :rtype: Batch
+    """
+    batch_file = "".join(
+        json.dumps(request) + "\n" for request in requests
+    ).encode("utf-8")
+    uploaded_file = await call_with_retries_async(
+        "responses",
+        lambda: _get_async_client().files.create(
+            file=("batch.jsonl", batch_file),
+            purpose="batch",
+        ),
+    )
+    return await call_with_retries_async(
+        "responses",
+        lambda: _get_async_client().batches.create(
+            input_file_id=uploaded_file.id,
+            endpoint="/v1/responses",
+            completion_window="24h",
+        ),
+    )
+
+
+async def get_batch_async(batch_id):
+    """
+    Get the current state of a batch.
+
+    :param batch_id: The ID of the batch.
+    :type batch_id: str
+    :returns: The batch object from the OpenAI API.
+    :rtype: Batch
+    """
+    return await call_with_retries_async(
+        "responses", lambda: _get_async_client().batches.retrieve(batch_id)
+    )
+
+
+async def get_batch_results_async(batch, request_inputs):
+    """
+    Download the results of a finished batch, with records of their usage
+    (at the batch tier).
+
+    The usage isn't recorded here: the caller persists the records in the
+    same transaction as what it makes of the results (see
+    :func:`book_api.persistence.transition_bulk_job`), so that it's
+    recorded exactly once.
+
+    :param batch: The finished batch.
+    :type batch: Batch
+    :param request_inputs: The (instructions, input) of each request,
+        by custom ID, to record along with the usage.
+    :type request_inputs: dict[str, tuple]
+    :returns: A tuple of (the response of each request by custom ID, or
+        None for requests that failed; the usage records, as from
+        :func:`book_api.response_monitor.get_response_record`).
+    :rtype: tuple[dict[str, OpenAIResponse | None], list[dict]]
+    """
+    from openai.types.responses import Response
+    results = {}
+    records = []
+    # Failed requests are in the error file
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = await call_with_retries_async(
+            "responses", lambda: _get_async_client().files.content(file_id)
+        )
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            custom_id = result["custom_id"]
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                logger.warning(
+                    "Batch request %s failed: %s",
+                    custom_id, result.get("error") or response.get("body"),
+                )
+                results[custom_id] = None
+                continue
+            # Built leniently, like the client does with API responses
+            openai_response = Response.construct(**response["body"])
+            instructions, input = request_inputs.get(custom_id, (None, None))
+            records.append(get_response_record(
+                instructions, input, openai_response, batch=True
+            ))
+            results[custom_id] = openai_response
+    return results, records
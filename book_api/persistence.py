@@ -1,24 +1,40 @@
-from sqlite3 import connect
-
-DB_PATH = "book_api/persistence.db"
+from datetime import datetime, timezone
+from book_api.db_connections import get_connection_manager
 
 
 def get_db_connection():
-    """Create a database connection to the SQLite database."""
-    conn = connect(DB_PATH)
-    return conn
+    """
+    Get this thread's connection to the SQLite database.
+
+    Connections are long-lived and shared (see ``db_connections``), so
+    don't close them. Using one as a context manager commits (or rolls
+    back) the transaction.
+    """
+    return get_connection_manager().get_connection()
+
+
+def close_db_connections():
+    """Close all connections to the SQLite database (on shutdown)."""
+    get_connection_manager().close_all()
 
 
 def setup_database():
-    """Create the necessary tables in the database."""
+    """
+    Create the necessary tables in the database.
+
+    Runs in one write transaction, taken up front, so that when several
+    worker processes start at once, only the first one creates (and
+    backfills) anything; the others wait, then find it all there.
+    """
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        # Usage only, so scans stay narrow
+        # (Databases created before response_texts existed still have
+        # instructions/input/output columns here, see handy_scripts/update.py)
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS responses (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            instructions TEXT,
-            input TEXT,
-            output TEXT,
             model TEXT NOT NULL,
             cached_input_tokens INTEGER NOT NULL,
             uncached_input_tokens INTEGER NOT NULL,
@@ -28,6 +44,97 @@ def setup_database():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
         ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_responses_timestamp
+        ON responses (timestamp)
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_responses_model
+        ON responses (model)
+        ''')
+        # The bulky text of each response, kept apart from the usage
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_texts (
+            response_id INTEGER PRIMARY KEY REFERENCES responses (id),
+            instructions TEXT,
+            input TEXT,
+            output TEXT
+        )
+        ''')
+        # Usage summed per hour, model and tier, maintained as responses
+        # are persisted (so cost reports don't scan all responses)
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master"
+            " WHERE type = 'table' AND name = 'usage_rollups'"
+        )
+        rollups_existed = cursor.fetchone() is not None
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_rollups (
+            hour DATETIME NOT NULL,
+            model TEXT NOT NULL,
+            batch BOOLEAN NOT NULL,
+            request_count INTEGER NOT NULL,
+            cached_input_tokens INTEGER NOT NULL,
+            uncached_input_tokens INTEGER NOT NULL,
+            reasoning_output_tokens INTEGER NOT NULL,
+            nonreasoning_output_tokens INTEGER NOT NULL,
+            PRIMARY KEY (hour, model, batch)
+        )
+        ''')
+        if not rollups_existed:
+            # Backfill from any responses persisted before rollups existed
+            cursor.execute('''
+            INSERT OR IGNORE INTO usage_rollups
+            SELECT strftime('%Y-%m-%d %H:00:00', timestamp), model, batch,
+                   COUNT(*),
+                   SUM(cached_input_tokens),
+                   SUM(uncached_input_tokens),
+                   SUM(reasoning_output_tokens),
+                   SUM(nonreasoning_output_tokens)
+            FROM responses
+            GROUP BY 1, model, batch
+            ''')
+        # Embeddings are stored as raw float32 bytes
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            model TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            PRIMARY KEY (model, text_hash)
+        )
+        ''')
+        # What's currently loaded in ChromaDB (ID -> content hash)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS library_manifest (
+            id TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL
+        )
+        ''')
+        # Bulk recommendation jobs (see bulk_jobs), and their prompts
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bulk_jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            response_mode TEXT NOT NULL,
+            prompt_count INTEGER NOT NULL,
+            theme_batch_id TEXT,
+            format_batch_id TEXT,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bulk_job_prompts (
+            job_id TEXT NOT NULL REFERENCES bulk_jobs (id),
+            prompt_index INTEGER NOT NULL,
+            prompt TEXT NOT NULL,
+            books TEXT,
+            response TEXT,
+            error TEXT,
+            PRIMARY KEY (job_id, prompt_index)
+        )
+        ''')
         conn.commit()
 
 
@@ -39,23 +146,442 @@ def persist_response(response):
         response (dict): A dictionary containing the response statistics.
     """
     with get_db_connection() as conn:
-        cursor = conn.cursor()
+        persist_responses([response], conn)
+
+
+def persist_responses(responses, conn):
+    """
+    Persist several responses' statistics in a single transaction,
+    updating the usage rollups in the same transaction.
+
+    Args:
+        responses (list[dict]): Dictionaries containing the response
+            statistics.
+        conn (sqlite3.Connection): The connection to write with.
+    """
+    cursor = conn.cursor()
+    texts = []
+    rollups = {}  # (hour, model, batch) -> summed usage
+    for response in responses:
+        timestamp = response.get("timestamp") or _utc_now()
+        usage = (
+            response.get("cached_input_tokens", 0),
+            response.get("uncached_input_tokens", 0),
+            response.get("reasoning_output_tokens", 0),
+            response.get("nonreasoning_output_tokens", 0),
+        )
+        model = response.get("model", "unknown")
+        batch = bool(response.get("batch", False))
         cursor.execute('''
         INSERT INTO responses (
-            instructions, input, output, model,
+            model,
             cached_input_tokens, uncached_input_tokens,
             reasoning_output_tokens, nonreasoning_output_tokens,
-            batch
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+            batch, timestamp
+        ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (model, *usage, batch, timestamp))
+        texts.append((
+            cursor.lastrowid,
             response.get("instructions", None),
             response.get("input", None),
             response.get("output", None),
-            response.get("model", "unknown"),
-            response.get("cached_input_tokens", 0),
-            response.get("uncached_input_tokens", 0),
-            response.get("reasoning_output_tokens", 0),
-            response.get("nonreasoning_output_tokens", 0),
-            response.get("batch", False),
         ))
+
+        key = (timestamp[:13] + ":00:00", model, batch)
+        summed = rollups.get(key, (0, 0, 0, 0, 0))
+        rollups[key] = (summed[0] + 1, *(
+            summed_tokens + tokens
+            for summed_tokens, tokens in zip(summed[1:], usage)
+        ))
+
+    cursor.executemany('''
+    INSERT INTO response_texts (response_id, instructions, input, output)
+    VALUES (?, ?, ?, ?)
+    ''', texts)
+    cursor.executemany('''
+    INSERT INTO usage_rollups (
+        hour, model, batch, request_count,
+        cached_input_tokens, uncached_input_tokens,
+        reasoning_output_tokens, nonreasoning_output_tokens
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (hour, model, batch) DO UPDATE SET
+        request_count = request_count + excluded.request_count,
+        cached_input_tokens =
+            cached_input_tokens + excluded.cached_input_tokens,
+        uncached_input_tokens =
+            uncached_input_tokens + excluded.uncached_input_tokens,
+        reasoning_output_tokens =
+            reasoning_output_tokens + excluded.reasoning_output_tokens,
+        nonreasoning_output_tokens =
+            nonreasoning_output_tokens + excluded.nonreasoning_output_tokens
+    ''', [key + summed for key, summed in rollups.items()])
+    conn.commit()
+
+
+def _utc_now():
+    """The current UTC time, formatted like SQLite's CURRENT_TIMESTAMP."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _hour_range(start, end):
+    """
+    Build the WHERE clause (and its parameters) selecting rollup hours
+    from ``start`` (rounded down to the hour) to ``end``.
+    """
+    conditions = []
+    parameters = []
+    if start is not None:
+        conditions.append("hour >= strftime('%Y-%m-%d %H:00:00', ?)")
+        parameters.append(start)
+    if end is not None:
+        conditions.append("hour < datetime(?)")
+        parameters.append(end)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, parameters
+
+
+def get_usage_rollups(start=None, end=None):
+    """
+    Get usage summed per model and tier from the hourly rollups.
+
+    :param start: Only include hours from this UTC time on
+        (e.g. "2025-01-31" or "2025-01-31 14:00:00"),
+        rounded down to the hour.
+    :type start: str, optional
+    :param end: Only include hours starting before this UTC time.
+    :type end: str, optional
+    :returns: Rows of (model, batch, request count, uncached input tokens,
+        cached input tokens, reasoning output tokens,
+        non-reasoning output tokens).
+    :rtype: list[tuple]
+    """
+    where, parameters = _hour_range(start, end)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT model, batch,
+               SUM(request_count),
+               SUM(uncached_input_tokens),
+               SUM(cached_input_tokens),
+               SUM(reasoning_output_tokens),
+               SUM(nonreasoning_output_tokens)
+        FROM usage_rollups
+        {where}
+        GROUP BY model, batch
+        ''', parameters)
+        return cursor.fetchall()
+
+
+# How to truncate rollup hours to each period
+PERIOD_FORMATS = {
+    "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d",
+    "week": "%Y-%W",
+    "month": "%Y-%m",
+}
+
+
+def get_usage_rollups_by_period(period, start=None, end=None):
+    """
+    Get usage summed per period, model and tier from the hourly rollups.
+
+    :param period: "hour", "day", "week" or "month".
+    :type period: str
+    :param start: As for :func:`get_usage_rollups`.
+    :type start: str, optional
+    :param end: As for :func:`get_usage_rollups`.
+    :type end: str, optional
+    :returns: Rows of (period, followed by the same as
+        :func:`get_usage_rollups`), oldest first.
+    :rtype: list[tuple]
+    """
+    where, parameters = _hour_range(start, end)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT strftime(?, hour), model, batch,
+               SUM(request_count),
+               SUM(uncached_input_tokens),
+               SUM(cached_input_tokens),
+               SUM(reasoning_output_tokens),
+               SUM(nonreasoning_output_tokens)
+        FROM usage_rollups
+        {where}
+        GROUP BY 1, model, batch
+        ORDER BY 1, model, batch
+        ''', [PERIOD_FORMATS[period], *parameters])
+        return cursor.fetchall()
+
+
+def get_cached_embeddings(model, text_hashes):
+    """
+    Get cached embeddings for the given text hashes.
+
+    :param model: The embedding model name.
+    :type model: str
+    :param text_hashes: The SHA-256 hex digests of the texts.
+    :type text_hashes: list[str]
+    :returns: A mapping of text hash to raw float32 embedding bytes,
+        for the hashes found in the cache.
+    :rtype: dict[str, bytes]
+    """
+    found = {}
+    chunk_size = 500  # Stay well below SQLite's bound parameter limit
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(text_hashes), chunk_size):
+            chunk = text_hashes[start:start + chunk_size]
+            placeholders = ", ".join("?" for _ in chunk)
+            cursor.execute(f'''
+            SELECT text_hash, embedding FROM embedding_cache
+            WHERE model = ? AND text_hash IN ({placeholders})
+            ''', (model, *chunk))
+            found.update(cursor.fetchall())
+    return found
+
+
+def persist_embeddings(model, embeddings):
+    """
+    Persist embeddings in the embedding cache.
+
+    :param model: The embedding model name.
+    :type model: str
+    :param embeddings: A mapping of text hash to raw float32 embedding bytes.
+    :type embeddings: dict[str, bytes]
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+        INSERT OR REPLACE INTO embedding_cache (model, text_hash, embedding)
+        VALUES (?, ?, ?)
+        ''', [
+            (model, text_hash, embedding)
+            for text_hash, embedding in embeddings.items()
+        ])
+        conn.commit()
+
+
+def get_library_manifest():
+    """
+    Get the library manifest (what's currently loaded in ChromaDB).
+
+    :returns: A mapping of ChromaDB ID to content hash.
+    :rtype: dict[str, str]
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, content_hash FROM library_manifest")
+        return dict(cursor.fetchall())
+
+
+def update_library_manifest(upserted, removed_ids, *, replace=False):
+    """
+    Update the library manifest in a single transaction.
+
+    :param upserted: A mapping of ChromaDB ID to content hash
+        for added or changed entries.
+    :type upserted: dict[str, str]
+    :param removed_ids: The IDs of removed entries.
+    :type removed_ids: list[str]
+    :param replace: Whether to drop all existing entries first.
+    :type replace: bool
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if replace:
+            cursor.execute("DELETE FROM library_manifest")
+        cursor.executemany(
+            "DELETE FROM library_manifest WHERE id = ?",
+            [(entry_id,) for entry_id in removed_ids]
+        )
+        cursor.executemany('''
+        INSERT OR REPLACE INTO library_manifest (id, content_hash)
+        VALUES (?, ?)
+        ''', list(upserted.items()))
+        conn.commit()
+
+
+BULK_JOB_FIELDS = (
+    "id", "status", "response_mode", "prompt_count",
+    "theme_batch_id", "format_batch_id", "error", "created_at", "updated_at",
+)
+
+
+def create_bulk_job(job_id, status, response_mode, prompts, theme_batch_id):
+    """
+    Persist a new bulk job, with its prompts, in a single transaction.
+
+    :param job_id: The ID of the job.
+    :type job_id: str
+    :param status: The initial status of the job.
+    :type status: str
+    :param response_mode: How to format the recommendations.
+    :type response_mode: str
+    :param prompts: The prompts to recommend books for.
+    :type prompts: list[str]
+    :param theme_batch_id: The ID of the theme extraction batch.
+    :type theme_batch_id: str
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT INTO bulk_jobs (
+            id, status, response_mode, prompt_count, theme_batch_id
+        ) VALUES (?, ?, ?, ?, ?)
+        ''', (job_id, status, response_mode, len(prompts), theme_batch_id))
+        cursor.executemany('''
+        INSERT INTO bulk_job_prompts (job_id, prompt_index, prompt)
+        VALUES (?, ?, ?)
+        ''', [(job_id, index, prompt) for index, prompt in enumerate(prompts)])
+        conn.commit()
+
+
+def get_bulk_job(job_id):
+    """
+    Get a bulk job.
+
+    :param job_id: The ID of the job.
+    :type job_id: str
+    :returns: The job's fields (see ``BULK_JOB_FIELDS``),
+        or None if there is no such job.
+    :rtype: dict or None
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT {', '.join(BULK_JOB_FIELDS)} FROM bulk_jobs WHERE id = ?",
+            (job_id,)
+        )
+        row = cursor.fetchone()
+    return dict(zip(BULK_JOB_FIELDS, row)) if row is not None else None
+
+
+def get_bulk_job_ids(statuses):
+    """Get the IDs of the bulk jobs with any of the given statuses."""
+    placeholders = ", ".join("?" for _ in statuses)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT id FROM bulk_jobs WHERE status IN ({placeholders})"
+            " ORDER BY created_at",
+            tuple(statuses)
+        )
+        return [job_id for job_id, in cursor.fetchall()]
+
+
+def claim_bulk_job(job_id, from_status, claimed_status, stale_after_seconds):
+    """
+    Claim a bulk job for one worker to move on, across processes: set its
+    status to ``claimed_status``, if it still has ``from_status`` (compare
+    and set). A claim older than ``stale_after_seconds`` (e.g. of a
+    worker that died) is taken over.
+
+    :param job_id: The ID of the job.
+    :type job_id: str
+    :param from_status: The status the job must have.
+    :type from_status: str
+    :param claimed_status: The status marking the job as claimed.
+    :type claimed_status: str
+    :param stale_after_seconds: How long a claim holds.
+    :type stale_after_seconds: float
+    :returns: When it was claimed (with microseconds, to tell claims
+        apart, see :func:`transition_bulk_job`), or None if it couldn't be.
+    :rtype: str or None
+    """
+    claimed_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        UPDATE bulk_jobs SET status = ?, updated_at = ?
+        WHERE id = ? AND (
+            status = ?
+            OR (status = ? AND updated_at < datetime('now', ?))
+        )
+        ''', (
+            claimed_status, claimed_at, job_id,
+            from_status, claimed_status, f"-{stale_after_seconds} seconds",
+        ))
+        claimed = cursor.rowcount == 1
         conn.commit()
+    return claimed_at if claimed else None
+
+
+def transition_bulk_job(
+    job_id, from_status, results=(), responses=(), *, claimed_at=None,
+    **fields
+):
+    """
+    Move a bulk job on from a status, in a single transaction: update its
+    fields (e.g. its status), record results for some of its prompts, and
+    persist the usage of the batch responses they came from.
+
+    Nothing is written unless the job still has ``from_status`` (compare
+    and set), so a transition never happens twice, and the usage is
+    recorded exactly once along with it.
+
+    :param job_id: The ID of the job.
+    :type job_id: str
+    :param from_status: The status the job must have.
+    :type from_status: str
+    :param results: Tuples of (prompt index, books JSON, response, error).
+    :type results: list[tuple]
+    :param responses: The response statistics to persist (see
+        :func:`persist_responses`).
+    :type responses: list[dict]
+    :param claimed_at: If the job was claimed (see
+        :func:`claim_bulk_job`), when, so it's only moved on under that
+        claim (not if it went stale and was taken over).
+    :type claimed_at: str, optional
+    :param fields: The fields to update, and their new values.
+    :returns: Whether the job was moved on.
+    :rtype: bool
+    """
+    assignments = ", ".join(f"{field} = ?" for field in fields)
+    conditions = "id = ? AND status = ?"
+    parameters = (*fields.values(), job_id, from_status)
+    if claimed_at is not None:
+        conditions += " AND updated_at = ?"
+        parameters += (claimed_at,)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(
+            f"UPDATE bulk_jobs SET {assignments},"
+            f" updated_at = CURRENT_TIMESTAMP WHERE {conditions}",
+            parameters
+        )
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return False
+        cursor.executemany('''
+        UPDATE bulk_job_prompts
+        SET books = ?, response = ?, error = ?
+        WHERE job_id = ? AND prompt_index = ?
+        ''', [
+            (books, response, error, job_id, prompt_index)
+            for prompt_index, books, response, error in results
+        ])
+        persist_responses(responses, conn)
+        conn.commit()
+    return True
+
+
+def get_bulk_job_prompts(job_id):
+    """
+    Get a bulk job's prompts, with their results so far.
+
+    :param job_id: The ID of the job.
+    :type job_id: str
+    :returns: Rows of (prompt index, prompt, books JSON, response,
+        error), in prompt order.
+    :rtype: list[tuple]
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT prompt_index, prompt, books, response, error
+        FROM bulk_job_prompts
+        WHERE job_id = ?
+        ORDER BY prompt_index
+        ''', (job_id,))
+        return cursor.fetchall()
@@ -0,0 +1,22 @@
+from os import getenv
+
+DB_PATH = getenv("DB_PATH", "book_api/persistence.db")
+
+# Write-behind queue for response statistics
+RESPONSE_QUEUE_MAX_SIZE = int(getenv("RESPONSE_QUEUE_MAX_SIZE", "10000"))
+RESPONSE_WRITE_BATCH_SIZE = int(getenv("RESPONSE_WRITE_BATCH_SIZE", "500"))
+# How long the writer waits for more records before writing a batch
+RESPONSE_WRITE_INTERVAL_SECONDS = float(
+    getenv("RESPONSE_WRITE_INTERVAL_SECONDS", "0.5")
+)
+
+# SQLite connection settings (one long-lived connection per thread)
+SQLITE_BUSY_TIMEOUT_MS = int(getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# NORMAL is safe with WAL: a power loss may lose the last transactions,
+# but never corrupts the database
+SQLITE_SYNCHRONOUS = getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE_KB = int(getenv("SQLITE_CACHE_SIZE_KB", "20000"))
+# Prepared statements kept per connection (sqlite3's statement cache)
+SQLITE_STATEMENT_CACHE_SIZE = int(
+    getenv("SQLITE_STATEMENT_CACHE_SIZE", "256")
+)
@@ -0,0 +1,74 @@
+import re
+
+COSTS_PER_1M_TOKENS = {
+    "gpt-4.1-nano": {
+        "regular": {
+            "uncached_input": 0.10,
+            "cached_input": 0.025,
+            "output": 0.40,
+        },
+        "batch": {
+            "uncached_input": 0.05,
+            "output": 0.20,
+        }
+    },
+    "text-embedding-3-small": {
+        "regular": {
+            "uncached_input": 0.02,
+        },
+        "batch": {
+            "uncached_input": 0.01,
+        }
+    }
+}
+CURRENCY = "USD"
+
+# Which price applies to each kind of token
+PRICE_FOR_TOKEN_TYPE = {
+    "uncached_input": "uncached_input",
+    "cached_input": "cached_input",
+    "nonreasoning_output": "output",
+    "reasoning_output": "output",
+}
+
+
+def normalize_model_name(model):
+    """
+    Strip the datestamp from a model name, to look up its pricing.
+
+    Model names get persisted with full datestamp
+    (e.g. "gpt-4.1-nano-2025-04-14"). If no datestamp, the model name
+    is returned unchanged.
+    """
+    datestamp_pattern = r"-\d{4}-\d{2}-\d{2}$"
+    return re.sub(datestamp_pattern, "", model)
+
+
+def cost_for_tokens(tokens, cost_per_million):
+    return (tokens / 1_000_000) * cost_per_million
+
+
+def get_token_costs(model, tier, token_counts):
+    """
+    Compute the cost of each kind of token used.
+
+    :param model: The (normalized) model name.
+    :type model: str
+    :param tier: "regular" or "batch".
+    :type tier: str
+    :param token_counts: Token counts by kind ("uncached_input",
+        "cached_input", "nonreasoning_output", "reasoning_output").
+    :type token_counts: dict[str, int]
+    :returns: Costs by kind of token, or None if there's no pricing
+        for this model and tier.
+    :rtype: dict[str, float] or None
+    """
+    pricing = COSTS_PER_1M_TOKENS.get(model, {}).get(tier)
+    if pricing is None:
+        return None
+    return {
+        token_type: cost_for_tokens(
+            tokens, pricing.get(PRICE_FOR_TOKEN_TYPE[token_type], 0)
+        )
+        for token_type, tokens in token_counts.items()
+    }
@@ -0,0 +1,101 @@
+import logging
+from book_api.chroma_db_setup import iter_summaries_txt
+from book_api.rag_config import (
+    PROMPT_CACHE_KEY,
+    PROMPT_CACHE_MIN_TOKENS,
+    PROMPT_CATALOGUE_DIGEST_ENABLED,
+    PROMPT_CATALOGUE_DIGEST_MAX_TOKENS,
+)
+from book_api.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+_catalogue_digest = ""  # Built from summaries.txt, see below
+
+
+def build_catalogue_digest(entries, min_tokens, max_tokens):
+    """
+    Build a digest of the library: every book's title and author, then,
+    while still under ``min_tokens``, their summaries.
+
+    Books are sorted, so the digest is the same in every process
+    (whatever order the library is read in).
+
+    :param entries: The library's (title, author, summary) entries.
+    :type entries: Iterable[tuple[str, str, str]]
+    :param min_tokens: Add summaries until the digest is this long.
+    :type min_tokens: int
+    :param max_tokens: Leave books (or summaries) out past this length.
+    :type max_tokens: int
+    :rtype: str
+    """
+    entries = sorted(entries)
+    lines = []
+    n_tokens = 0
+    for title, author, _ in entries:
+        line = f"- {title} by {author}"
+        n_tokens += count_tokens(line) + 1  # And the newline
+        if n_tokens > max_tokens:
+            logger.warning(
+                "Catalogue digest cut short at %d of %d books.",
+                len(lines), len(entries),
+            )
+            break
+        lines.append(line)
+    digest = "Books in the library:\n" + "\n".join(lines)
+    for index, (_, _, summary) in enumerate(entries[:len(lines)]):
+        if count_tokens(digest) >= min_tokens:
+            break
+        lines[index] += f": {' '.join(summary.split())}"
+        padded_digest = "Books in the library:\n" + "\n".join(lines)
+        if count_tokens(padded_digest) > max_tokens:
+            break
+        digest = padded_digest
+    return digest
+
+
+def refresh_catalogue_digest():
+    """(Re)build the catalogue digest from summaries.txt, if enabled."""
+    global _catalogue_digest
+    if not PROMPT_CATALOGUE_DIGEST_ENABLED:
+        return
+    _catalogue_digest = build_catalogue_digest(
+        iter_summaries_txt(),
+        PROMPT_CACHE_MIN_TOKENS,
+        PROMPT_CATALOGUE_DIGEST_MAX_TOKENS,
+    )
+    digest_tokens = count_tokens(_catalogue_digest)
+    if digest_tokens < PROMPT_CACHE_MIN_TOKENS:
+        logger.info(
+            "Catalogue digest is %d tokens, too short to be cached.",
+            digest_tokens,
+        )
+
+
+def with_catalogue_digest(instructions):
+    """
+    Append the catalogue digest (if enabled) to fixed instructions.
+
+    The instructions directly follow the tools in a prompt, so together
+    they're a prefix shared by every request, which OpenAI caches once
+    it's long enough. Anything varying goes in the input, after them.
+
+    :param instructions: The fixed instructions for a call.
+    :type instructions: str
+    :rtype: str
+    """
+    if not _catalogue_digest:
+        return instructions
+    return f"{instructions}\n\n{_catalogue_digest}"
+
+
+def prompt_cache_key(call):
+    """
+    Get the prompt cache key for a kind of call, so requests sharing
+    its prefix are routed to the same cache.
+
+    :param call: The kind of call (e.g. "identify-themes").
+    :type call: str
+    :rtype: str
+    """
+    return f"{PROMPT_CACHE_KEY}-{call}"
@@ -0,0 +1,135 @@
+from os import getenv
+from book_api.formatting import RESPONSE_MODES
+
+# How to format recommendations by default (can be overridden per request):
+# "llm" has the LLM format them, "markdown" renders them locally,
+# "json" returns just the structured results
+RESPONSE_MODE = getenv("RESPONSE_MODE", "llm")
+if RESPONSE_MODE not in RESPONSE_MODES:
+    raise ValueError(
+        f"RESPONSE_MODE must be one of {RESPONSE_MODES}, got {RESPONSE_MODE}"
+    )
+
+# Semantic response cache (in front of get_book_recommendation)
+SEMANTIC_CACHE_ENABLED = (
+    getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+)
+# Minimum cosine similarity between prompt embeddings to count as a hit
+SEMANTIC_CACHE_THRESHOLD = float(getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_TTL_SECONDS = float(
+    getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600")
+)
+SEMANTIC_CACHE_MAX_ENTRIES = int(getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+
+# Embedding cache (in-process LRU tier in front of the SQLite tier)
+EMBEDDING_CACHE_ENABLED = (
+    getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+)
+EMBEDDING_CACHE_MAX_ENTRIES = int(
+    getenv("EMBEDDING_CACHE_MAX_ENTRIES", "10000")
+)
+
+# Request coalescing: concurrent identical requests (same normalized
+# prompt) and embedding requests share one in-flight computation
+COALESCING_ENABLED = getenv("COALESCING_ENABLED", "true").lower() == "true"
+
+# Theme extraction fast path: query ChromaDB with the prompt itself, and
+# only fall back to the tool-calling LLM if the best match isn't close enough
+THEME_FAST_PATH_ENABLED = (
+    getenv("THEME_FAST_PATH_ENABLED", "false").lower() == "true"
+)
+# Maximum cosine distance of the best match to trust the fast path
+THEME_FAST_PATH_MAX_DISTANCE = float(
+    getenv("THEME_FAST_PATH_MAX_DISTANCE", "0.6")
+)
+# Only short prompts are tried on the fast path
+THEME_FAST_PATH_MAX_WORDS = int(getenv("THEME_FAST_PATH_MAX_WORDS", "12"))
+THEME_FAST_PATH_N_RESULTS = int(getenv("THEME_FAST_PATH_N_RESULTS", "3"))
+
+# Prompt caching: OpenAI caches prompt prefixes (tools, then instructions,
+# then input) of 1024+ tokens, at a quarter of the input price
+# Requests with the same key are routed to the same cache
+PROMPT_CACHE_KEY = getenv("PROMPT_CACHE_KEY", "book-recommendations")
+PROMPT_CACHE_MIN_TOKENS = int(getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+# Append a digest of the library to the theme extraction instructions,
+# padded (with summaries) past PROMPT_CACHE_MIN_TOKENS so it gets cached
+# (Only saves money if the prompt was close to the threshold already,
+# but also tells the LLM what's actually in the library)
+PROMPT_CATALOGUE_DIGEST_ENABLED = (
+    getenv("PROMPT_CATALOGUE_DIGEST_ENABLED", "false").lower() == "true"
+)
+PROMPT_CATALOGUE_DIGEST_MAX_TOKENS = int(
+    getenv("PROMPT_CATALOGUE_DIGEST_MAX_TOKENS", "4096")
+)
+
+# Hybrid retrieval: a BM25 index of titles, authors and summaries, next to
+# the vector search. Exact title/author matches are answered without
+# embedding anything; other queries fuse the lexical and vector rankings
+# with reciprocal rank fusion
+LEXICAL_RETRIEVAL_ENABLED = (
+    getenv("LEXICAL_RETRIEVAL_ENABLED", "true").lower() == "true"
+)
+# Reciprocal rank fusion constant (higher flattens the rank weights)
+RRF_K = int(getenv("RRF_K", "60"))
+# Most books recommended for a prompt naming a title or author
+EXACT_MATCH_MAX_RESULTS = int(getenv("EXACT_MATCH_MAX_RESULTS", "5"))
+
+# Where the lexical index is stored (memory-mapped, so worker processes
+# share one copy)
+LEXICAL_INDEX_DIR = getenv("LEXICAL_INDEX_DIR", "book_api/lexical_index")
+
+# Most books retrieved per tool call, whatever the model asks for
+MAX_N_RESULTS = int(getenv("MAX_N_RESULTS", "10"))
+# Token budget for the book summaries sent to the formatting call;
+# summaries are trimmed (longest first) to fit
+FORMATTING_CONTEXT_MAX_TOKENS = int(
+    getenv("FORMATTING_CONTEXT_MAX_TOKENS", "2000")
+)
+
+# Retrieval backend: "chroma" queries the ChromaDB server, "numpy" an
+# in-process, memory-mapped index built from the same embeddings
+RETRIEVAL_BACKEND = getenv("RETRIEVAL_BACKEND", "chroma")
+if RETRIEVAL_BACKEND not in ("chroma", "numpy"):
+    raise ValueError(
+        "RETRIEVAL_BACKEND must be 'chroma' or 'numpy',"
+        f" got {RETRIEVAL_BACKEND}"
+    )
+VECTOR_INDEX_DIR = getenv("VECTOR_INDEX_DIR", "book_api/vector_index")
+
+# Neighbour table: every book's nearest neighbours ("more like <title>")
+# and theme clusters with representative books, precomputed from the
+# vector index whenever the library changes
+NEIGHBOUR_TABLE_DIR = getenv("NEIGHBOUR_TABLE_DIR", "book_api/neighbour_table")
+NEIGHBOURS_PER_BOOK = int(getenv("NEIGHBOURS_PER_BOOK", "10"))
+# Number of theme clusters (0 picks one from the library size)
+THEME_CLUSTER_COUNT = int(getenv("THEME_CLUSTER_COUNT", "0"))
+THEME_CLUSTER_REPRESENTATIVES = int(
+    getenv("THEME_CLUSTER_REPRESENTATIVES", "5")
+)
+# Serve theme queries close enough to a cluster's centroid from its
+# representatives, without querying the retrieval backend
+MATERIALIZED_THEMES_ENABLED = (
+    getenv("MATERIALIZED_THEMES_ENABLED", "false").lower() == "true"
+)
+MATERIALIZED_THEMES_MIN_SIMILARITY = float(
+    getenv("MATERIALIZED_THEMES_MIN_SIMILARITY", "0.8")
+)
+
+# Lock files, so only one worker process syncs the library and builds
+# the indexes at a time
+LOCK_DIR = getenv("LOCK_DIR", "book_api/locks")
+
+# Bulk recommendation jobs (through the Batch API, see bulk_jobs)
+# (The Batch API takes at most 50,000 requests per batch)
+BULK_JOB_MAX_PROMPTS = int(getenv("BULK_JOB_MAX_PROMPTS", "50000"))
+# How often the API checks on running jobs' batches
+BULK_JOB_POLL_INTERVAL_SECONDS = float(
+    getenv("BULK_JOB_POLL_INTERVAL_SECONDS", "60")
+)
+# How long a worker's claim on a job it's moving on holds; after that
+# (e.g. if the worker died), another worker takes the job over
+BULK_JOB_CLAIM_TIMEOUT_SECONDS = float(
+    getenv("BULK_JOB_CLAIM_TIMEOUT_SECONDS", "3600")
+)
+# Tool calls answered per embedding request and query, during retrieval
+BULK_RETRIEVAL_CHUNK_SIZE = int(getenv("BULK_RETRIEVAL_CHUNK_SIZE", "256"))
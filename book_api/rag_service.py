@@ -1,6 +1,43 @@
 import json
-from book_api.open_ai_service import get_response, get_response_text
-from book_api.chroma_db_service import get_book_by_themes
+from itertools import zip_longest
+from book_api.open_ai_service import (
+    get_response_async,
+    get_response_text_async,
+    stream_response_text_async,
+)
+from book_api.embedding_cache import get_embedding_vector_async
+from book_api.chroma_db_service import (
+    get_books_by_theme_groups,
+    get_books_by_embedding,
+)
+from book_api.context_builder import (
+    build_books_context,
+    build_tool_call_context,
+    clamp_n_results,
+    function_call_items,
+    record_context_report,
+)
+from book_api.formatting import format_books_markdown, unique_books
+from book_api.lexical_index import get_lexical_index
+from book_api.neighbour_table import get_neighbour_table
+from book_api.rag_config import (
+    COALESCING_ENABLED,
+    EXACT_MATCH_MAX_RESULTS,
+    LEXICAL_RETRIEVAL_ENABLED,
+    MAX_N_RESULTS,
+    NEIGHBOURS_PER_BOOK,
+    SEMANTIC_CACHE_ENABLED,
+    RESPONSE_MODE,
+    THEME_FAST_PATH_ENABLED,
+    THEME_FAST_PATH_MAX_DISTANCE,
+    THEME_FAST_PATH_MAX_WORDS,
+    THEME_FAST_PATH_N_RESULTS,
+)
+from book_api.prompt_prefix import prompt_cache_key, with_catalogue_digest
+from book_api.semantic_cache import get_semantic_cache
+from book_api.single_flight import get_single_flight
+from book_api.theme_extraction import extract_themes, record_retrieval_path
+from book_api.tracing import span
 
 
 # Define callable tools
@@ -22,8 +59,11 @@ tools = [
                 },
                 "n_results": {
                     "type": "integer",
+                    "minimum": 1,
+                    "maximum": MAX_N_RESULTS,
                     "description": (
-                        "The number of book summaries to retrieve (default 3)."
+                        "The number of book summaries to retrieve"
+                        f" (default 3, at most {MAX_N_RESULTS})."
                     ),
                     # Note: probably works without description too
                 },
@@ -34,28 +74,420 @@ tools = [
 ]
 
 
-def get_book_recommendation(user_input):
+instructions_identify_themes = (
+    "Based on the user's input, identify relevant themes"
+    " and call the appropriate tool to get book summaries."
+)
+instructions_format_recommendations = (
+    "Format the book recommendations into a user-friendly"
+    " format. Include title, author, and summary for each book."
+    " Do not change the content of the summaries."
+)
+
+
+async def get_book_recommendation(user_input, response_mode=None):
     """
-    Get formatted book recommendations based on user input.
+    Get book recommendations based on user input.
+
+    Every OpenAI, ChromaDB and persistence call on this path is awaited,
+    so concurrent requests don't block each other.
+
+    If the semantic cache is enabled, prompts similar enough to a recent
+    one are answered from the cache, without calling the LLM. If request
+    coalescing is enabled, concurrent requests for the same (normalized)
+    prompt share a single computation.
+
+    :param user_input: The user's prompt.
+    :type user_input: str
+    :param response_mode: "llm" to have the LLM format the response,
+        "markdown" to render it locally, or "json" for just the structured
+        results. (Defaults to the RESPONSE_MODE setting.)
+    :type response_mode: str, optional
+    :returns: A dict with the recommended "books" and, unless in "json"
+        mode, the formatted "response" text.
+    :rtype: dict
     """
-    input_list = [user_input]
+    response_mode = response_mode or RESPONSE_MODE
+    return await _coalesced(
+        "recommendation",
+        (normalize_prompt(user_input), response_mode),
+        lambda: _get_book_recommendation(user_input, response_mode),
+    )
 
-    # Step 1: Send user input to OpenAI and get tool call
-    instructions_identify_themes = (
-        "Based on the user's input, identify relevant themes"
-        " and call the appropriate tool to get book summaries."
+
+async def _get_book_recommendation(user_input, response_mode):
+    prompt_embedding, cached = await _lookup_cached_recommendation(
+        user_input, response_mode
+    )
+    if cached is not None:
+        return build_recommendation(
+            response_mode, cached["response"], cached["books"]
+        )
+
+    input_list, recommended_books, context_report = (
+        await _coalesced_retrieval(user_input, prompt_embedding)
+    )
+    final_response_text = None
+    if response_mode == "llm":
+        # Step 4: Pass summaries back to OpenAI for formatting
+        record_context_report(context_report)
+        with span("formatting_llm"):
+            final_response_text = await get_response_text_async(
+                input=input_list,
+                instructions=instructions_format_recommendations,
+                max_output_tokens=1000,
+                prompt_cache_key=prompt_cache_key("format-recommendations"),
+            )
+
+    _store_cached_recommendation(
+        prompt_embedding, final_response_text, recommended_books
+    )
+    return build_recommendation(
+        response_mode, final_response_text, recommended_books
+    )
+
+
+async def stream_book_recommendation(user_input, response_mode=None):
+    """
+    Stream book recommendations based on user input.
+
+    Yields ``(event, data)`` tuples: a "books" event with the retrieved
+    titles and authors as soon as retrieval is done, then "delta" events
+    with the formatted response text as it's produced. In "json" mode,
+    the "books" event carries the full structured results instead, and
+    there are no "delta" events.
+
+    The formatted response is streamed separately for each request, but
+    retrieval is coalesced like in :func:`get_book_recommendation`.
+    """
+    response_mode = response_mode or RESPONSE_MODE
+    prompt_embedding, cached = await _lookup_cached_recommendation(
+        user_input, response_mode
+    )
+    if cached is not None:
+        recommendation = build_recommendation(
+            response_mode, cached["response"], cached["books"]
+        )
+        async for event in _stream_recommendation(recommendation):
+            yield event
+        return
+
+    input_list, recommended_books, context_report = (
+        await _coalesced_retrieval(user_input, prompt_embedding)
+    )
+    if response_mode != "llm":
+        _store_cached_recommendation(
+            prompt_embedding, None, recommended_books
+        )
+        recommendation = build_recommendation(
+            response_mode, None, recommended_books
+        )
+        async for event in _stream_recommendation(recommendation):
+            yield event
+        return
+
+    yield "books", _titles_and_authors(recommended_books)
+
+    # Step 4: Stream the formatted summaries back from OpenAI
+    # (The span covers the whole stream, not just time to first token)
+    record_context_report(context_report)
+    response_text_parts = []
+    with span("formatting_llm"):
+        async for delta in stream_response_text_async(
+            input=input_list,
+            instructions=instructions_format_recommendations,
+            max_output_tokens=1000,
+            prompt_cache_key=prompt_cache_key("format-recommendations"),
+        ):
+            response_text_parts.append(delta)
+            yield "delta", delta
+
+    _store_cached_recommendation(
+        prompt_embedding, "".join(response_text_parts), recommended_books
+    )
+
+
+def build_recommendation(response_mode, llm_response_text, books):
+    """
+    Build a recommendation (as returned to users) in the given mode.
+
+    :param response_mode: "llm", "markdown" or "json".
+    :type response_mode: str
+    :param llm_response_text: The LLM formatted text ("llm" mode only).
+    :type llm_response_text: str or None
+    :param books: The recommended books.
+    :type books: list[dict]
+    :returns: A dict with the "books" and, unless in "json" mode,
+        the formatted "response" text.
+    :rtype: dict
+    """
+    books = unique_books(books)
+    if response_mode == "json":
+        return {"books": books}
+    if response_mode == "markdown":
+        return {"response": format_books_markdown(books), "books": books}
+    return {"response": llm_response_text, "books": books}
+
+
+def normalize_prompt(user_input):
+    """
+    Normalize a prompt (case and whitespace), so that prompts differing
+    only in those are coalesced.
+
+    :param user_input: The user's prompt.
+    :type user_input: str
+    :rtype: str
+    """
+    return " ".join(user_input.casefold().split())
+
+
+async def _coalesced(name, key, call):
+    """Await ``call()``, coalesced with identical calls if enabled."""
+    if not COALESCING_ENABLED:
+        return await call()
+    return await get_single_flight(name).run_async(key, call)
+
+
+async def _coalesced_retrieval(user_input, prompt_embedding):
+    return await _coalesced(
+        "retrieval",
+        normalize_prompt(user_input),
+        lambda: _retrieve_books(user_input, prompt_embedding),
+    )
+
+
+async def _stream_recommendation(recommendation):
+    """Stream an already complete recommendation."""
+    if "response" not in recommendation:  # "json" mode
+        yield "books", recommendation["books"]
+        return
+    yield "books", _titles_and_authors(recommendation["books"])
+    yield "delta", recommendation["response"]
+
+
+def _titles_and_authors(books):
+    return [
+        {"title": book["title"], "author": book["author"]}
+        for book in books
+    ]
+
+
+async def _lookup_cached_recommendation(user_input, response_mode):
+    """
+    Look up a recommendation in the semantic cache (if enabled).
+
+    Prompts naming a title or author skip it, since they're answered
+    without embedding anything (see :func:`_retrieve_books_exact_match`).
+
+    :returns: A tuple of (prompt embedding, cached recommendation),
+        either of which may be None.
+    """
+    if not SEMANTIC_CACHE_ENABLED or _exact_matches(user_input):
+        return None, None
+    prompt_embedding = (await get_embedding_vector_async([user_input]))[0]
+    with span("semantic_cache_lookup"):
+        cached = get_semantic_cache().lookup(prompt_embedding)
+    if (
+        cached is not None
+        and response_mode == "llm"
+        and cached["response"] is None
+    ):
+        # Only the books were cached (from a local formatting mode),
+        # so the LLM still has to format them
+        return prompt_embedding, None
+    return prompt_embedding, cached
+
+
+def _store_cached_recommendation(prompt_embedding, response_text, books):
+    if prompt_embedding is not None:
+        get_semantic_cache().store(
+            prompt_embedding, {"response": response_text, "books": books}
+        )
+
+
+async def _retrieve_books_fast_path(user_input, prompt_embedding=None):
+    """
+    Retrieve books by querying ChromaDB with the prompt itself,
+    skipping the tool-calling LLM round-trip.
+
+    :returns: A tuple of (the input list for the formatting call,
+        the recommended books, the context report), or None if the
+        prompt isn't eligible or the best match isn't close enough.
+    """
+    themes = extract_themes(user_input)
+    if not themes or len(user_input.split()) > THEME_FAST_PATH_MAX_WORDS:
+        record_retrieval_path("fast_path_skipped")
+        return None
+
+    if prompt_embedding is None:
+        prompt_embedding = (await get_embedding_vector_async([user_input]))[0]
+    recommended_books, distances = await get_books_by_embedding(
+        prompt_embedding, THEME_FAST_PATH_N_RESULTS
     )
-    response = get_response(
-        input=input_list,
-        instructions=instructions_identify_themes,
-        tools=tools,
-        max_output_tokens=100,  # Can it fit in 100 tokens?
+    if not distances or distances[0] > THEME_FAST_PATH_MAX_DISTANCE:
+        record_retrieval_path("fast_path_fallback")
+        return None
+
+    record_retrieval_path("fast_path")
+    input_list, context_report = build_books_context(
+        user_input, recommended_books
+    )
+    return input_list, recommended_books, context_report
+
+
+def _exact_matches(user_input):
+    """Book rows whose title or author the prompt names (if enabled)."""
+    if not LEXICAL_RETRIEVAL_ENABLED:
+        return []
+    return get_lexical_index().exact_matches(user_input)
+
+
+def _retrieve_books_exact_match(user_input):
+    """
+    Retrieve books for a prompt naming a title or author, from the
+    lexical index and the neighbour table: no embedding, no tool-calling
+    LLM round-trip.
+
+    A named author's books are recommended as they are ("anything by
+    Jane Austen"), but a named title is a seed ("something like
+    Dracula"): its nearest neighbours are recommended, not the book
+    itself.
+
+    :returns: A tuple of (the input list for the formatting call,
+        the recommended books, the context report), or None if the
+        prompt names none (or names a title, but the neighbour table
+        isn't loaded yet).
+    """
+    rows = _exact_matches(user_input)
+    if not rows:
+        return None
+    lexical_index = get_lexical_index()
+    named_books = [
+        lexical_index.books[row]
+        for row in lexical_index.title_matches(user_input)
+    ]
+    if named_books:
+        neighbour_table = get_neighbour_table()
+        if neighbour_table is None:
+            record_retrieval_path("exact_match_fallback")
+            return None
+        books = _neighbours_of(neighbour_table, named_books)
+        record_retrieval_path("title_neighbours")
+    else:
+        books = [lexical_index.books[row] for row in rows]
+        record_retrieval_path("exact_match")
+    named_keys = {(book["title"], book["author"]) for book in named_books}
+    recommended_books = unique_books([
+        book for book in books
+        if (book["title"], book["author"]) not in named_keys
+    ])[:EXACT_MATCH_MAX_RESULTS]
+    input_list, context_report = build_books_context(
+        user_input, recommended_books
     )
-    input_list.append(response.output)
-    # TODO: do we need *all* the output?
-    # (If not, we could save tokens by passing only relevant bits.)
+    return input_list, recommended_books, context_report
+
+
+def _neighbours_of(neighbour_table, named_books):
+    """
+    The named books' nearest neighbours, closest first (taking turns
+    between the named books), as book dicts.
+    """
+    neighbours_per_book = []
+    for named_book in named_books:
+        for row in neighbour_table.find_title(named_book["title"]):
+            if neighbour_table.get_book(row)["author"] != named_book["author"]:
+                continue
+            neighbour_rows, _ = neighbour_table.get_neighbours(
+                row, NEIGHBOURS_PER_BOOK
+            )
+            neighbours_per_book.append(neighbour_rows)
+    books = []
+    for rank_rows in zip_longest(*neighbours_per_book):
+        for row in rank_rows:
+            if row is None:
+                continue
+            book = neighbour_table.get_book(row)
+            books.append({
+                "title": book["title"],
+                "author": book["author"],
+                "summary": book["summary"],
+            })
+    return books
 
-    # Step 2: Parse the tool call from the response
+
+async def _retrieve_books(user_input, prompt_embedding=None):
+    """
+    Run the retrieval part of the RAG pipeline (steps 1 to 3).
+
+    Tries exact title/author matches first, then the theme extraction
+    fast path, if enabled.
+
+    :returns: A tuple of (the input list for the formatting call,
+        all recommended books, the context report).
+    """
+    with span("exact_match_retrieval"):
+        exact_match_result = _retrieve_books_exact_match(user_input)
+    if exact_match_result is not None:
+        return exact_match_result
+
+    if THEME_FAST_PATH_ENABLED:
+        with span("fast_path_retrieval"):
+            fast_path_result = await _retrieve_books_fast_path(
+                user_input, prompt_embedding
+            )
+        if fast_path_result is not None:
+            return fast_path_result
+
+    record_retrieval_path("tool_call")
+
+    # Step 1: Send user input to OpenAI and get tool call
+    with span("theme_extraction_llm"):
+        response = await get_response_async(
+            input=[user_input],
+            instructions=with_catalogue_digest(instructions_identify_themes),
+            tools=tools,
+            max_output_tokens=100,  # Can it fit in 100 tokens?
+            prompt_cache_key=prompt_cache_key("identify-themes"),
+        )
+
+    # Step 2: Parse the tool calls from the response
+    tool_calls = parse_tool_calls(response)
+
+    # Step 3: Get book summaries for all tool calls at once
+    # (One embedding request and one query, however many calls there are)
+    books_per_call = await get_books_by_theme_groups(
+        [themes for _, themes, _ in tool_calls],
+        [n_results for _, _, n_results in tool_calls],
+    )
+    # Only the function calls are sent back with their outputs, not the
+    # whole response output, and summaries are fitted to a token budget
+    with span("context_building"):
+        input_list, context_report = build_tool_call_context(
+            user_input,
+            function_call_items(response),
+            tool_calls,
+            books_per_call,
+        )
+    all_recommended_books = [
+        book
+        for recommended_books in books_per_call
+        for book in recommended_books
+    ]
+    return input_list, all_recommended_books, context_report
+
+
+def parse_tool_calls(response):
+    """
+    Parse the ``get_books_by_themes`` tool calls from a response.
+
+    :param response: The theme identification response.
+    :type response: OpenAIResponse
+    :returns: A list of (call ID, themes, n_results) tuples
+        (n_results clamped, see ``MAX_N_RESULTS``).
+    :rtype: list[tuple]
+    :raises ValueError: If the response calls any other function.
+    """
+    tool_calls = []
     for item in response.output:
         if item.type == "function_call":
             function_name = item.name
@@ -65,35 +497,7 @@ def get_book_recommendation(user_input):
                     f"Unexpected function call: {function_name}"
                 )
             arguments = json.loads(item.arguments)
-            themes = arguments.themes  # Has to be there!
-            n_results = arguments.get("n_results")
-
-            # Step 3: Call the function to get book summaries
-            kwargs = {}
-            if n_results is not None:
-                kwargs["n_results"] = n_results
-            recommended_books = get_book_by_themes(
-                themes, **kwargs
-            )
-
-            input_list.append({
-                "type": "function_call_output",
-                "call_id": item.call_id,
-                "output": json.dumps({
-                    "recommended_books": recommended_books
-                })
-            })
-
-    # Step 4: Pass summaries back to OpenAI for formatting
-    instructions_format_recommendations = (
-        "Format the book recommendations into a user-friendly"
-        " format. Include title, author, and summary for each book."
-        " Do not change the content of the summaries."
-    )
-    final_response_text = get_response_text(
-        input=input_list,
-        instructions=instructions_format_recommendations,
-        max_output_tokens=1000,
-    )
-
-    return final_response_text
+            themes = arguments["themes"]  # Has to be there!
+            n_results = clamp_n_results(arguments.get("n_results"))
+            tool_calls.append((item.call_id, themes, n_results))
+    return tool_calls
@@ -1,4 +1,12 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from book_api.metrics import get_usage_metrics
 from book_api.persistence import persist_response
+from book_api.response_queue import get_response_writer
+from book_api.tracing import span
+
+logger = logging.getLogger(__name__)
 
 
 def get_response_stats(openai_response):
@@ -46,9 +54,9 @@ def get_response_stats(openai_response):
     return stats
 
 
-def record_response(instructions, input, openai_response, *, batch=False):
+def get_response_record(instructions, input, openai_response, *, batch=False):
     """
-    Records the response statistics for a given OpenAI response.
+    Build the record persisted for a given OpenAI response.
 
     :param instructions: Instructions for the response.
     :type instructions: str
@@ -58,17 +66,88 @@ def record_response(instructions, input, openai_response, *, batch=False):
     :type openai_response: OpenAIResponse
     :param batch: Whether the request used the Batch API.
     :type batch: bool
-    :returns: None
+    :returns: The response statistics, with its texts and timestamp.
+    :rtype: dict
     """
     response_data = get_response_stats(openai_response)
     response_data["instructions"] = instructions
-    response_data["input"] = input
+    response_data["input"] = (
+        input if input is None or isinstance(input, str)
+        else str(input)  # e.g. a list of past outputs; SQLite wants text
+    )
     response_data["output"] = (
         openai_response.output_text
         if hasattr(openai_response, 'output_text')
         else "[EMBEDDING RESPONSE]"  # No output text for embeddings
     )
+    response_data["batch"] = batch
+    # Stamped now, not when the background writer gets to it
+    response_data["timestamp"] = (
+        datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    )
     # TODO: we're not logging tool calls here!
     # (Token usage counts should still be correct, though.)
-    persist_response(response_data)
-    print("[INFO] Response recorded in the database.")
+    return response_data
+
+
+def record_response(instructions, input, openai_response, *, batch=False):
+    """
+    Records the response statistics for a given OpenAI response.
+
+    :param instructions: Instructions for the response.
+    :type instructions: str
+    :param input: Input text sent to the OpenAI API.
+    :type input: str
+    :param openai_response: The response object from OpenAI API.
+    :type openai_response: OpenAIResponse
+    :param batch: Whether the request used the Batch API.
+    :type batch: bool
+    :returns: None
+    """
+    response_data = get_response_record(
+        instructions, input, openai_response, batch=batch
+    )
+    get_usage_metrics().record(response_data)
+    response_writer = get_response_writer()
+    if response_writer.running:
+        # Written in the background (see response_queue)
+        response_writer.enqueue(response_data)
+        return
+    # No writer running (e.g. in a handy script), so write it directly
+    with span("sqlite_write"):
+        persist_response(response_data)
+    logger.debug("Response recorded in the database.")
+
+
+async def record_response_async(
+    instructions, input, openai_response, *, batch=False
+):
+    """
+    Async variant of :func:`record_response`.
+
+    Enqueuing for the background writer never blocks; if no writer is
+    running, the SQLite write runs in a worker thread instead, so it
+    doesn't block the event loop either.
+
+    :param instructions: Instructions for the response.
+    :type instructions: str
+    :param input: Input text sent to the OpenAI API.
+    :type input: str
+    :param openai_response: The response object from OpenAI API.
+    :type openai_response: OpenAIResponse
+    :param batch: Whether the request used the Batch API.
+    :type batch: bool
+    :returns: None
+    """
+    if get_response_writer().running:
+        record_response(
+            instructions, input, openai_response, batch=batch
+        )
+        return
+    await asyncio.to_thread(
+        record_response,
+        instructions,
+        input,
+        openai_response,
+        batch=batch,
+    )
@@ -0,0 +1,133 @@
+import logging
+import queue
+import threading
+from time import monotonic
+from book_api.db_connections import get_connection_manager
+from book_api.persistence import persist_responses
+from book_api.persistence_config import (
+    RESPONSE_QUEUE_MAX_SIZE,
+    RESPONSE_WRITE_BATCH_SIZE,
+    RESPONSE_WRITE_INTERVAL_SECONDS,
+)
+from book_api.tracing import span
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()  # Sentinel telling the writer to finish up
+
+
+class ResponseWriter:
+    """
+    Write-behind recorder for response statistics.
+
+    Requests only enqueue records (never blocking on SQLite). A background
+    thread drains the queue in batches, writing each batch in a single
+    transaction over the thread's long-lived, WAL-mode connection.
+    If the queue is full, records are dropped (and counted) rather than
+    slowing requests.
+    """
+
+    def __init__(self, max_size, batch_size, write_interval_seconds):
+        self.batch_size = batch_size
+        self.write_interval_seconds = write_interval_seconds
+        self._queue = queue.Queue(maxsize=max_size)
+        self._thread = None
+        self.written_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the background writer thread."""
+        if self.running:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="response-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Flush all queued records, then stop the writer thread."""
+        if not self.running:
+            return
+        self._queue.put(_STOP)  # Blocks if full; the writer keeps draining
+        self._thread.join()  # type: ignore
+        self._thread = None
+
+    def enqueue(self, record):
+        """
+        Queue a record for writing, without blocking.
+
+        :returns: Whether the record was queued (False if it was dropped).
+        :rtype: bool
+        """
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped_count += 1
+            return False
+
+    def stats(self):
+        """Return the queue depth and written/dropped/failed counters."""
+        return {
+            "queue_depth": self._queue.qsize(),
+            "written": self.written_count,
+            "dropped": self.dropped_count,
+            "failed": self.failed_count,
+        }
+
+    def _run(self):
+        conn = get_connection_manager().get_connection()
+        try:
+            stopping = False
+            while not stopping:
+                batch = [self._queue.get()]  # Wait for at least one record
+                # Then give others a moment to arrive, up to a full batch
+                deadline = monotonic() + self.write_interval_seconds
+                try:
+                    while len(batch) < self.batch_size and _STOP not in batch:
+                        batch.append(self._queue.get(
+                            timeout=max(0, deadline - monotonic())
+                        ))
+                except queue.Empty:
+                    pass
+                if _STOP in batch:
+                    stopping = True
+                    batch = [
+                        record for record in batch if record is not _STOP
+                    ]
+                    # Drain whatever is left (nothing new should arrive)
+                    while not self._queue.empty():
+                        batch.append(self._queue.get_nowait())
+                if batch:
+                    self._write(conn, batch)
+        finally:
+            get_connection_manager().release_connection()
+
+    def _write(self, conn, batch):
+        try:
+            with span("sqlite_write"):
+                persist_responses(batch, conn)
+            self.written_count += len(batch)
+        except Exception as e:
+            conn.rollback()
+            self.failed_count += len(batch)
+            logger.error(
+                "Failed to persist %d responses: %s", len(batch), e
+            )
+
+
+_response_writer = ResponseWriter(
+    max_size=RESPONSE_QUEUE_MAX_SIZE,
+    batch_size=RESPONSE_WRITE_BATCH_SIZE,
+    write_interval_seconds=RESPONSE_WRITE_INTERVAL_SECONDS,
+)
+
+
+def get_response_writer():
+    """Get the shared write-behind response writer."""
+    return _response_writer
@@ -0,0 +1,124 @@
+import asyncio
+from book_api.chroma_db_setup import (
+    get_async_chroma_collection,
+    get_chroma_collection,
+    get_library_fingerprint,
+)
+from book_api.rag_config import RETRIEVAL_BACKEND, VECTOR_INDEX_DIR
+from book_api.vector_index import ensure_vector_index, load_vector_index
+
+# Above this many (rows x dimensions), searches run in a worker thread
+# rather than on the event loop
+NUMPY_INLINE_SEARCH_MAX_SIZE = 10_000_000
+
+
+class ChromaRetrievalBackend:
+    """Retrieval backend querying the ChromaDB server."""
+
+    async def query(self, query_embeddings, n_results):
+        """
+        Find the books closest to each query embedding.
+
+        :param query_embeddings: The embeddings to search with.
+        :type query_embeddings: list[list[float]]
+        :param n_results: The number of books to return per query.
+        :type n_results: int
+        :returns: For each query, a tuple of (a list of dictionaries
+            containing title, author, and summary; the matching list
+            of cosine distances).
+        :rtype: list[tuple[list[dict], list[float]]]
+        """
+        collection = get_async_chroma_collection()
+        results = await collection.query(
+            query_embeddings=query_embeddings,  # type: ignore
+            n_results=n_results,
+            include=["metadatas", "documents", "distances"],
+        )
+        all_documents = results["documents"]
+        all_metadatas = results["metadatas"]
+        all_distances = results["distances"]
+        # Pylance doesn't understand that we explicitly asked for these
+
+        query_results = []
+        for documents, metadatas, distances in zip(
+            all_documents, all_metadatas, all_distances  # type: ignore
+        ):
+            books = []
+            for idx in range(len(documents)):
+                books.append({
+                    "title": metadatas[idx].get("title", "Unknown Title"),
+                    "author": metadatas[idx].get("author", "Unknown Author"),
+                    "summary": documents[idx],
+                })
+            query_results.append((books, list(distances)))
+        return query_results
+
+    def refresh(self):
+        """Nothing to refresh, ChromaDB is always up to date."""
+
+
+class NumpyRetrievalBackend:
+    """
+    Retrieval backend using an in-process, memory-mapped NumPy index.
+
+    The index is built from the embeddings in ChromaDB (see
+    ``vector_index``), and rebuilt whenever the library changes.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self._index = None
+
+    async def query(self, query_embeddings, n_results):
+        """See :meth:`ChromaRetrievalBackend.query`."""
+        index = self._index
+        if index is None:
+            raise ValueError(
+                "Vector index not loaded. Call refresh() first."
+            )
+        if index.embeddings.size > NUMPY_INLINE_SEARCH_MAX_SIZE:
+            matches = await asyncio.to_thread(
+                index.search, query_embeddings, n_results
+            )
+        else:
+            matches = index.search(query_embeddings, n_results)
+
+        query_results = []
+        for rows, distances in matches:
+            books = []
+            for row in rows:
+                book = index.get_book(row)
+                books.append({
+                    "title": book["title"],
+                    "author": book["author"],
+                    "summary": book["summary"],
+                })
+            query_results.append((books, distances))
+        return query_results
+
+    def refresh(self):
+        """
+        Make sure the index matches the library, (re)building it from
+        ChromaDB if needed, and (re)load it.
+        """
+        fingerprint = get_library_fingerprint()
+        ensure_vector_index(get_chroma_collection, self.index_dir, fingerprint)
+        if self._index is None or self._index.fingerprint != fingerprint:
+            self._index = load_vector_index(self.index_dir)
+
+
+_retrieval_backend = (
+    NumpyRetrievalBackend(VECTOR_INDEX_DIR)
+    if RETRIEVAL_BACKEND == "numpy"
+    else ChromaRetrievalBackend()
+)
+
+
+def get_retrieval_backend():
+    """Get the configured retrieval backend."""
+    return _retrieval_backend
+
+
+def refresh_retrieval_backend():
+    """Bring the retrieval backend up to date with the library."""
+    _retrieval_backend.refresh()
@@ -0,0 +1,141 @@
+import logging
+import threading
+from collections import OrderedDict
+from time import monotonic
+import numpy as np
+from book_api.rag_config import (
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL_SECONDS,
+    SEMANTIC_CACHE_MAX_ENTRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """
+    A size-bounded LRU cache keyed on prompt embeddings.
+
+    A lookup is a hit if a stored prompt embedding has a cosine similarity
+    of at least ``threshold`` with the query embedding, and the entry is
+    younger than ``ttl_seconds``.
+
+    Thread-safe: it's cleared from the library sync thread (see
+    :func:`clear_semantic_cache`) while the event loop uses it.
+    """
+
+    def __init__(self, threshold, ttl_seconds, max_entries):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._next_key = 0
+        # key -> (normalized embedding, value, created at), oldest first
+        self._entries = OrderedDict()
+        # Stacked embeddings, rebuilt lazily after the entries change
+        self._keys = []
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None  # E.g. a mocked (all-zero) embedding
+        return vector / norm
+
+    def _evict_expired(self):
+        now = monotonic()
+        expired = [
+            key for key, (_, _, created_at) in self._entries.items()
+            if now - created_at > self.ttl_seconds
+        ]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, embedding):
+        """
+        Look up a cached value for a prompt embedding.
+
+        :param embedding: The prompt embedding.
+        :type embedding: list[float]
+        :returns: The cached value, or None on a miss.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            self._evict_expired()
+            if query is None or not self._entries:
+                self.misses += 1
+                return None
+
+            if self._matrix is None:
+                self._keys = list(self._entries.keys())
+                self._matrix = np.stack([
+                    self._entries[key][0] for key in self._keys
+                ])
+            similarities = self._matrix @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            key = self._keys[best]
+            self._entries.move_to_end(key)  # Mark as recently used
+            self.hits += 1
+            return self._entries[key][1]
+
+    def store(self, embedding, value):
+        """
+        Store a value for a prompt embedding, evicting the least recently
+        used entry if the cache is full.
+
+        :param embedding: The prompt embedding.
+        :type embedding: list[float]
+        :param value: The value to cache.
+        """
+        vector = self._normalize(embedding)
+        if vector is None or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[self._next_key] = (vector, value, monotonic())
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self):
+        """Drop all entries (e.g. when the library changes)."""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        """Return the hit/miss counters and current size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+_semantic_cache = SemanticCache(
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS,
+    max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+)
+
+
+def get_semantic_cache():
+    """Get the shared semantic response cache."""
+    return _semantic_cache
+
+
+def clear_semantic_cache():
+    """Invalidate the shared semantic response cache."""
+    _semantic_cache.clear()
+    logger.info("Semantic response cache cleared.")
@@ -0,0 +1,117 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller (the
+    leader) makes the call, and callers arriving while it's in flight
+    (followers) wait for it and get its result (or exception) too.
+
+    Nothing is kept once the call is done, so this only caps upstream
+    load during bursts of identical calls; it's not a cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> Future, for sync calls (from threads)
+        self._tasks = {}  # (event loop, key) -> Task, for coroutines
+        self.leader_count = 0
+        self.follower_count = 0
+
+    def run(self, key, call):
+        """
+        Call ``call()``, unless a call with the same key is in flight
+        (from another thread), in which case wait for that one instead.
+
+        :param key: What makes calls identical. Must be hashable.
+        :param call: Makes the call (with no arguments).
+        :type call: Callable
+        :returns: The call's result.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._calls[key] = Future()
+                self.leader_count += 1
+            else:
+                self.follower_count += 1
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def run_async(self, key, call):
+        """
+        Async variant of :meth:`run`, for calls on the same event loop.
+
+        The call runs as its own task, so it's carried through for the
+        followers even if the leader is cancelled (e.g. disconnects).
+
+        :param call: Returns the coroutine making the call.
+        :type call: Callable
+        """
+        loop = asyncio.get_running_loop()
+        task_key = (loop, key)
+        with self._lock:
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = self._tasks[task_key] = loop.create_task(call())
+                task.add_done_callback(
+                    lambda done_task: self._call_done(task_key, done_task)
+                )
+                self.leader_count += 1
+            else:
+                self.follower_count += 1
+        return await asyncio.shield(task)
+
+    def _call_done(self, task_key, task):
+        with self._lock:
+            if self._tasks.get(task_key) is task:
+                del self._tasks[task_key]
+        if not task.cancelled():
+            # Retrieve it, so it isn't logged as never retrieved if every
+            # caller was cancelled in the meantime (callers still get it)
+            task.exception()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "leaders": self.leader_count,
+                "followers": self.follower_count,
+                "in_flight": len(self._calls) + len(self._tasks),
+            }
+
+
+_single_flights = {}
+
+
+def get_single_flight(name):
+    """
+    Get the shared :class:`SingleFlight` for a kind of call.
+
+    :param name: The kind of call (e.g. "recommendation").
+    :type name: str
+    :rtype: SingleFlight
+    """
+    return _single_flights.setdefault(name, SingleFlight())
+
+
+def get_single_flight_stats():
+    """Get leader, follower and in flight counts, per kind of call."""
+    return {
+        name: single_flight.stats()
+        for name, single_flight in _single_flights.items()
+    }
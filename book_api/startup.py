@@ -0,0 +1,65 @@
+import logging
+from contextlib import contextmanager
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Imported by main before its other dependencies, so this is about when
+# the app started loading
+_started_at = perf_counter()
+_phase_seconds = {}  # Startup phase -> seconds, in the order they ran
+_serving_after = None  # Seconds until requests were accepted
+_ready_after = None  # Seconds until the library was synced and loaded
+
+
+@contextmanager
+def startup_phase(name):
+    """
+    Time a phase of startup, for the startup report.
+
+    :param name: The phase (e.g. "library_sync").
+    :type name: str
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        _phase_seconds[name] = perf_counter() - start
+        logger.info(
+            "Startup phase %s took %.3f s.", name, _phase_seconds[name]
+        )
+
+
+def mark_serving():
+    """Record that requests are being accepted (e.g. /health, /ready)."""
+    global _serving_after
+    _serving_after = perf_counter() - _started_at
+    logger.info("Accepting requests after %.3f s.", _serving_after)
+
+
+def mark_ready():
+    """Record that the library is synced and loaded, so it can be used."""
+    global _ready_after
+    _ready_after = perf_counter() - _started_at
+    logger.info("Ready after %.3f s.", _ready_after)
+
+
+def is_ready():
+    return _ready_after is not None
+
+
+def _milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def get_startup_report():
+    """Get the time taken by each startup phase, and until ready."""
+    return {
+        "ready": is_ready(),
+        "serving_after_ms": _milliseconds(_serving_after),
+        "ready_after_ms": _milliseconds(_ready_after),
+        "phases_ms": {
+            name: _milliseconds(seconds)
+            for name, seconds in _phase_seconds.items()
+        },
+    }
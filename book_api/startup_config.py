@@ -0,0 +1,9 @@
+from os import getenv
+
+# Retry-After sent with 503s while the library is still being synced
+STARTUP_RETRY_AFTER_SECONDS = int(getenv("STARTUP_RETRY_AFTER_SECONDS", "5"))
+# Wait between attempts if syncing the library fails at startup
+# (e.g. ChromaDB isn't up yet)
+STARTUP_RETRY_DELAY_SECONDS = float(
+    getenv("STARTUP_RETRY_DELAY_SECONDS", "5")
+)
@@ -0,0 +1,75 @@
+import re
+from book_api.chroma_db_setup import iter_summaries_txt
+
+# Words too common to tell books apart
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because
+been before being below between both but by can could did do does doing down
+during each even every few for from further had has have having he her here
+hers him his how i if in into is it its itself just like me more most my no
+nor not now of off on once only or other our out over own same she should so
+some such than that the their them then there these they this those through
+to too under until up very was we were what when where which while who whom
+why will with would you your book books novel novels story stories read
+recommend recommendation something anything set about
+""".split())
+WORD_PATTERN = re.compile(r"[a-z]+")
+
+_vocabulary = frozenset()  # Built from summaries.txt, see below
+# How often each retrieval path was taken (see rag_service)
+_path_counts = {
+    "exact_match": 0,  # Prompt named an author (lexical index)
+    "title_neighbours": 0,  # Prompt named a title (neighbour table)
+    # Named a title, but the neighbour table wasn't loaded yet
+    "exact_match_fallback": 0,
+    "fast_path": 0,  # Answered without the tool-calling LLM
+    "fast_path_fallback": 0,  # Tried, but not confident enough
+    "fast_path_skipped": 0,  # Prompt not eligible (too long, no themes)
+    "tool_call": 0,  # Themes extracted by the tool-calling LLM
+}
+
+
+def _words(text):
+    return WORD_PATTERN.findall(text.lower())
+
+
+def refresh_theme_vocabulary():
+    """(Re)build the theme vocabulary from the words in summaries.txt."""
+    global _vocabulary
+    vocabulary = set()
+    for title, author, summary in iter_summaries_txt():
+        for text in (title, author, summary):
+            vocabulary.update(
+                word for word in _words(text)
+                if len(word) >= 3 and word not in STOPWORDS
+            )
+    _vocabulary = frozenset(vocabulary)
+
+
+def extract_themes(prompt):
+    """
+    Extract themes from a prompt locally, without calling the LLM.
+
+    A theme is any word of the prompt that also appears in the library
+    (and isn't a stopword).
+
+    :param prompt: The user's prompt.
+    :type prompt: str
+    :returns: The themes, in the order they appear in the prompt.
+    :rtype: list[str]
+    """
+    themes = []
+    for word in _words(prompt):
+        if word in _vocabulary and word not in themes:
+            themes.append(word)
+    return themes
+
+
+def record_retrieval_path(path):
+    """Count a request as having taken the given retrieval path."""
+    _path_counts[path] += 1
+
+
+def get_retrieval_path_stats():
+    """Get how often each retrieval path was taken."""
+    return dict(_path_counts)
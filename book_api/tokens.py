@@ -0,0 +1,76 @@
+import logging
+import threading
+from functools import lru_cache
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# text-embedding-3-* models use cl100k_base, gpt-4.1-* models use o200k_base
+EMBEDDING_ENCODING = "cl100k_base"
+RESPONSE_ENCODING = "o200k_base"
+CHARS_PER_TOKEN_ESTIMATE = 4  # Rough average for English text
+
+_encoding_lock = threading.Lock()  # Loaded once, from whichever thread
+_fallback_logged = False  # Warned about once, not once per encoding
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(encoding_name):
+    global _fallback_logged
+    with _encoding_lock:
+        try:
+            return tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            # tiktoken downloads encodings on first use, which can fail
+            # offline (the Docker image has them baked in, see Dockerfile)
+            log = logger.debug if _fallback_logged else logger.warning
+            _fallback_logged = True
+            log(
+                "Could not load %s encoding: %s,"
+                " estimating token counts instead.",
+                encoding_name, e,
+            )
+            return None
+
+
+def count_tokens(text, encoding_name=RESPONSE_ENCODING):
+    """
+    Count the tokens in a text locally (no API call).
+
+    Falls back to an estimate from the text length if the tokenizer
+    encoding isn't available.
+
+    :param text: The text to count tokens for.
+    :type text: str
+    :param encoding_name: The tiktoken encoding to use.
+    :type encoding_name: str, optional
+    :returns: The number of tokens.
+    :rtype: int
+    """
+    encoding = _get_encoding(encoding_name)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN_ESTIMATE)  # Rounded up
+    return len(encoding.encode(text))
+
+
+def truncate_to_tokens(text, max_tokens, encoding_name=RESPONSE_ENCODING):
+    """
+    Cut a text down to at most ``max_tokens`` tokens, counted locally
+    like in :func:`count_tokens`.
+
+    :param text: The text to cut.
+    :type text: str
+    :param max_tokens: The most tokens to keep.
+    :type max_tokens: int
+    :param encoding_name: The tiktoken encoding to use.
+    :type encoding_name: str, optional
+    :returns: The text, or as much of its start as fits.
+    :rtype: str
+    """
+    encoding = _get_encoding(encoding_name)
+    if encoding is None:
+        return text[:max(max_tokens, 0) * CHARS_PER_TOKEN_ESTIMATE]
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max(max_tokens, 0)])
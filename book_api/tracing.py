@@ -0,0 +1,316 @@
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter, time_ns
+from book_api.tracing_config import (
+    TRACE_EXPORT_PATH,
+    LATENCY_SAMPLES_PER_STAGE,
+)
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+_current_trace = ContextVar("current_trace", default=None)
+# The innermost open span's ID, so concurrent tasks of one trace each
+# nest their spans under their own parent
+_current_span_id = ContextVar("current_span_id", default=None)
+
+
+class Trace:
+    """The timed spans of one request, under a shared trace ID."""
+
+    def __init__(self, name):
+        self.trace_id = secrets.token_hex(16)
+        self.root_span_id = secrets.token_hex(8)
+        self.name = name
+        self.start_time_ns = time_ns()
+        self.started_at = perf_counter()
+        self.duration = None
+        self.spans = []  # Finished spans, as dicts
+        self.attributes = {}  # Exported on the root span
+
+    def server_timing(self):
+        """Format the finished spans as a Server-Timing header value."""
+        durations = {}
+        for span in self.spans:
+            durations[span["name"]] = (
+                durations.get(span["name"], 0.0) + span["duration"]
+            )
+        total = perf_counter() - self.started_at
+        return ", ".join(
+            f"{name};dur={duration * 1000:.1f}"
+            for name, duration in list(durations.items()) + [("total", total)]
+        )
+
+    def to_otlp(self):
+        """Convert to an OTLP JSON ``ExportTraceServiceRequest``."""
+        def otlp_span(span_id, parent_span_id, name, start_ns, duration):
+            otlp = {
+                "traceId": self.trace_id,
+                "spanId": span_id,
+                "name": name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(start_ns),
+                "endTimeUnixNano": str(start_ns + int(duration * 1e9)),
+            }
+            if parent_span_id:
+                otlp["parentSpanId"] = parent_span_id
+            return otlp
+
+        root_span = otlp_span(
+            self.root_span_id, None, self.name,
+            self.start_time_ns, self.duration or 0.0
+        )
+        if self.attributes:
+            root_span["attributes"] = [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ]
+        spans = [root_span] + [
+            otlp_span(
+                span["span_id"], span["parent_span_id"], span["name"],
+                span["start_time_ns"], span["duration"]
+            )
+            for span in self.spans
+        ]
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{
+                "key": "service.name",
+                "value": {"stringValue": "book_api"},
+            }]},
+            "scopeSpans": [{"scope": {"name": "book_api"}, "spans": spans}],
+        }]}
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}  # 64-bit ints are strings in JSON
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class LatencyHistogram:
+    """
+    Latencies of one stage: cumulative bucket counts (for Prometheus)
+    and a window of recent samples (for percentiles).
+    """
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=LATENCY_SAMPLES_PER_STAGE)
+
+    def observe(self, duration):
+        index = bisect_left(LATENCY_BUCKETS, duration)
+        if index < len(self.bucket_counts):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += duration
+        self.recent.append(duration)
+
+    def percentiles(self):
+        """p50/p95/p99 of the recent samples, in milliseconds."""
+        samples = sorted(self.recent)
+        if not samples:
+            return {}
+        return {
+            f"p{percentile}": round(1000 * samples[
+                min(len(samples) - 1, len(samples) * percentile // 100)
+            ], 2)
+            for percentile in (50, 95, 99)
+        }
+
+
+_histograms = {}  # Stage name -> LatencyHistogram
+_histograms_lock = threading.Lock()  # Spans also end in worker threads
+_export_lock = threading.Lock()
+# Traces waiting to be exported, and the thread writing them out
+_export_queue = None
+_export_thread = None
+_export_pid = None
+
+
+def start_trace(name):
+    """
+    Start a trace for the current request (or other unit of work).
+
+    Spans opened in the same context (including tasks it starts) are
+    added to it.
+
+    :param name: The name of the root span (e.g. the request path).
+    :type name: str
+    :returns: The new trace.
+    :rtype: Trace
+    """
+    trace = Trace(name)
+    _current_trace.set(trace)
+    _current_span_id.set(None)
+    return trace
+
+
+def get_current_trace():
+    """Get the current trace, or None outside of one."""
+    return _current_trace.get()
+
+
+def set_trace_attributes(attributes):
+    """
+    Add attributes (e.g. token counts) to the current trace, if any.
+
+    :param attributes: The attributes, by name.
+    :type attributes: dict
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+def finish_trace(trace):
+    """
+    Record a trace's total duration and export it (if configured).
+
+    The export is written by a background thread (see
+    :func:`stop_trace_export`), so this never blocks the event loop.
+    """
+    trace.duration = perf_counter() - trace.started_at
+    if TRACE_EXPORT_PATH:
+        _get_export_queue().put(trace)
+
+
+def _get_export_queue():
+    """Get this process's export queue, starting its writer if needed."""
+    global _export_queue, _export_thread, _export_pid
+    with _export_lock:
+        if _export_thread is None or _export_pid != os.getpid():
+            # (Not yet started, or started before forking into a worker)
+            _export_queue = queue.SimpleQueue()
+            _export_thread = threading.Thread(
+                target=_export_traces, args=(_export_queue,),
+                name="trace-export", daemon=True,
+            )
+            _export_thread.start()
+            _export_pid = os.getpid()
+        return _export_queue
+
+
+def _export_traces(export_queue):
+    """Append queued traces to the export file, until told to stop."""
+    while True:
+        trace = export_queue.get()
+        if trace is None:
+            return
+        try:
+            with open(TRACE_EXPORT_PATH, "a") as export_file:
+                export_file.write(json.dumps(trace.to_otlp()) + "\n")
+        except OSError as e:
+            logger.warning("Could not export trace %s: %s", trace.trace_id, e)
+
+
+def stop_trace_export():
+    """Write out any queued traces, and stop the writer (on shutdown)."""
+    global _export_thread
+    with _export_lock:
+        export_thread = _export_thread
+        if export_thread is None or _export_pid != os.getpid():
+            return
+        _export_queue.put(None)
+        _export_thread = None
+    export_thread.join()
+
+
+@contextmanager
+def span(stage):
+    """
+    Time a stage of the pipeline.
+
+    The timing is added to the stage's latency histogram, and to the
+    current trace (if any) as a span.
+
+    :param stage: The name of the stage (e.g. "embedding").
+    :type stage: str
+    """
+    trace = _current_trace.get()
+    span_id = secrets.token_hex(8)
+    parent_span_id = None
+    if trace is not None:
+        parent_span_id = _current_span_id.get() or trace.root_span_id
+    span_token = _current_span_id.set(span_id)
+    start_time_ns = time_ns()
+    started_at = perf_counter()
+    try:
+        yield
+    finally:
+        duration = perf_counter() - started_at
+        try:
+            _current_span_id.reset(span_token)
+        except ValueError:
+            pass  # Ended in another context (e.g. a generator's consumer)
+        with _histograms_lock:
+            histogram = _histograms.get(stage)
+            if histogram is None:
+                histogram = _histograms[stage] = LatencyHistogram()
+            histogram.observe(duration)
+        if trace is not None:
+            trace.spans.append({
+                "span_id": span_id,
+                "parent_span_id": parent_span_id,
+                "name": stage,
+                "start_time_ns": start_time_ns,
+                "duration": duration,
+            })
+
+
+def get_latency_stats():
+    """Get p50/p95/p99 latencies (in milliseconds) per stage."""
+    with _histograms_lock:
+        return {
+            stage: {"count": histogram.count, **histogram.percentiles()}
+            for stage, histogram in _histograms.items()
+        }
+
+
+def reset_latency_stats():
+    """Forget all latencies recorded so far (e.g. after a warm-up)."""
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def latency_metric_families():
+    """Get the latency histograms as Prometheus metric families."""
+    samples = []
+    with _histograms_lock:
+        for stage, histogram in _histograms.items():
+            cumulative = 0
+            for bound, bucket_count in zip(
+                LATENCY_BUCKETS, histogram.bucket_counts
+            ):
+                cumulative += bucket_count
+                samples.append(
+                    ("_bucket", {"stage": stage, "le": str(bound)}, cumulative)
+                )
+            samples.append(
+                ("_bucket", {"stage": stage, "le": "+Inf"}, histogram.count)
+            )
+            samples.append(("_sum", {"stage": stage}, histogram.sum))
+            samples.append(("_count", {"stage": stage}, histogram.count))
+    return [(
+        "book_api_stage_latency_seconds", "histogram",
+        "Latency of each stage of the RAG pipeline.",
+        samples,
+    )]
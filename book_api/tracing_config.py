@@ -0,0 +1,12 @@
+from os import getenv
+
+LOG_LEVEL = getenv("LOG_LEVEL", "INFO")
+# Add a Server-Timing header (per-stage timings) to responses
+SERVER_TIMING_ENABLED = (
+    getenv("SERVER_TIMING_ENABLED", "false").lower() == "true"
+)
+# If set, finished traces are appended to this file as OTLP JSON lines
+# (readable by e.g. the OpenTelemetry Collector's otlpjson receiver)
+TRACE_EXPORT_PATH = getenv("TRACE_EXPORT_PATH")
+# Recent timings kept per stage, to compute percentiles from
+LATENCY_SAMPLES_PER_STAGE = int(getenv("LATENCY_SAMPLES_PER_STAGE", "10000"))
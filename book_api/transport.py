@@ -0,0 +1,387 @@
+import asyncio
+import logging
+import random
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from book_api.transport_config import (
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    OPENAI_KEEPALIVE_SECONDS,
+    OPENAI_CONNECT_TIMEOUT_SECONDS,
+    OPENAI_RESPONSE_TIMEOUT_SECONDS,
+    CHROMA_MAX_CONNECTIONS,
+    CHROMA_MAX_KEEPALIVE_CONNECTIONS,
+    CHROMA_KEEPALIVE_SECONDS,
+    OPENAI_MAX_RETRIES,
+    OPENAI_RETRY_BASE_DELAY_SECONDS,
+    OPENAI_RETRY_MAX_DELAY_SECONDS,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_MIN_CONCURRENCY,
+    OPENAI_RESPONSES_TOKENS_PER_MINUTE,
+    OPENAI_EMBEDDINGS_TOKENS_PER_MINUTE,
+)
+try:
+    import httpx2 as httpx  # What newer openai releases are built on
+except ImportError:
+    import httpx
+
+logger = logging.getLogger(__name__)
+
+# openai and chromadb take a good part of a second each to import, so
+# they're only imported where they're first needed (see /ready in main)
+
+
+# Clients
+
+def _openai_limits():
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+    )
+
+
+def _openai_timeout():
+    return httpx.Timeout(
+        OPENAI_RESPONSE_TIMEOUT_SECONDS,
+        connect=OPENAI_CONNECT_TIMEOUT_SECONDS,
+    )
+
+
+def make_openai_client():
+    """
+    Make the sync OpenAI client, with a tuned connection pool.
+
+    The client's own retries are off; see :func:`call_with_retries`.
+    """
+    from openai import OpenAI, DefaultHttpxClient
+    return OpenAI(
+        http_client=DefaultHttpxClient(
+            limits=_openai_limits(), timeout=_openai_timeout()
+        ),
+        max_retries=0,
+    )
+
+
+def make_async_openai_client():
+    """Async variant of :func:`make_openai_client`."""
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    return AsyncOpenAI(
+        http_client=DefaultAsyncHttpxClient(
+            limits=_openai_limits(), timeout=_openai_timeout()
+        ),
+        max_retries=0,
+    )
+
+
+def chroma_settings():
+    """ChromaDB client settings, with a tuned connection pool."""
+    from chromadb.config import Settings
+    return Settings(
+        chroma_http_keepalive_secs=CHROMA_KEEPALIVE_SECONDS,
+        chroma_http_max_connections=CHROMA_MAX_CONNECTIONS,
+        chroma_http_max_keepalive_connections=(
+            CHROMA_MAX_KEEPALIVE_CONNECTIONS
+        ),
+    )
+
+
+# Limits
+
+class TokenBucket:
+    """
+    A token budget, refilled continuously up to a minute's worth.
+
+    Calls wait until the budget can cover their (estimated) tokens, so
+    bursts are smoothed out instead of running into the upstream
+    tokens-per-minute limit.
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self._tokens = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        """
+        Take tokens from the budget (going into debt if need be).
+
+        :returns: How long to wait for the debt to be paid off, in seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens
+                + (now - self._updated_at) * self.capacity / 60,
+            )
+            self._updated_at = now
+            self._tokens -= min(tokens, self.capacity)
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens * 60 / self.capacity
+
+    def acquire(self, tokens):
+        time.sleep(self._reserve(tokens))
+
+    async def acquire_async(self, tokens):
+        await asyncio.sleep(self._reserve(tokens))
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    A cap on concurrent calls that adapts to rate limiting (AIMD):
+    the limit grows by one per "limit" successful calls, and halves on
+    every rate limited call.
+
+    Shared by threads and event loops, so sync calls (e.g. ingestion)
+    and async calls (the request path) count against the same limit.
+    """
+
+    def __init__(self, maximum, minimum):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self._limit = float(maximum)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._sync_waiters = threading.Condition(self._lock)
+        self._async_waiters = deque()  # (event loop, future)
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def _try_acquire(self):
+        if self._in_flight < self.limit:
+            self._in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self._sync_waiters:
+            while not self._try_acquire():
+                self._sync_waiters.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._try_acquire():
+                    return
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            await future
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            # Let every waiter try again (the limit may also have grown)
+            self._sync_waiters.notify_all()
+            while self._async_waiters:
+                loop, future = self._async_waiters.popleft()
+                loop.call_soon_threadsafe(_resolve, future)
+
+    def record_success(self):
+        with self._lock:
+            self._limit = min(self.maximum, self._limit + 1 / self._limit)
+
+    def record_rate_limited(self):
+        with self._lock:
+            self._limit = max(self.minimum, self._limit / 2)
+        logger.warning(
+            "Rate limited by OpenAI, concurrency limit now %d.", self.limit
+        )
+
+    def stats(self):
+        with self._lock:
+            return {"limit": self.limit, "in_flight": self._in_flight}
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class OutboundLimiter:
+    """
+    The limits on calls to one endpoint: a token budget (if configured)
+    and an adaptive concurrency limit.
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        )
+        self.concurrency = AdaptiveConcurrencyLimiter(
+            OPENAI_MAX_CONCURRENCY, OPENAI_MIN_CONCURRENCY
+        )
+
+    @contextmanager
+    def slot(self, estimated_tokens=0):
+        """Hold a slot for one call (retries included)."""
+        if self.token_bucket is not None:
+            self.token_bucket.acquire(estimated_tokens)
+        self.concurrency.acquire()
+        try:
+            yield
+            self.concurrency.record_success()
+        finally:
+            self.concurrency.release()
+
+    @asynccontextmanager
+    async def slot_async(self, estimated_tokens=0):
+        """Async variant of :meth:`slot`."""
+        if self.token_bucket is not None:
+            await self.token_bucket.acquire_async(estimated_tokens)
+        await self.concurrency.acquire_async()
+        try:
+            yield
+            self.concurrency.record_success()
+        finally:
+            self.concurrency.release()
+
+
+_limiters = {
+    "responses": OutboundLimiter(OPENAI_RESPONSES_TOKENS_PER_MINUTE),
+    "embeddings": OutboundLimiter(OPENAI_EMBEDDINGS_TOKENS_PER_MINUTE),
+}
+
+
+def get_limiter(endpoint):
+    """
+    Get the limiter for an OpenAI endpoint.
+
+    :param endpoint: "responses" or "embeddings".
+    :type endpoint: str
+    :rtype: OutboundLimiter
+    """
+    return _limiters[endpoint]
+
+
+def get_limiter_stats():
+    """Get the current concurrency limit and calls in flight, per endpoint."""
+    return {
+        endpoint: limiter.concurrency.stats()
+        for endpoint, limiter in _limiters.items()
+    }
+
+
+# Retries
+
+def is_openai_error(error):
+    """Whether an exception comes from openai (without importing it)."""
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(error, openai.OpenAIError)
+
+
+def is_retryable(error):
+    """Whether a failed call is worth retrying (429, 5xx or no response)."""
+    from openai import APIConnectionError, APIStatusError
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, APIConnectionError)  # Timeouts included
+
+
+def retry_delay(attempt, error=None):
+    """
+    How long to wait before retrying, in seconds: exponential backoff
+    with full jitter, or as long as the server asks (Retry-After).
+    """
+    from openai import APIStatusError
+    if isinstance(error, APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            return min(float(retry_after), OPENAI_RETRY_MAX_DELAY_SECONDS)
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(
+        OPENAI_RETRY_MAX_DELAY_SECONDS,
+        OPENAI_RETRY_BASE_DELAY_SECONDS * 2 ** attempt,
+    ))
+
+
+def _should_retry(limiter, attempt, error):
+    from openai import RateLimitError
+    if isinstance(error, RateLimitError):
+        limiter.concurrency.record_rate_limited()
+    if attempt >= OPENAI_MAX_RETRIES or not is_retryable(error):
+        return False
+    logger.info(
+        "OpenAI call failed (%s), retrying (%d of %d).",
+        error, attempt + 1, OPENAI_MAX_RETRIES,
+    )
+    return True
+
+
+def _retry(limiter, call):
+    from openai import APIConnectionError, APIStatusError
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except (APIStatusError, APIConnectionError) as e:
+            if not _should_retry(limiter, attempt, e):
+                raise
+            time.sleep(retry_delay(attempt, e))
+            attempt += 1
+
+
+async def _retry_async(limiter, call):
+    from openai import APIConnectionError, APIStatusError
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except (APIStatusError, APIConnectionError) as e:
+            if not _should_retry(limiter, attempt, e):
+                raise
+            await asyncio.sleep(retry_delay(attempt, e))
+            attempt += 1
+
+
+def call_with_retries(endpoint, call, estimated_tokens=0):
+    """
+    Call OpenAI within the endpoint's limits, retrying transient failures.
+
+    :param endpoint: "responses" or "embeddings".
+    :type endpoint: str
+    :param call: Makes the call (with no arguments).
+    :type call: Callable
+    :param estimated_tokens: The tokens the call is expected to use,
+        for the token budget.
+    :type estimated_tokens: int, optional
+    :returns: Whatever ``call`` returns.
+    :raises openai.OpenAIError: If the call fails for good.
+    """
+    limiter = get_limiter(endpoint)
+    with limiter.slot(estimated_tokens):
+        return _retry(limiter, call)
+
+
+async def call_with_retries_async(endpoint, call, estimated_tokens=0):
+    """
+    Async variant of :func:`call_with_retries`.
+
+    :param call: Returns an awaitable making the call (with no arguments).
+    :type call: Callable
+    """
+    limiter = get_limiter(endpoint)
+    async with limiter.slot_async(estimated_tokens):
+        return await _retry_async(limiter, call)
+
+
+@asynccontextmanager
+async def stream_with_retries_async(endpoint, call, estimated_tokens=0):
+    """
+    Like :func:`call_with_retries_async`, for a call returning a stream;
+    the endpoint's slot is held until the stream is done with.
+
+    Usage: ``async with stream_with_retries_async(...) as stream: ...``
+    """
+    limiter = get_limiter(endpoint)
+    async with limiter.slot_async(estimated_tokens):
+        yield await _retry_async(limiter, call)
@@ -0,0 +1,52 @@
+from os import getenv
+
+# Connection pools (one per client; kept alive between requests)
+OPENAI_MAX_CONNECTIONS = int(getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(
+    getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+OPENAI_KEEPALIVE_SECONDS = float(getenv("OPENAI_KEEPALIVE_SECONDS", "60"))
+CHROMA_MAX_CONNECTIONS = int(getenv("CHROMA_MAX_CONNECTIONS", "50"))
+CHROMA_MAX_KEEPALIVE_CONNECTIONS = int(
+    getenv("CHROMA_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+CHROMA_KEEPALIVE_SECONDS = float(getenv("CHROMA_KEEPALIVE_SECONDS", "60"))
+
+# Timeouts, in seconds (the read timeout applies per call type)
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(
+    getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "5")
+)
+OPENAI_RESPONSE_TIMEOUT_SECONDS = float(
+    getenv("OPENAI_RESPONSE_TIMEOUT_SECONDS", "60")
+)
+OPENAI_EMBEDDING_TIMEOUT_SECONDS = float(
+    getenv("OPENAI_EMBEDDING_TIMEOUT_SECONDS", "20")
+)
+
+# Retries on rate limits (429), server errors (5xx) and connection errors,
+# with exponential backoff and full jitter
+OPENAI_MAX_RETRIES = int(getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_RETRY_BASE_DELAY_SECONDS = float(
+    getenv("OPENAI_RETRY_BASE_DELAY_SECONDS", "0.5")
+)
+OPENAI_RETRY_MAX_DELAY_SECONDS = float(
+    getenv("OPENAI_RETRY_MAX_DELAY_SECONDS", "20")
+)
+
+# Adaptive concurrency limits (per endpoint): the limit grows by one per
+# "limit" successful calls, and halves on every rate limited one
+OPENAI_MAX_CONCURRENCY = int(getenv("OPENAI_MAX_CONCURRENCY", "64"))
+OPENAI_MIN_CONCURRENCY = int(getenv("OPENAI_MIN_CONCURRENCY", "2"))
+# Token budgets per minute (0 for none), e.g. the account's TPM limits
+OPENAI_RESPONSES_TOKENS_PER_MINUTE = int(
+    getenv("OPENAI_RESPONSES_TOKENS_PER_MINUTE", "0")
+)
+OPENAI_EMBEDDINGS_TOKENS_PER_MINUTE = int(
+    getenv("OPENAI_EMBEDDINGS_TOKENS_PER_MINUTE", "0")
+)
+
+# Fall back to mocked responses when OpenAI fails (for development only;
+# otherwise, failures are raised)
+OPENAI_MOCK_ON_FAILURE = (
+    getenv("OPENAI_MOCK_ON_FAILURE", "false").lower() == "true"
+)
@@ -0,0 +1,269 @@
+import json
+import logging
+import mmap
+import os
+import shutil
+from array import array
+from time import time
+import numpy as np
+from book_api.file_lock import file_lock
+
+logger = logging.getLogger(__name__)
+
+INDEX_MANIFEST_NAME = "index.json"
+EMBEDDINGS_FILE_NAME = "embeddings.npy"  # Normalized float32, one row a book
+BOOKS_FILE_NAME = "books.jsonl"  # One JSON record per book, same order
+OFFSETS_FILE_NAME = "offsets.npy"  # Byte offsets of the records (n + 1)
+BUILD_PAGE_SIZE = 1000  # Entries fetched from ChromaDB at a time
+
+
+class BookRecords:
+    """
+    Book records in a memory-mapped JSON lines file (with the byte offset
+    of each record), decoded on demand, so only the books actually read
+    are deserialized.
+    """
+
+    def __init__(self, path):
+        self.offsets = np.load(
+            os.path.join(path, OFFSETS_FILE_NAME), mmap_mode="r"
+        )
+        with open(os.path.join(path, BOOKS_FILE_NAME), "rb") as books_file:
+            self._books = (
+                mmap.mmap(books_file.fileno(), 0, access=mmap.ACCESS_READ)
+                if os.fstat(books_file.fileno()).st_size else b""
+            )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_book(self, row):
+        """Get the book record (id, title, author, summary) for a row."""
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return json.loads(self._books[start:end])
+
+    __getitem__ = get_book
+
+
+def write_book_records(path, books):
+    """
+    Write book records for :class:`BookRecords` to read.
+
+    :param path: The directory to write them to.
+    :type path: str
+    :param books: The book records, one dictionary each.
+    :type books: Iterable[dict]
+    """
+    offsets = array("q", [0])
+    with open(os.path.join(path, BOOKS_FILE_NAME), "wb") as books_file:
+        for book in books:
+            books_file.write(json.dumps(book).encode("utf-8") + b"\n")
+            offsets.append(books_file.tell())
+    np.save(
+        os.path.join(path, OFFSETS_FILE_NAME),
+        np.frombuffer(offsets, dtype=np.int64),
+    )
+
+
+class VectorIndex:
+    """
+    An in-process, memory-mapped vector index of the library.
+
+    Answers top-k cosine similarity queries with a single matrix product,
+    without any network hop. Book records are read from
+    :class:`BookRecords`.
+    """
+
+    def __init__(self, index_dir, version_dir, fingerprint):
+        self.fingerprint = fingerprint
+        self.path = path = os.path.join(index_dir, version_dir)
+        self.embeddings = np.load(
+            os.path.join(path, EMBEDDINGS_FILE_NAME), mmap_mode="r"
+        )
+        self.books = BookRecords(path)
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def get_book(self, row):
+        """Get the book record (id, title, author, summary) for a row."""
+        return self.books.get_book(row)
+
+    def search(self, query_embeddings, n_results):
+        """
+        Find the rows closest to each query embedding.
+
+        :param query_embeddings: The embeddings to search with.
+        :type query_embeddings: list[list[float]]
+        :param n_results: The number of rows to return per query.
+        :type n_results: int
+        :returns: For each query, a tuple of (row indices, cosine
+            distances), closest first.
+        :rtype: list[tuple[list[int], list[float]]]
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        n_results = min(n_results, len(self))
+        if n_results <= 0:
+            return [([], []) for _ in range(len(queries))]
+
+        # (n_queries x n_books) cosine similarities, in one product
+        similarities = queries @ self.embeddings.T
+        results = []
+        for row_similarities in similarities:
+            top = np.argpartition(-row_similarities, n_results - 1)
+            top = top[:n_results]
+            top = top[np.argsort(-row_similarities[top])]
+            results.append((
+                top.tolist(),
+                (1.0 - row_similarities[top]).tolist(),
+            ))
+        return results
+
+
+def read_index_manifest(index_dir):
+    """Read the index manifest, or return None if there's no index."""
+    try:
+        with open(os.path.join(index_dir, INDEX_MANIFEST_NAME)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def load_vector_index(index_dir):
+    """Load (memory-map) the current vector index, or return None."""
+    index_manifest = read_index_manifest(index_dir)
+    if index_manifest is None:
+        return None
+    return VectorIndex(
+        index_dir,
+        index_manifest["version_dir"],
+        index_manifest["fingerprint"],
+    )
+
+
+def build_vector_index(collection, index_dir, fingerprint):
+    """
+    Build the vector index from the embeddings already in ChromaDB.
+
+    No embedding calls are made. Entries are fetched and written a page at
+    a time, so memory use stays flat. The new index is written to a fresh
+    directory and swapped in atomically, so readers never see a partial
+    index.
+
+    :param collection: The ChromaDB collection to read from.
+    :type collection: chromadb.Collection
+    :param index_dir: The directory holding the index.
+    :type index_dir: str
+    :param fingerprint: Identifies the library contents being indexed.
+    :type fingerprint: str
+    """
+    version_dir, path = new_version_dir(index_dir)
+
+    count = collection.count()
+    embeddings = None
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    row = 0
+    with open(os.path.join(path, BOOKS_FILE_NAME), "wb") as books_file:
+        while row < count:
+            page = collection.get(
+                include=["embeddings", "metadatas", "documents"],
+                limit=BUILD_PAGE_SIZE,
+                offset=row,
+            )
+            page_embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+            if not len(page_embeddings):
+                raise RuntimeError(
+                    "ChromaDB collection changed while building the index"
+                )
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(
+                    os.path.join(path, EMBEDDINGS_FILE_NAME), mode="w+",
+                    dtype=np.float32, shape=(count, page_embeddings.shape[1])
+                )
+            norms = np.linalg.norm(page_embeddings, axis=1, keepdims=True)
+            page_end = row + len(page_embeddings)
+            embeddings[row:page_end] = (
+                page_embeddings / np.where(norms == 0, 1, norms)
+            )
+
+            for entry_id, metadata, document in zip(
+                page["ids"], page["metadatas"], page["documents"]
+            ):
+                books_file.write(json.dumps({
+                    "id": entry_id,
+                    "title": metadata.get("title", "Unknown Title"),
+                    "author": metadata.get("author", "Unknown Author"),
+                    "summary": document,
+                }).encode("utf-8") + b"\n")
+                row += 1
+                offsets[row] = books_file.tell()
+
+    if embeddings is None:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+        np.save(os.path.join(path, EMBEDDINGS_FILE_NAME), embeddings)
+    else:
+        embeddings.flush()
+        del embeddings
+    np.save(os.path.join(path, OFFSETS_FILE_NAME), offsets)
+
+    swap_in_version(index_dir, version_dir, fingerprint)
+    logger.info("Built vector index with %d entries.", row)
+
+
+def ensure_vector_index(get_collection, index_dir, fingerprint):
+    """
+    Make sure the vector index matches the library, (re)building it from
+    ChromaDB if needed.
+
+    :param get_collection: Gets the ChromaDB collection to build from
+        (only called if a build is needed).
+    :type get_collection: Callable
+    :param index_dir: The directory holding the index.
+    :type index_dir: str
+    :param fingerprint: Identifies the current library contents.
+    :type fingerprint: str
+    """
+    # Builds may be set off from several threads, or worker processes
+    with file_lock("vector_index"):
+        index_manifest = read_index_manifest(index_dir)
+        if (
+            index_manifest is None
+            or index_manifest["fingerprint"] != fingerprint
+        ):
+            build_vector_index(get_collection(), index_dir, fingerprint)
+
+
+def new_version_dir(index_dir):
+    """
+    Create a fresh version directory to build an index into.
+
+    :returns: A tuple of (the version directory's name, its path).
+    :rtype: tuple[str, str]
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    version_dir = f"v{time():.6f}".replace(".", "_")
+    path = os.path.join(index_dir, version_dir)
+    os.makedirs(path)
+    return version_dir, path
+
+
+def swap_in_version(index_dir, version_dir, fingerprint):
+    """
+    Point the index manifest at a newly built version (atomically, so
+    readers never see a partial index), then clean up older versions.
+    """
+    previous_manifest = read_index_manifest(index_dir)
+    manifest_path = os.path.join(index_dir, INDEX_MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump(
+            {"version_dir": version_dir, "fingerprint": fingerprint}, file
+        )
+    os.replace(manifest_path + ".tmp", manifest_path)
+    for name in os.listdir(index_dir):
+        is_old_version = name.startswith("v") and name != version_dir
+        if previous_manifest and name == previous_manifest["version_dir"]:
+            continue  # Might still be mapped by readers, keep one around
+        if is_old_version:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
@@ -1,5 +1,5 @@
 import { useState } from 'react'
-import { sendPrompt } from './api'
+import { streamPrompt } from './api'
 import './App.css'
 
 function App() {
@@ -7,8 +7,13 @@ function App() {
   const [apiResponse, setResponse] = useState("<Blank>")
 
   const handleClick = async () => {
-    const res = await sendPrompt(userPrompt)
-    setResponse(res)
+    setResponse("")
+    await streamPrompt(userPrompt, {
+      onBooks: books => setResponse(
+        "Found: " + books.map(book => `${book.title} (${book.author})`).join(", ") + "\n\n"
+      ),
+      onDelta: text => setResponse(previous => previous + text),
+    })
   }
 
   return (
@@ -17,3 +17,62 @@ export async function sendPrompt(prompt: string): Promise<string> {
     const data = (await response.json()) as PromptResponse
     return data.response
 }
+
+export type RecommendedBook = { title: string, author: string }
+export type StreamHandlers = {
+    onBooks?: (books: RecommendedBook[]) => void
+    onDelta: (text: string) => void
+}
+
+// Streams the response over server-sent events (POST, so no EventSource)
+export async function streamPrompt(
+    prompt: string,
+    { onBooks, onDelta }: StreamHandlers,
+): Promise<void> {
+    const response = await fetch('/api/book-recommendation/stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ prompt } as PromptRequest),
+    })
+
+    if (!response.ok || !response.body) {
+        throw new Error(`Error: ${response.statusText}`)
+    }
+
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+    let buffer = ''
+    while (true) {
+        const { value, done } = await reader.read()
+        if (done) {
+            break
+        }
+        buffer += value
+
+        // Events are separated by a blank line
+        let separatorIndex
+        while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, separatorIndex)
+            buffer = buffer.slice(separatorIndex + 2)
+
+            let event = 'message'
+            let data = ''
+            for (const line of rawEvent.split('\n')) {
+                if (line.startsWith('event: ')) {
+                    event = line.slice('event: '.length)
+                } else if (line.startsWith('data: ')) {
+                    data += line.slice('data: '.length)
+                }
+            }
+
+            if (event === 'books') {
+                onBooks?.(JSON.parse(data) as RecommendedBook[])
+            } else if (event === 'delta') {
+                onDelta((JSON.parse(data) as { text: string }).text)
+            } else if (event === 'error') {
+                throw new Error(`Error: ${(JSON.parse(data) as { detail: string }).detail}`)
+            }
+        }
+    }
+}